@@ -1,12 +1,21 @@
 import os
+import io
+import csv
 import json
-from flask import Flask, request, jsonify
+import time
+import base64
+import binascii
+import click
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from flask_jwt_extended import create_access_token, jwt_required, JWTManager, get_jwt_identity
+from flask_jwt_extended import create_access_token, create_refresh_token, decode_token, get_jwt, jwt_required, JWTManager
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt.exceptions import PyJWTError
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_cors import CORS
 from decimal import Decimal
-from datetime import timedelta # Ensure timedelta is imported for explicit token expiry
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone # Ensure timedelta is imported for explicit token expiry
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -22,7 +31,77 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL',
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'super-secret-dev-key-make-sure-to-change-this') # Added a more explicit warning in default
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(minutes=15) # Explicitly setting default, can be configured via ENV if needed
+# Refresh tokens (issued at login, exchanged at /auth/refresh for new access tokens without a password check)
+app.config['JWT_REFRESH_TOKEN_EXPIRES'] = timedelta(days=int(os.environ.get('JWT_REFRESH_TOKEN_DAYS', 30)))
 app.config['ALPHA_VANTAGE_API_KEY'] = os.environ.get('ALPHA_VANTAGE_API_KEY', 'YOUR_ALPHA_VANTAGE_API_KEY_PLEASE_SET') # Added a more explicit warning
+# Alpha Vantage client: call budget (shared by all threads), max seconds a caller waits for budget before failing fast,
+# HTTP timeout and pool size, and circuit breaker (consecutive failures to open, seconds before a trial call)
+app.config['ALPHA_VANTAGE_CALLS_PER_MINUTE'] = float(os.environ.get('ALPHA_VANTAGE_CALLS_PER_MINUTE', 5))
+app.config['ALPHA_VANTAGE_BURST'] = int(os.environ.get('ALPHA_VANTAGE_BURST', 5))
+app.config['ALPHA_VANTAGE_MAX_WAIT'] = float(os.environ.get('ALPHA_VANTAGE_MAX_WAIT', 2))
+app.config['ALPHA_VANTAGE_TIMEOUT'] = float(os.environ.get('ALPHA_VANTAGE_TIMEOUT', 10))
+app.config['ALPHA_VANTAGE_POOL_SIZE'] = int(os.environ.get('ALPHA_VANTAGE_POOL_SIZE', 10))
+app.config['ALPHA_VANTAGE_BREAKER_THRESHOLD'] = int(os.environ.get('ALPHA_VANTAGE_BREAKER_THRESHOLD', 5))
+app.config['ALPHA_VANTAGE_BREAKER_RESET'] = float(os.environ.get('ALPHA_VANTAGE_BREAKER_RESET', 60))
+# Simulated market for MOCK_ASSET_PRICES=true: seed, optional directory for memory-mapped paths shared by workers,
+# and an optional fixed ISO timestamp (e.g. '2025-03-03T15:00:00+00:00') so load tests see identical prices every run
+app.config['MARKET_SIM_SEED'] = int(os.environ.get('MARKET_SIM_SEED', 42))
+app.config['MARKET_SIM_CACHE_DIR'] = os.environ.get('MARKET_SIM_CACHE_DIR') or None
+app.config['MARKET_SIM_FREEZE_AT'] = os.environ.get('MARKET_SIM_FREEZE_AT') or None
+# Price cache: seconds a quote stays fresh, per asset type, and max number of symbols kept (LRU)
+app.config['PRICE_CACHE_TTL_STOCK'] = float(os.environ.get('PRICE_CACHE_TTL_STOCK', 60))
+app.config['PRICE_CACHE_TTL_CRYPTO'] = float(os.environ.get('PRICE_CACHE_TTL_CRYPTO', 30))
+app.config['PRICE_CACHE_TTL_DEFAULT'] = float(os.environ.get('PRICE_CACHE_TTL_DEFAULT', 60))
+app.config['PRICE_CACHE_MAX_ENTRIES'] = int(os.environ.get('PRICE_CACHE_MAX_ENTRIES', 1024))
+# Background refresher (flask refresh-prices): upstream call budget, and how old a stored snapshot may be when served
+app.config['PRICE_REFRESH_CALLS_PER_MINUTE'] = float(os.environ.get('PRICE_REFRESH_CALLS_PER_MINUTE', 5))
+app.config['PRICE_SNAPSHOT_MAX_AGE'] = float(os.environ.get('PRICE_SNAPSHOT_MAX_AGE', 300))
+# Request handlers only read snapshots and never wait on Alpha Vantage; set to 'true' to fetch inline on a missing
+# or stale snapshot instead (dev setups that don't run the refresher)
+app.config['PRICE_FETCH_ON_SNAPSHOT_MISS'] = os.environ.get('PRICE_FETCH_ON_SNAPSHOT_MISS', 'false').lower() == 'true'
+# Concurrent upstream price fetches shared by all requests, and max symbols per /assets/prices call
+app.config['PRICE_FETCH_MAX_WORKERS'] = int(os.environ.get('PRICE_FETCH_MAX_WORKERS', 8))
+app.config['PRICE_BATCH_MAX_SYMBOLS'] = int(os.environ.get('PRICE_BATCH_MAX_SYMBOLS', 50))
+# Max orders accepted by one POST /trades/orders batch
+app.config['TRADE_BATCH_MAX_ORDERS'] = int(os.environ.get('TRADE_BATCH_MAX_ORDERS', 50))
+# Server-Sent Events price stream: seconds between polls per symbol, heartbeat interval, open streams per user
+app.config['STREAM_POLL_INTERVAL'] = float(os.environ.get('STREAM_POLL_INTERVAL', 5))
+app.config['STREAM_HEARTBEAT_INTERVAL'] = float(os.environ.get('STREAM_HEARTBEAT_INTERVAL', 15))
+app.config['STREAM_MAX_CONNECTIONS_PER_USER'] = int(os.environ.get('STREAM_MAX_CONNECTIONS_PER_USER', 3))
+# Minimum seconds between upstream checks for new history bars of one asset/interval
+app.config['HISTORY_RECHECK_SECONDS'] = float(os.environ.get('HISTORY_RECHECK_SECONDS', 900))
+app.config['HISTORY_CACHE_TTL'] = float(os.environ.get('HISTORY_CACHE_TTL', 60))
+app.config['HISTORY_CACHE_MAX_ENTRIES'] = int(os.environ.get('HISTORY_CACHE_MAX_ENTRIES', 2048))
+app.config['INDICATOR_CACHE_TTL'] = float(os.environ.get('INDICATOR_CACHE_TTL', 3600))
+# Memoized /portfolio/performance results (keyed by the user's last trade and snapshot, so a new trade invalidates them)
+app.config['PERFORMANCE_CACHE_TTL'] = float(os.environ.get('PERFORMANCE_CACHE_TTL', 3600))
+app.config['PERFORMANCE_CACHE_MAX_ENTRIES'] = int(os.environ.get('PERFORMANCE_CACHE_MAX_ENTRIES', 1024))
+# /trades keyset pagination: default and max page size
+app.config['TRADES_PAGE_SIZE'] = int(os.environ.get('TRADES_PAGE_SIZE', 50))
+app.config['TRADES_MAX_PAGE_SIZE'] = int(os.environ.get('TRADES_MAX_PAGE_SIZE', 500))
+# Leaderboard (maintained by a background thread per worker): seconds between catch-up syncs with other workers' writes,
+# between full rebuilds, and max page size
+app.config['LEADERBOARD_SYNC_INTERVAL'] = float(os.environ.get('LEADERBOARD_SYNC_INTERVAL', 5))
+app.config['LEADERBOARD_FULL_RELOAD_INTERVAL'] = float(os.environ.get('LEADERBOARD_FULL_RELOAD_INTERVAL', 600))
+app.config['LEADERBOARD_MAX_PAGE_SIZE'] = int(os.environ.get('LEADERBOARD_MAX_PAGE_SIZE', 100))
+# Seconds an admin JWT claim is trusted before the user's current role is re-read (bounds how long a demoted admin keeps access)
+app.config['ROLE_CACHE_TTL'] = float(os.environ.get('ROLE_CACHE_TTL', 30))
+app.config['ROLE_CACHE_MAX_ENTRIES'] = int(os.environ.get('ROLE_CACHE_MAX_ENTRIES', 1024))
+# Password hashing: werkzeug method for new hashes (older hashes are upgraded on login), hashing processes (0 = inline),
+# calls allowed to wait for a free process before sign-ins get a 503, and max seconds per hash or check
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+app.config['PASSWORD_POOL_WORKERS'] = int(os.environ.get('PASSWORD_POOL_WORKERS', 2))
+app.config['PASSWORD_POOL_MAX_PENDING'] = int(os.environ.get('PASSWORD_POOL_MAX_PENDING', 16))
+app.config['PASSWORD_HASH_TIMEOUT'] = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 5))
+# Token revocation: revoked tokens a worker's Bloom filter is sized for, seconds between syncs with other workers' revocations,
+# and between full rebuilds (which drop expired entries)
+app.config['REVOCATION_BLOOM_CAPACITY'] = int(os.environ.get('REVOCATION_BLOOM_CAPACITY', 100000))
+app.config['REVOCATION_SYNC_INTERVAL'] = float(os.environ.get('REVOCATION_SYNC_INTERVAL', 5))
+app.config['REVOCATION_FULL_RELOAD_INTERVAL'] = float(os.environ.get('REVOCATION_FULL_RELOAD_INTERVAL', 3600))
+# Public content responses: seconds an encoded page or item is served from memory (writes in this worker invalidate at once,
+# other workers' within the TTL) and entries kept
+app.config['CONTENT_CACHE_TTL'] = float(os.environ.get('CONTENT_CACHE_TTL', 60))
+app.config['CONTENT_CACHE_MAX_ENTRIES'] = int(os.environ.get('CONTENT_CACHE_MAX_ENTRIES', 512))
 
 # Initialize CORS
 # Allow all origins specified in FRONTEND_URL or default to localhost
@@ -35,14 +114,84 @@ CORS(app, resources={r'/*': {'origins': frontend_urls}}, supports_credentials=Tr
 
 # Initialize Extensions
 # Ensure models.py is correctly structured and in the same directory or accessible via PYTHONPATH
-from models import db, User, EducationalContent, Asset, Trade, PortfolioHolding, News, Quiz, QuizQuestion, Module
+from models import db, User, EducationalContent, Asset, Trade, PortfolioHolding, OpenOrder, RevokedToken, News, Quiz, QuizQuestion, Module
+from cache import TTLCache
+from market_data import AlphaVantageClient, Quote
+from market_sim import MarketSimulator
+from price_refresh import PriceRefreshScheduler, read_price_snapshot, read_price_snapshots
+from price_history import HistoryStore, HISTORY_RANGES
+from price_stream import PriceBroker, TooManyConnections
+from orders import OrderRejected, lock_user_row, execute_market_order
+from order_book import OrderMatcher, RESTING_ORDER_TYPES
+from downsample import downsample_history
+from leaderboard import Leaderboard
+from performance import compute_performance, performance_version
+from reconcile import reconcile
+from identity import current_user, role_claims, RoleCache
+from passwords import PasswordHasher, HashingUnavailable
+from revocation import RevocationStore
+from user_import import import_users
+from response_cache import ResponseCache, cached_body, conditional_response
+from query_audit import HotQuery, audit
+from portfolio_snapshots import PORTFOLIO_HISTORY_RANGES, take_portfolio_snapshots, portfolio_history_query
+from serialization import (json_object, json_response, stream_json_response, encode_with_children, ASSET_FIELDS, TRADE_FIELDS, OPEN_ORDER_FIELDS,
+                           SNAPSHOT_FIELDS, CONTENT_FIELDS, NEWS_FIELDS, QUIZ_FIELDS, QUIZ_QUESTION_FIELDS, MODULE_FIELDS, ADMIN_USER_FIELDS)
+from indicators import parse_indicator_spec, compute_indicators, to_json_lists
 db.init_app(app)
 jwt = JWTManager(app)
 
-# Alpha Vantage specific imports
-from alpha_vantage.foreignexchange import ForeignExchange
-from alpha_vantage.timeseries import TimeSeries
-import requests
+# The one Alpha Vantage client: pooled connections, shared rate limit, circuit breaker
+market_data = AlphaVantageClient(
+    api_key=app.config['ALPHA_VANTAGE_API_KEY'],
+    calls_per_minute=app.config['ALPHA_VANTAGE_CALLS_PER_MINUTE'],
+    burst=app.config['ALPHA_VANTAGE_BURST'],
+    max_wait=app.config['ALPHA_VANTAGE_MAX_WAIT'],
+    timeout=app.config['ALPHA_VANTAGE_TIMEOUT'],
+    pool_size=app.config['ALPHA_VANTAGE_POOL_SIZE'],
+    failure_threshold=app.config['ALPHA_VANTAGE_BREAKER_THRESHOLD'],
+    reset_timeout=app.config['ALPHA_VANTAGE_BREAKER_RESET']
+)
+
+# Deterministic market used when MOCK_ASSET_PRICES=true
+market_sim = MarketSimulator(seed=app.config['MARKET_SIM_SEED'], cache_dir=app.config['MARKET_SIM_CACHE_DIR'])
+
+def market_sim_now():
+    frozen = app.config['MARKET_SIM_FREEZE_AT']
+    return datetime.fromisoformat(frozen).astimezone(timezone.utc) if frozen else datetime.now(timezone.utc)
+
+# Process-wide quote cache shared by every endpoint that needs a current price
+price_cache = TTLCache(max_entries=app.config['PRICE_CACHE_MAX_ENTRIES'], default_ttl=app.config['PRICE_CACHE_TTL_DEFAULT'])
+# In-memory ranking by account value, kept up to date incrementally off the request path (see leaderboard.py)
+leaderboard = Leaderboard(
+    sync_interval=app.config['LEADERBOARD_SYNC_INTERVAL'],
+    full_reload_interval=app.config['LEADERBOARD_FULL_RELOAD_INTERVAL']
+)
+# FIFO lots and risk metrics per user, keyed by (user_id, last trade id, last snapshot time)
+performance_cache = TTLCache(max_entries=app.config['PERFORMANCE_CACHE_MAX_ENTRIES'], default_ttl=app.config['PERFORMANCE_CACHE_TTL'])
+# Admin flag per user, confirming is_admin JWT claims (see identity.RoleCache)
+role_cache = RoleCache(TTLCache(max_entries=app.config['ROLE_CACHE_MAX_ENTRIES'], default_ttl=app.config['ROLE_CACHE_TTL']))
+# Encoded GET /content pages and items (see response_cache.ResponseCache)
+content_responses = ResponseCache(TTLCache(max_entries=app.config['CONTENT_CACHE_MAX_ENTRIES'], default_ttl=app.config['CONTENT_CACHE_TTL']))
+# Password hashing and checks run in this bounded process pool, never on the request thread
+password_hasher = PasswordHasher(
+    method=app.config['PASSWORD_HASH_METHOD'],
+    workers=app.config['PASSWORD_POOL_WORKERS'],
+    max_pending=app.config['PASSWORD_POOL_MAX_PENDING'],
+    timeout=app.config['PASSWORD_HASH_TIMEOUT']
+)
+# Revoked token ids (logout), checked in memory on every authenticated request
+revocations = RevocationStore(
+    capacity=app.config['REVOCATION_BLOOM_CAPACITY'],
+    sync_interval=app.config['REVOCATION_SYNC_INTERVAL'],
+    full_reload_interval=app.config['REVOCATION_FULL_RELOAD_INTERVAL']
+)
+
+@jwt.token_in_blocklist_loader
+def check_if_token_revoked(jwt_header, jwt_payload):
+    return revocations.is_revoked(jwt_payload['jti'])
+
+# Bounded pool for upstream quote fetches, so a burst of misses can't fan out unboundedly
+price_fetch_executor = ThreadPoolExecutor(max_workers=app.config['PRICE_FETCH_MAX_WORKERS'], thread_name_prefix='price-fetch')
 
 
 # --- Database Initialization Command (for development) ---
@@ -52,6 +201,130 @@ def init_db_command():
         db.create_all()
     print("Initialized the database. All tables created.")
 
+@app.cli.command("refresh-prices")
+@click.option('--once', is_flag=True, help="Refresh every asset once, then exit.")
+@click.option('--calls-per-minute', type=float, default=None, help="Upstream call budget (defaults to PRICE_REFRESH_CALLS_PER_MINUTE).")
+def refresh_prices_command(once, calls_per_minute):
+    # Every refreshed quote is a tick for the limit/stop order book
+    matcher = OrderMatcher()
+    def on_price(asset, price):
+        price_cache.set(asset.symbol, price, ttl=price_cache_ttl_for(asset.asset_type))
+        filled = matcher.on_price(asset, price)
+        if filled:
+            print(f"Filled {filled} resting orders for {asset.symbol} at {price}.")
+
+    scheduler = PriceRefreshScheduler(
+        fetch_quote=fetch_quote_from_alpha_vantage,
+        calls_per_minute=calls_per_minute or app.config['PRICE_REFRESH_CALLS_PER_MINUTE'],
+        on_price=on_price
+    )
+    if once:
+        refreshed = scheduler.run_cycle()
+        print(f"Refreshed {refreshed} asset prices.")
+    else:
+        print(f"Refreshing asset prices continuously ({scheduler.min_interval:.1f}s between upstream calls). Ctrl+C to stop.")
+        scheduler.run_forever()
+
+@app.cli.command("snapshot-portfolios")
+@click.option('--full', is_flag=True, help="Value every user, not only those whose holdings or prices changed.")
+@click.option('--every', type=float, default=None, help="Keep running, taking snapshots every N seconds.")
+def snapshot_portfolios_command(full, every):
+    while True:
+        written = take_portfolio_snapshots(full=full)
+        print(f"Wrote {written} portfolio snapshots.")
+        if every is None:
+            break
+        time.sleep(every)
+
+@app.cli.command("reconcile")
+@click.option('--workers', type=int, default=1, help="Worker processes; 1 runs everything in this process.")
+@click.option('--partitions', type=int, default=None, help="User id ranges to split the work into (default: 4 per worker).")
+@click.option('--repair', is_flag=True, help="Rewrite mismatched portfolio_holdings rows from the trade ledger.")
+@click.option('--tolerance', type=str, default='0.000001', help="Allowed difference in average purchase price.")
+@click.option('--starting-cash', type=str, default='10000.00', help="Cash every account starts with, for the cash check.")
+def reconcile_command(workers, partitions, repair, tolerance, starting_cash):
+    """Checks portfolio_holdings and cash balances against the trades table."""
+    totals = {}
+    samples = []
+    started = time.perf_counter()
+    for report in reconcile(partitions or max(1, workers) * 4, workers=workers, repair=repair,
+                            tolerance=Decimal(tolerance), starting_cash=Decimal(starting_cash)):
+        samples.extend(report.pop('samples'))
+        low, high = report.pop('users')
+        for key, value in report.items():
+            totals[key] = totals.get(key, 0) + value
+        print(f"users {low}-{high}: {report['trades']} trades, {report['pairs']} positions replayed")
+
+    print(f"Reconciled {totals.get('trades', 0)} trades in {time.perf_counter() - started:.1f}s.")
+    for key in ('missing', 'unexpected', 'quantity', 'average_cost', 'negative_ledger', 'cash_adjusted', 'negative_cash'):
+        print(f"  {key}: {totals.get(key, 0)}")
+    if repair:
+        print(f"  repaired holdings rows: {totals.get('repaired', 0)}")
+    for sample in samples[:20]:
+        print(f"  e.g. {sample}")
+
+@app.cli.command("prune-revoked-tokens")
+def prune_revoked_tokens_command():
+    """Deletes revocation records of tokens that have expired anyway."""
+    deleted = db.session.execute(db.delete(RevokedToken).where(RevokedToken.expires_at <= datetime.now(timezone.utc))).rowcount
+    db.session.commit()
+    print(f"Deleted {deleted} expired revoked tokens.")
+
+@app.cli.command("import-users")
+@click.argument('csv_file', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--workers', type=int, default=4, help="Password hashing processes (0 hashes in this process).")
+@click.option('--batch-size', type=int, default=1000, help="Rows validated, hashed and inserted per round.")
+@click.option('--method', default=None, help="werkzeug hash method (defaults to PASSWORD_HASH_METHOD).")
+@click.option('--report', 'report_file', type=click.File('w'), default=None, help="Write rejected rows (line, username, email, error) as CSV.")
+@click.option('--dry-run', is_flag=True, help="Validate and hash, but insert nothing.")
+def import_users_command(csv_file, workers, batch_size, method, report_file, dry_run):
+    """Creates accounts from a CSV with username, email, password (and optional cohort, cash_balance) columns."""
+    started = time.perf_counter()
+    try:
+        report = import_users(csv_file, method=method or app.config['PASSWORD_HASH_METHOD'], workers=workers,
+                              batch_size=batch_size, dry_run=dry_run)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    verb = "Validated" if dry_run else "Created"
+    print(f"{verb} {report.created} of {report.read} users in {time.perf_counter() - started:.1f}s, {len(report.errors)} rejected.")
+    if report_file:
+        report.write_errors(report_file)
+    else:
+        for line, username, email, error in report.errors[:20]:
+            print(f"  line {line} ({username or email}): {error}")
+        if len(report.errors) > 20:
+            print(f"  ... {len(report.errors) - 20} more; use --report to write them all")
+
+@app.cli.command("create-indexes")
+def create_indexes_command():
+    """Creates any index declared on the models that the database lacks (safe to rerun)."""
+    created = 0
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name in existing:
+                continue
+            index.create(bind=db.engine, checkfirst=True)
+            print(f"Created {index.name} on {table.name}.")
+            created += 1
+    print(f"Created {created} indexes.")
+
+@app.cli.command("explain-hot-queries")
+@click.option('--seed-rows', type=int, default=10000, help="Trades to seed (other tables in proportion); 0 explains against the data as is.")
+@click.option('--verbose', is_flag=True, help="Print every plan, not only the flagged ones.")
+def explain_hot_queries_command(seed_rows, verbose):
+    """EXPLAINs the queries the endpoints issue and flags full table scans. Seeded rows are rolled back."""
+    flagged_count = 0
+    for query, flagged, notes, plan in audit(hot_queries, seed_rows=seed_rows):
+        status = f"FULL SCAN of {', '.join(flagged)}" if flagged else "ok"
+        print(f"{query.name}: {status}" + (f" ({'; '.join(notes)})" if notes else ""))
+        if flagged or verbose:
+            print('    ' + plan.replace('\n', '\n    '))
+        flagged_count += bool(flagged)
+    if flagged_count:
+        raise click.ClickException(f"{flagged_count} hot queries scan a whole table.")
+
 # --- API Endpoints ---
 @app.route('/')
 def home():
@@ -82,8 +355,11 @@ def register():
     if User.query.filter((User.username == username) | (User.email == email)).first():
         return jsonify(message="Username or email already exists"), 409
 
-    new_user = User(username=username, email=email)
-    new_user.set_password(password)
+    try:
+        password_hash = password_hasher.hash(password)
+    except HashingUnavailable as e:
+        return jsonify(message=e.message), 503
+    new_user = User(username=username, email=email, password_hash=password_hash)
     try:
         db.session.add(new_user)
         db.session.commit()
@@ -111,11 +387,23 @@ def login():
     user_query = User.query.filter((User.username == username_or_email) | (User.email == username_or_email))
     user = user_query.first()
 
-    if user and user.check_password(password):
+    try:
+        password_ok = user is not None and password_hasher.verify(user.password_hash, password)
+        if password_ok and password_hasher.needs_rehash(user.password_hash):
+            # Hash parameters changed since this password was stored: upgrade it now that we have the plaintext
+            user.password_hash = password_hasher.hash(password)
+            db.session.commit()
+    except HashingUnavailable as e:
+        db.session.rollback()
+        return jsonify(message=e.message), 503
+
+    if password_ok:
         identity_data = {'id': user.id, 'username': user.username}
-        access_token = create_access_token(identity=json.dumps(identity_data))
+        access_token = create_access_token(identity=json.dumps(identity_data), additional_claims=role_claims(user))
+        refresh_token = create_refresh_token(identity=json.dumps(identity_data))
         return jsonify(
             access_token=access_token,
+            refresh_token=refresh_token,
             id=user.id,
             username=user.username,
             email=user.email,
@@ -124,12 +412,44 @@ def login():
     else:
         return jsonify(message="Invalid username/email or password"), 401
 
+@app.route('/auth/refresh', methods=['POST'])
+@jwt_required(refresh=True)
+def refresh_access_token():
+    """
+    Exchanges a refresh token (Authorization: Bearer <refresh_token>) for a new access token.
+    No password check: the role claim comes from the role cache, revocation from the in-memory filter.
+    Output: {"access_token": "..."}
+    """
+    user = current_user()
+    access_token = create_access_token(identity=json.dumps(user.identity()),
+                                       additional_claims={'is_admin': role_cache.is_admin(user.id)})
+    return jsonify(access_token=access_token), 200
+
+@app.route('/auth/logout', methods=['POST'])
+@jwt_required(verify_type=False)
+def logout():
+    """
+    Revokes the presented token (access or refresh) and, if given, the session's refresh token.
+    Body (optional): {"refresh_token": "..."}
+    """
+    user_id = current_user().id
+    tokens = [get_jwt()]
+    refresh_token = (request.get_json(silent=True) or {}).get('refresh_token')
+    if refresh_token:
+        try:
+            tokens.append(decode_token(refresh_token, allow_expired=True))
+        except (JWTExtendedException, PyJWTError):
+            return jsonify(message="Invalid refresh token."), 400
+        if json.loads(tokens[-1]['sub'])['id'] != user_id:
+            return jsonify(message="Refresh token belongs to another user."), 403
+    for token in tokens:
+        revocations.revoke(token['jti'], user_id, token['type'], datetime.fromtimestamp(token['exp'], timezone.utc))
+    return jsonify(message="Logged out."), 200
+
 @app.route('/protected', methods=['GET'])
 @jwt_required()
 def protected():
-    raw_identity = get_jwt_identity()
-    current_user_identity = json.loads(raw_identity)
-    return jsonify(logged_in_as=current_user_identity), 200
+    return jsonify(logged_in_as=current_user().identity()), 200
 
 # --- Educational Content (CMS) Endpoints ---
 @app.route('/content', methods=['POST'])
@@ -142,9 +462,7 @@ def create_content():
     body = data.get('body')
     video_url = data.get('video_url')
     
-    raw_identity = get_jwt_identity()
-    current_user_identity_dict = json.loads(raw_identity)
-    author_id = current_user_identity_dict['id']
+    author_id = current_user().id
 
     if not title or not content_type: return jsonify(message="Title and content_type are required"), 400
     if content_type not in ['article', 'video', 'tutorial']:
@@ -156,21 +474,40 @@ def create_content():
         db.session.commit()
     except Exception as e:
         db.session.rollback(); app.logger.error(f"Error creating content: {str(e)}"); return jsonify(message="Error creating content"), 500
+    content_responses.invalidate()
     return jsonify(message="Content created successfully", content=new_content.to_dict()), 201
 
 @app.route('/content', methods=['GET'])
 def list_content():
+    """
+    Served from the response cache, with an ETag (If-None-Match gets a 304).
+    No Last-Modified: a deletion changes a page without moving its newest updated_at.
+    """
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 10, type=int)
-    contents_pagination = EducationalContent.query.order_by(EducationalContent.created_at.desc()).paginate(page=page, per_page=per_page, error_out=False)
-    contents = contents_pagination.items
-    return jsonify(contents=[content.to_dict() for content in contents], total=contents_pagination.total, pages=contents_pagination.pages, current_page=contents_pagination.page), 200
+    # Same clamping as Flask-SQLAlchemy's paginate(error_out=False)
+    page = page if page >= 1 else 1
+    per_page = per_page if per_page >= 1 else 20
+
+    def build():
+        total = db.session.execute(db.select(db.func.count(EducationalContent.id))).scalar()
+        rows = db.session.execute(
+            CONTENT_FIELDS.select().order_by(EducationalContent.created_at.desc()).limit(per_page).offset((page - 1) * per_page)
+        ).all()
+        return cached_body(json_object(contents=CONTENT_FIELDS.encode_list(rows), total=total, pages=-(-total // per_page), current_page=page))
+
+    return conditional_response(content_responses.page((page, per_page), build))
 
 @app.route('/content/<int:content_id>', methods=['GET'])
 def get_content(content_id):
-    content = EducationalContent.query.get(content_id)
-    if not content: return jsonify(message="Content not found"), 404
-    return jsonify(content.to_dict()), 200
+    """Served from the response cache, with an ETag and Last-Modified (updated_at); matching validators get a 304."""
+    def build():
+        row = db.session.execute(CONTENT_FIELDS.select().where(EducationalContent.id == content_id)).first()
+        return cached_body(CONTENT_FIELDS.encode(row), row.updated_at) if row else None
+
+    cached = content_responses.item(content_id, build)
+    if cached is None: return jsonify(message="Content not found"), 404
+    return conditional_response(cached)
 
 @app.route('/content/<int:content_id>', methods=['PUT'])
 @jwt_required()
@@ -178,9 +515,7 @@ def update_content(content_id):
     content = EducationalContent.query.get(content_id)
     if not content: return jsonify(message="Content not found"), 404
     
-    raw_identity = get_jwt_identity()
-    current_user_identity_dict = json.loads(raw_identity)
-    if content.author_id != current_user_identity_dict['id']: return jsonify(message="Forbidden: You can only update your own content"), 403
+    if content.author_id != current_user().id: return jsonify(message="Forbidden: You can only update your own content"), 403
 
     data = request.get_json();
     if not data: return jsonify(message="Request body must be JSON"), 400
@@ -193,6 +528,7 @@ def update_content(content_id):
         db.session.commit()
     except Exception as e:
         db.session.rollback(); app.logger.error(f"Error updating content: {str(e)}"); return jsonify(message="Error updating content"), 500
+    content_responses.invalidate(content_id)
     return jsonify(message="Content updated successfully", content=content.to_dict()), 200
 
 @app.route('/content/<int:content_id>', methods=['DELETE'])
@@ -201,15 +537,14 @@ def delete_content(content_id):
     content = EducationalContent.query.get(content_id)
     if not content: return jsonify(message="Content not found"), 404
 
-    raw_identity = get_jwt_identity()
-    current_user_identity_dict = json.loads(raw_identity)
-    if content.author_id != current_user_identity_dict['id']: return jsonify(message="Forbidden: You can only delete your own content"), 403
+    if content.author_id != current_user().id: return jsonify(message="Forbidden: You can only delete your own content"), 403
     
     try:
         db.session.delete(content)
         db.session.commit()
     except Exception as e:
         db.session.rollback(); app.logger.error(f"Error deleting content: {str(e)}"); return jsonify(message="Error deleting content"), 500
+    content_responses.invalidate(content_id)
     return jsonify(message="Content deleted successfully"), 200
 
 # --- Asset and Price Data Endpoints ---
@@ -217,61 +552,181 @@ def delete_content(content_id):
 @jwt_required() 
 def list_assets():
     try:
-        assets = Asset.query.all()
-        return jsonify(assets=[asset.to_dict() for asset in assets]), 200
+        rows = db.session.execute(ASSET_FIELDS.select().order_by(Asset.id)).all()
+        return json_response(assets=ASSET_FIELDS.encode_list(rows))
     except Exception as e:
         app.logger.error(f"Error fetching assets: {str(e)}")
         return jsonify(message="Error fetching assets from database"), 500
 
-# --- Helper function to get current price ---
+# --- Helper functions to get current price ---
+def price_cache_ttl_for(asset_type):
+    asset_type = (asset_type or '').lower()
+    if asset_type == 'stock':
+        return app.config['PRICE_CACHE_TTL_STOCK']
+    if asset_type == 'crypto':
+        return app.config['PRICE_CACHE_TTL_CRYPTO']
+    return app.config['PRICE_CACHE_TTL_DEFAULT']
+
 def get_current_price_for_asset(asset_db_object):
-    if os.environ.get('MOCK_ASSET_PRICES') == 'true':
-        app.logger.info(f"MOCK PRICE: Returning mock price for {asset_db_object.symbol}")
-        if asset_db_object.asset_type.lower() == 'stock':
-            return Decimal('150.75')
-        elif asset_db_object.asset_type.lower() == 'crypto':
-            return Decimal('2500.50')
+    """
+    Returns the current price of an asset as a Decimal, or None if unavailable.
+    Served from the process-wide price cache; on a miss the latest asset_prices
+    snapshot is used. Without a fresh snapshot the price is unavailable, unless
+    PRICE_FETCH_ON_SNAPSHOT_MISS opts in to calling Alpha Vantage inline.
+    Concurrent misses for the same symbol share a single load.
+    """
+    return price_cache.get_or_load(
+        asset_db_object.symbol,
+        lambda: load_price(asset_db_object),
+        ttl=price_cache_ttl_for(asset_db_object.asset_type)
+    )
+
+def load_price(asset_db_object):
+    price = read_price_snapshot(asset_db_object.id, app.config['PRICE_SNAPSHOT_MAX_AGE'])
+    if price is not None:
+        return price
+    if not app.config['PRICE_FETCH_ON_SNAPSHOT_MISS']:
+        app.logger.warning(f"No fresh price snapshot for {asset_db_object.symbol}; is `flask refresh-prices` running?")
+        return None
+    return fetch_price_from_alpha_vantage(asset_db_object)
+
+def get_current_prices_for_assets(assets):
+    """
+    Batch version of get_current_price_for_asset: returns {symbol: Decimal or None}.
+    Cache hits are served directly, the remaining symbols are resolved with one
+    asset_prices query; with PRICE_FETCH_ON_SNAPSHOT_MISS, whatever is still
+    missing is fetched from Alpha Vantage concurrently on the shared price-fetch pool.
+    """
+    prices = {}
+    missing = []
+    for asset in assets:
+        price = price_cache.get(asset.symbol)
+        if price is not None:
+            prices[asset.symbol] = price
+        else:
+            missing.append(asset)
+
+    snapshots = read_price_snapshots([a.id for a in missing], app.config['PRICE_SNAPSHOT_MAX_AGE'])
+    to_fetch = []
+    for asset in missing:
+        price = snapshots.get(asset.id)
+        if price is not None:
+            price_cache.set(asset.symbol, price, ttl=price_cache_ttl_for(asset.asset_type))
+            prices[asset.symbol] = price
         else:
-            return Decimal('100.00')
+            to_fetch.append(asset)
+
+    if to_fetch and not app.config['PRICE_FETCH_ON_SNAPSHOT_MISS']:
+        app.logger.warning(f"No fresh price snapshot for {', '.join(a.symbol for a in to_fetch)}; is `flask refresh-prices` running?")
+        to_fetch = []
+
+    def fetch(asset):
+        return price_cache.load(asset.symbol, lambda: fetch_price_from_alpha_vantage(asset), ttl=price_cache_ttl_for(asset.asset_type))
+
+    futures = {asset.symbol: price_fetch_executor.submit(fetch, asset) for asset in to_fetch}
+    for symbol, future in futures.items():
+        try:
+            prices[symbol] = future.result()
+        except Exception as e:
+            app.logger.error(f"Unexpected error fetching price for {symbol}: {str(e)}")
+            prices[symbol] = None
+    for asset in missing:
+        prices.setdefault(asset.symbol, None)
+    return prices
+
+def fetch_price_from_alpha_vantage(asset_db_object):
+    quote = fetch_quote_from_alpha_vantage(asset_db_object)
+    return quote.price if quote else None
+
+def fetch_quote_from_alpha_vantage(asset_db_object):
+    """A market_data.Quote, stale when it is the last known price served during an outage; None if unavailable."""
+    if os.environ.get('MOCK_ASSET_PRICES') == 'true':
+        app.logger.info(f"MOCK PRICE: Returning simulated price for {asset_db_object.symbol}")
+        return Quote(market_sim.quote(asset_db_object, market_sim_now()), datetime.now(timezone.utc), False)
 
-    api_key = app.config.get('ALPHA_VANTAGE_API_KEY')
-    if not api_key or api_key == 'YOUR_ALPHA_VANTAGE_API_KEY_PLEASE_SET' or api_key == 'YOUR_ALPHA_VANTAGE_API_KEY': # check against both common placeholder values
+    if not market_data.configured:
         app.logger.error("Alpha Vantage API Key not configured or is placeholder.")
         return None
+    return market_data.fetch_quote(asset_db_object)
 
-    price_str = None
-    data_from_av = None
+@app.route('/assets/prices', methods=['GET'])
+@jwt_required()
+def get_asset_prices():
+    """
+    Returns current prices for several assets in one call.
+    Query param: symbols = comma-separated list, e.g. 'AAPL,BTCUSD'
+    Output: {"prices": [{"symbol": "AAPL", "price": "123.45", "asset_type": "stock"},
+                        {"symbol": "XYZ", "error": "Asset not found."}, ...]}
+    """
+    symbols = list(dict.fromkeys(s.strip().upper() for s in request.args.get('symbols', '').split(',') if s.strip()))
+    if not symbols:
+        return jsonify(message="Query parameter 'symbols' is required."), 400
+    if len(symbols) > app.config['PRICE_BATCH_MAX_SYMBOLS']:
+        return jsonify(message=f"At most {app.config['PRICE_BATCH_MAX_SYMBOLS']} symbols per request."), 400
+
+    assets = {a.symbol: a for a in Asset.query.filter(Asset.symbol.in_(symbols)).all()}
+    prices = get_current_prices_for_assets(list(assets.values()))
+    results = []
+    for symbol in symbols:
+        asset = assets.get(symbol)
+        if not asset:
+            results.append({'symbol': symbol, 'error': "Asset not found."})
+        elif prices.get(symbol) is None:
+            results.append({'symbol': symbol, 'asset_type': asset.asset_type, 'error': "Price unavailable."})
+        else:
+            results.append({'symbol': symbol, 'asset_type': asset.asset_type, 'price': str(prices[symbol])})
+    return jsonify(prices=results), 200
+
+def poll_stream_price(asset_db_object):
+    # Runs on a broker poller thread: give each poll its own app context so DB reads see fresh snapshots
+    with app.app_context():
+        return get_current_price_for_asset(asset_db_object)
+
+# One poller per streamed symbol, fanned out to every connected client
+price_broker = PriceBroker(
+    get_price=poll_stream_price,
+    poll_interval=app.config['STREAM_POLL_INTERVAL'],
+    max_connections_per_user=app.config['STREAM_MAX_CONNECTIONS_PER_USER']
+)
+
+@app.route('/stream/prices', methods=['GET'])
+@jwt_required(locations=['headers', 'query_string']) # EventSource can't set headers: ?jwt=<token> also accepted
+def stream_prices():
+    """
+    Server-Sent Events stream of price ticks.
+    Query param: symbols = comma-separated list, e.g. 'AAPL,BTCUSD'
+    Events: 'price' with data {"symbol": ..., "price": ..., "timestamp": ...}; comment lines as heartbeat.
+    """
+    symbols = list(dict.fromkeys(s.strip().upper() for s in request.args.get('symbols', '').split(',') if s.strip()))
+    if not symbols:
+        return jsonify(message="Query parameter 'symbols' is required."), 400
+    if len(symbols) > app.config['PRICE_BATCH_MAX_SYMBOLS']:
+        return jsonify(message=f"At most {app.config['PRICE_BATCH_MAX_SYMBOLS']} symbols per request."), 400
+    assets = Asset.query.filter(Asset.symbol.in_(symbols)).all()
+    unknown = sorted(set(symbols) - {a.symbol for a in assets})
+    if unknown:
+        return jsonify(message=f"Assets not found: {', '.join(unknown)}"), 404
+
+    user_id = current_user().id
     try:
-        if asset_db_object.asset_type.lower() == 'stock':
-            ts = TimeSeries(key=api_key, output_format='json')
-            data_from_av, _ = ts.get_quote_endpoint(symbol=asset_db_object.symbol)
-            price_str = data_from_av.get('05. price') if data_from_av else None
-        elif asset_db_object.asset_type.lower() == 'crypto':
-            if len(asset_db_object.symbol) > 3 and asset_db_object.symbol.endswith('USD'):
-                from_currency = asset_db_object.symbol[:-3]
-                to_currency = 'USD'
-                fe = ForeignExchange(key=api_key, output_format='json')
-                data_from_av, _ = fe.get_currency_exchange_rate(from_currency_code=from_currency, to_currency_code=to_currency)
-                price_str = data_from_av.get('Realtime Currency Exchange Rate', {}).get('5. Exchange Rate') if data_from_av else None
-            else:
-                app.logger.warning(f"Unsupported crypto symbol format for price fetching: {asset_db_object.symbol}")
-                return None
-
-        if price_str:
-            return Decimal(price_str)
-        
-        app.logger.warning(f"Price not found for {asset_db_object.symbol} via Alpha Vantage. AV Data: {data_from_av}")
-        return None
-    
-    except requests.exceptions.RequestException as e:
-        app.logger.error(f"Network error fetching price for {asset_db_object.symbol}: {str(e)}")
-        return None
-    except ValueError as e: 
-        app.logger.error(f"Alpha Vantage API or data error for {asset_db_object.symbol}: {str(e)}. AV Data: {data_from_av}")
-        return None
-    except Exception as e: 
-        app.logger.error(f"Unexpected error fetching price for {asset_db_object.symbol}: {str(e)}")
-        return None
+        subscription = price_broker.subscribe(user_id, assets)
+    except TooManyConnections as e:
+        return jsonify(message=str(e)), 429
+
+    heartbeat = app.config['STREAM_HEARTBEAT_INTERVAL']
+    def events():
+        yield 'retry: 5000\n\n'
+        while True:
+            ticks = subscription.next_ticks(timeout=heartbeat)
+            if not ticks:
+                yield ': heartbeat\n\n'
+            for tick in ticks:
+                yield f"event: price\ndata: {json.dumps(tick)}\n\n"
+
+    response = Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # The server closes the response when the client disconnects
+    response.call_on_close(lambda: price_broker.unsubscribe(subscription))
+    return response
 
 @app.route('/assets/<string:symbol>/price', methods=['GET'])
 @jwt_required()
@@ -284,12 +739,55 @@ def get_asset_price(symbol):
     else:
         return jsonify(message=f"Could not get price for {symbol}."), 503
 
+# Local OHLC store: repeat history views are served from price_history instead of the upstream API
+history_store = HistoryStore(fetch_bars=market_data.get_bars, recheck_seconds=app.config['HISTORY_RECHECK_SECONDS'])
+# Finished (and downsampled) history responses, keyed by (symbol, range, points)
+history_cache = TTLCache(max_entries=app.config['HISTORY_CACHE_MAX_ENTRIES'], default_ttl=app.config['HISTORY_CACHE_TTL'])
+# Indicator results, keyed by (symbol, range, indicator set, last bar)
+indicator_cache = TTLCache(max_entries=app.config['HISTORY_CACHE_MAX_ENTRIES'], default_ttl=app.config['INDICATOR_CACHE_TTL'])
+
+class HistoryUnavailable(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+def load_asset_history(asset_from_db, range_param):
+    """Returns [{"date": ..., "price": ...}] for a validated range, oldest first. Raises HistoryUnavailable."""
+    interval, points = HISTORY_RANGES[range_param]
+
+    # MOCK mode: a view of the same simulated path that quotes come from
+    if os.environ.get('MOCK_ASSET_PRICES') == 'true':
+        return market_sim.history(asset_from_db, range_param, points, market_sim_now())
+
+    # Alpha Vantage mode, through the local price_history store
+    if asset_from_db.asset_type.lower() not in ('stock', 'crypto'):
+        raise HistoryUnavailable("Unsupported asset type for history.", 400)
+    if asset_from_db.asset_type.lower() == 'crypto':
+        interval = 'daily' # Only support daily for crypto for simplicity
+    if not market_data.configured:
+        raise HistoryUnavailable("Alpha Vantage API Key not configured.", 503)
+    try:
+        history_store.ensure_fresh(asset_from_db, interval, points)
+    except Exception as e:
+        # Serve whatever is already stored; only fail if we have nothing
+        app.logger.error(f"Error fetching history for {asset_from_db.symbol}: {str(e)}")
+        if history_store.latest_timestamp(asset_from_db.id, interval) is None:
+            raise HistoryUnavailable(f"Error fetching history for {asset_from_db.symbol}: {str(e)}", 500)
+
+    date_format = '%Y-%m-%d %H:%M:%S' if interval == '30min' else '%Y-%m-%d'
+    return [
+        {"date": bar.timestamp.strftime(date_format), "price": float(bar.close)}
+        for bar in history_store.read_bars(asset_from_db.id, interval, points)
+    ]
+
 @app.route('/assets/<string:symbol>/history', methods=['GET'])
 @jwt_required()
 def get_asset_history(symbol):
     """
     Returns historical price data for the given asset symbol and range.
-    Query param: range = '1d', '1m', '6m', 'ytd', '1y', '3y'
+    Query params: range = '1d', '1m', '6m', 'ytd', '1y', '3y'
+                  points (optional) = max number of points, downsampled with LTTB
     Output: [{"date": "2024-06-01", "price": 123.45}, ...]
     """
     asset_from_db = Asset.query.filter_by(symbol=symbol.upper()).first()
@@ -297,95 +795,64 @@ def get_asset_history(symbol):
         return jsonify(message=f"Asset {symbol} not found."), 404
 
     range_param = request.args.get('range', '1d')
-    # Map range to Alpha Vantage function and outputsize
-    av_function = None
-    av_interval = None
-    av_outputsize = 'compact'
-    mock_points = 30
-    if range_param == '1d':
-        av_function = 'TIME_SERIES_INTRADAY'
-        av_interval = '30min'
-        mock_points = 24
-    elif range_param == '1m':
-        av_function = 'TIME_SERIES_DAILY'
-        av_outputsize = 'compact'
-        mock_points = 22
-    elif range_param == '6m':
-        av_function = 'TIME_SERIES_DAILY'
-        av_outputsize = 'full'
-        mock_points = 132
-    elif range_param == 'ytd' or range_param == '1y':
-        av_function = 'TIME_SERIES_DAILY'
-        av_outputsize = 'full'
-        mock_points = 252
-    elif range_param == '3y':
-        av_function = 'TIME_SERIES_WEEKLY'
-        mock_points = 156
-    else:
+    if range_param not in HISTORY_RANGES:
         return jsonify(message="Invalid range parameter."), 400
+    points = request.args.get('points', type=int)
+    if points is not None and points < 3:
+        return jsonify(message="points must be an integer of at least 3."), 400
 
-    # MOCK mode: return generated data
-    if os.environ.get('MOCK_ASSET_PRICES') == 'true':
-        import random
-        from datetime import datetime, timedelta
-        now = datetime.utcnow()
-        history = []
-        base_price = float(get_current_price_for_asset(asset_from_db) or 100)
-        for i in range(mock_points):
-            if range_param == '1d':
-                dt = now - timedelta(hours=mock_points - i)
-                label = dt.strftime('%H:%M')
-            elif range_param in ['1m', '6m', 'ytd', '1y']:
-                dt = now - timedelta(days=mock_points - i)
-                label = dt.strftime('%Y-%m-%d')
-            else:
-                dt = now - timedelta(weeks=mock_points - i)
-                label = dt.strftime('%Y-%m-%d')
-            price = round(base_price * (1 + random.uniform(-0.05, 0.05)), 2)
-            history.append({"date": label, "price": price})
-        return jsonify(history=history), 200
-
-    # Alpha Vantage mode
-    api_key = app.config.get('ALPHA_VANTAGE_API_KEY')
-    if not api_key or api_key.startswith('YOUR_ALPHA_VANTAGE_API_KEY'):
-        return jsonify(message="Alpha Vantage API Key not configured."), 503
     try:
-        if asset_from_db.asset_type.lower() == 'stock':
-            ts = TimeSeries(key=api_key, output_format='json')
-            if av_function == 'TIME_SERIES_INTRADAY':
-                data, _ = ts.get_intraday(symbol=asset_from_db.symbol, interval=av_interval, outputsize='compact')
-                series = data.get(f'Time Series ({av_interval})', {})
-            elif av_function == 'TIME_SERIES_DAILY':
-                data, _ = ts.get_daily(symbol=asset_from_db.symbol, outputsize=av_outputsize)
-                series = data.get('Time Series (Daily)', {})
-            elif av_function == 'TIME_SERIES_WEEKLY':
-                data, _ = ts.get_weekly(symbol=asset_from_db.symbol)
-                series = data.get('Weekly Time Series', {})
-            else:
-                return jsonify(message="Unsupported function for stocks."), 400
-            # Format: [{date, price}]
-            history = []
-            for date_str, values in list(series.items())[:mock_points][::-1]:
-                price = float(values.get('4. close', 0))
-                history.append({"date": date_str, "price": price})
-            return jsonify(history=history), 200
-        elif asset_from_db.asset_type.lower() == 'crypto':
-            # Only support daily for crypto for simplicity
-            fe = ForeignExchange(key=api_key, output_format='json')
-            from_currency = asset_db_object.symbol[:-3] if asset_db_object.symbol.endswith('USD') else asset_db_object.symbol
-            to_currency = 'USD'
-            data, _ = fe.get_digital_currency_daily(symbol=from_currency, market=to_currency)
-            series = data.get('Time Series (Digital Currency Daily)', {})
-            history = []
-            for date_str, values in list(series.items())[:mock_points][::-1]:
-                price = float(values.get('4a. close (USD)', 0))
-                history.append({"date": date_str, "price": price})
-            return jsonify(history=history), 200
-        else:
-            return jsonify(message="Unsupported asset type for history."), 400
-    except Exception as e:
-        app.logger.error(f"Error fetching history for {symbol}: {str(e)}")
-        return jsonify(message=f"Error fetching history for {symbol}: {str(e)}"), 500
+        history = history_cache.get_or_load(
+            (asset_from_db.symbol, range_param, points),
+            lambda: downsample_history(load_asset_history(asset_from_db, range_param), points)
+        )
+    except HistoryUnavailable as e:
+        return jsonify(message=e.message), e.status_code
+    return jsonify(history=history), 200
+
+@app.route('/assets/<string:symbol>/indicators', methods=['GET'])
+@jwt_required()
+def get_asset_indicators(symbol):
+    """
+    Returns technical indicators computed over the asset's price history, aligned with its dates.
+    Query params: range = '1d', '1m', '6m', 'ytd', '1y' (default), '3y'
+                  ind = comma-separated list, e.g. 'sma:20,ema:50,rsi:14,bb:20:2,vol:20'
+    Output: {"dates": [...], "close": [...],
+             "indicators": {"sma:20": [null, ..., 123.45], "bb:20:2": {"upper": [...], "middle": [...], "lower": [...]}}}
+    Values are null until the indicator has enough data.
+    """
+    asset_from_db = Asset.query.filter_by(symbol=symbol.upper()).first()
+    if not asset_from_db:
+        return jsonify(message=f"Asset {symbol} not found."), 404
+    range_param = request.args.get('range', '1y')
+    if range_param not in HISTORY_RANGES:
+        return jsonify(message="Invalid range parameter."), 400
+    try:
+        specs = parse_indicator_spec(request.args.get('ind', ''))
+    except ValueError as e:
+        return jsonify(message=str(e)), 400
+
+    try:
+        history = history_cache.get_or_load(
+            (asset_from_db.symbol, range_param, None),
+            lambda: load_asset_history(asset_from_db, range_param)
+        )
+    except HistoryUnavailable as e:
+        return jsonify(message=e.message), e.status_code
+
+    def compute():
+        closes = [h['price'] for h in history]
+        interval = 'daily' if asset_from_db.asset_type.lower() == 'crypto' else HISTORY_RANGES[range_param][0]
+        return {
+            'dates': [h['date'] for h in history],
+            'close': closes,
+            'indicators': to_json_lists(compute_indicators(closes, specs, interval))
+        }
+
+    # The last bar is part of the key, so results are reused until a new bar arrives
+    last_bar = (history[-1]['date'], history[-1]['price']) if history else None
+    payload = indicator_cache.get_or_load((asset_from_db.symbol, range_param, tuple(s[0] for s in specs), len(history), last_bar), compute)
+    return jsonify(payload), 200
 
 @app.route('/trades/order', methods=['POST'])
 @jwt_required()
@@ -401,9 +868,7 @@ def place_trade_order():
     if not asset_symbol or not order_type: return jsonify(message="All fields required"), 400
     if order_type not in ['market_buy', 'market_sell']: return jsonify(message="Invalid order_type"), 400
 
-    raw_identity = get_jwt_identity()
-    current_user_identity_dict = json.loads(raw_identity)
-    user_id = current_user_identity_dict['id']
+    user_id = current_user().id
     
     asset = Asset.query.filter_by(symbol=asset_symbol.upper()).first()
     if not asset: return jsonify(message=f"Asset '{asset_symbol}' not found."), 404
@@ -411,113 +876,219 @@ def place_trade_order():
     current_price = get_current_price_for_asset(asset)
     if current_price is None: return jsonify(message=f"Could not get price for {asset_symbol}"), 503
 
-    # Fetch the user object to access cash_balance
-    user = User.query.get(user_id)
-    if not user:
-        # This case should ideally not be reached if JWT identity is valid
-        return jsonify(message="User not found for ID in token"), 404 
-
-    holding = PortfolioHolding.query.filter_by(user_id=user_id, asset_id=asset.id).first()
-
-    if order_type == 'market_sell':
-        if not holding or holding.quantity < quantity:
-            return jsonify(message="Insufficient holdings to sell"), 400
-        
-        total_proceeds = quantity * current_price
-        user.cash_balance += total_proceeds  # Add cash to user
-        
-        holding.quantity -= quantity
-        if holding.quantity == Decimal(0):
-            db.session.delete(holding)
-
-    elif order_type == 'market_buy':
-        total_cost = quantity * current_price
-        if user.cash_balance < total_cost:
-            return jsonify(message="Insufficient funds to complete this purchase."), 400
-        
-        user.cash_balance -= total_cost # Deduct cash from user
-
-        if holding:
-            avg_price = Decimal(holding.average_purchase_price)
-            current_qty = Decimal(holding.quantity)
-            new_total_value_of_holding = (avg_price * current_qty) + total_cost # Cost of old + cost of new
-            holding.quantity = current_qty + quantity
-            holding.average_purchase_price = new_total_value_of_holding / holding.quantity
-        else:
-            holding = PortfolioHolding(
-                user_id=user_id, 
-                asset_id=asset.id, 
-                quantity=quantity, 
-                average_purchase_price=current_price
-            )
-            db.session.add(holding)
-
-    new_trade = Trade(
-        user_id=user_id, 
-        asset_id=asset.id, 
-        order_type=order_type, 
-        quantity=quantity, 
-        price_at_execution=current_price
-    )
-    db.session.add(new_trade)
-    # User object (for cash_balance) is already part of the session if fetched, 
-    # SQLAlchemy tracks changes to it.
-
+    # Lock the user's row, then apply guarded UPDATEs: concurrent orders from the
+    # same user are serialized and can never both pass the funds/holdings check.
     try:
+        lock_user_row(user_id)
+        result = execute_market_order(user_id, asset, order_type, quantity, current_price)
         db.session.commit()
+        leaderboard.mark_dirty(user_id)
+    except OrderRejected as e:
+        db.session.rollback()
+        return jsonify(message=e.message), e.status_code
     except Exception as e:
         db.session.rollback()
         app.logger.error(f"Error in trade order execution or commit: {str(e)}")
         return jsonify(message="Error processing order on the server."), 500
-    
-    holding_updated_dict = None
-    if order_type == 'market_buy': 
-        # if it was a buy, holding is guaranteed to exist (either pre-existing or newly created)
-        # Re-fetch to ensure data is fresh from DB after commit, especially if new.
-        holding_updated_dict = PortfolioHolding.query.get({'user_id': user_id, 'asset_id': asset.id}).to_dict()
-    elif order_type == 'market_sell':
-        updated_holding_after_sell = PortfolioHolding.query.get({'user_id': user_id, 'asset_id': asset.id})
-        if updated_holding_after_sell: # If it still exists (quantity > 0)
-            holding_updated_dict = updated_holding_after_sell.to_dict()
-        # If it doesn't exist (quantity became 0 and was deleted), holding_updated_dict remains None
 
     return jsonify(
         message="Order placed", 
-        trade=new_trade.to_dict(), 
-        holding_updated=holding_updated_dict
+        trade=result['trade'], 
+        holding_updated=result['holding']
     ), 201
 
+@app.route('/trades/orders', methods=['POST'])
+@jwt_required()
+def place_trade_orders():
+    """
+    Places several market orders in one transaction.
+    Body: {"orders": [{"asset_symbol": "AAPL", "order_type": "market_buy", "quantity": "2"}, ...],
+           "mode": "all_or_nothing" (default) | "best_effort"}
+    Sells are applied before buys (so their proceeds can fund the buys), each group in request order.
+    all_or_nothing: any failing order rejects the whole batch (400, nothing is executed).
+    best_effort: failing orders are skipped, the rest are committed together.
+    Output: {"results": [{"index": 0, "status": "filled", "trade": {...}, "holding_updated": {...}},
+                         {"index": 1, "status": "rejected", "error": "..."}, ...], "cash_balance": "..."}
+    """
+    data = request.get_json()
+    if not data: return jsonify(message="Request body must be JSON"), 400
+    orders = data.get('orders')
+    mode = data.get('mode', 'all_or_nothing')
+    if mode not in ['all_or_nothing', 'best_effort']: return jsonify(message="Invalid mode"), 400
+    if not isinstance(orders, list) or not orders: return jsonify(message="orders must be a non-empty list"), 400
+    if len(orders) > app.config['TRADE_BATCH_MAX_ORDERS']:
+        return jsonify(message=f"At most {app.config['TRADE_BATCH_MAX_ORDERS']} orders per batch."), 400
+
+    user_id = current_user().id
+    results = [{'index': i} for i in range(len(orders))]
+    legs = []
+    for i, order in enumerate(orders):
+        order = order if isinstance(order, dict) else {}
+        try:
+            quantity = Decimal(order.get('quantity'))
+            if quantity <= Decimal(0): raise ValueError("Quantity must be positive.")
+        except (ValueError, TypeError, ArithmeticError) as e:
+            results[i].update(status='rejected', error=f"Invalid quantity: {str(e)}")
+            continue
+        if not order.get('asset_symbol') or order.get('order_type') not in ['market_buy', 'market_sell']:
+            results[i].update(status='rejected', error="asset_symbol and a valid order_type are required")
+            continue
+        legs.append((i, order['asset_symbol'].upper(), order['order_type'], quantity))
+
+    assets = {a.symbol: a for a in Asset.query.filter(Asset.symbol.in_({leg[1] for leg in legs})).all()} if legs else {}
+    prices = get_current_prices_for_assets(list(assets.values()))
+    executable = []
+    for i, symbol, order_type, quantity in legs:
+        if symbol not in assets:
+            results[i].update(status='rejected', error=f"Asset '{symbol}' not found.")
+        elif prices.get(symbol) is None:
+            results[i].update(status='rejected', error=f"Could not get price for {symbol}")
+        else:
+            executable.append((i, assets[symbol], order_type, quantity, prices[symbol]))
+
+    if mode == 'all_or_nothing' and len(executable) < len(orders):
+        for result in results:
+            result.setdefault('status', 'not_executed')
+        return jsonify(message="Batch rejected; no orders were executed.", results=results), 400
+
+    executable.sort(key=lambda leg: (leg[2] != 'market_sell', leg[0]))
+    cash_balance = None
+    try:
+        lock_user_row(user_id)
+        for i, asset, order_type, quantity, price in executable:
+            try:
+                if mode == 'best_effort':
+                    # A savepoint per order so a rejected one leaves the others intact
+                    with db.session.begin_nested():
+                        result = execute_market_order(user_id, asset, order_type, quantity, price)
+                else:
+                    result = execute_market_order(user_id, asset, order_type, quantity, price)
+            except OrderRejected as e:
+                results[i].update(status='rejected', error=e.message)
+                if mode == 'all_or_nothing':
+                    db.session.rollback()
+                    for index, other in enumerate(results):
+                        if other.get('status') != 'rejected':
+                            other.clear()
+                            other.update(index=index, status='not_executed')
+                    return jsonify(message="Batch rejected; no orders were executed.", results=results), 400
+                continue
+            cash_balance = result['cash_balance']
+            results[i].update(status='filled', trade=result['trade'], holding_updated=result['holding'])
+        db.session.commit()
+        leaderboard.mark_dirty(user_id)
+    except OrderRejected as e:
+        db.session.rollback()
+        return jsonify(message=e.message), e.status_code
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Error in batch order execution or commit: {str(e)}")
+        return jsonify(message="Error processing orders on the server."), 500
+
+    filled = sum(1 for r in results if r.get('status') == 'filled')
+    return jsonify(
+        message=f"{filled} of {len(orders)} orders placed",
+        results=results,
+        cash_balance=str(cash_balance) if cash_balance is not None else None
+    ), 201 if filled else 400
+
+@app.route('/trades/open-orders', methods=['POST'])
+@jwt_required()
+def place_open_order():
+    """
+    Places a resting limit or stop order. It is filled by the order matcher
+    (runs inside `flask refresh-prices`) on the first price tick that crosses
+    trigger_price; funds/holdings are checked at fill time.
+    Body: {"asset_symbol": "AAPL", "order_type": "limit_buy", "quantity": "2", "trigger_price": "180.50"}
+    order_type: limit_buy (fills at or below), limit_sell (at or above), stop_buy (at or above), stop_sell (at or below)
+    """
+    data = request.get_json()
+    if not data: return jsonify(message="Request body must be JSON"), 400
+    asset_symbol = data.get('asset_symbol'); order_type = data.get('order_type')
+    try:
+        quantity = Decimal(data.get('quantity')); trigger_price = Decimal(data.get('trigger_price'))
+        if quantity <= Decimal(0) or trigger_price <= Decimal(0): raise ValueError("Quantity and trigger_price must be positive.")
+    except (ValueError, TypeError, ArithmeticError) as e: return jsonify(message=f"Invalid quantity or trigger_price: {str(e)}"), 400
+
+    if not asset_symbol or not order_type: return jsonify(message="All fields required"), 400
+    if order_type not in RESTING_ORDER_TYPES: return jsonify(message="Invalid order_type"), 400
+
+    user_id = current_user().id
+    asset = Asset.query.filter_by(symbol=asset_symbol.upper()).first()
+    if not asset: return jsonify(message=f"Asset '{asset_symbol}' not found."), 404
+
+    order = OpenOrder(user_id=user_id, asset_id=asset.id, order_type=order_type, quantity=quantity, trigger_price=trigger_price)
+    try:
+        db.session.add(order)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Error placing open order: {str(e)}")
+        return jsonify(message="Error placing order on the server."), 500
+    return jsonify(message="Order placed", order=order.to_dict()), 201
+
+@app.route('/trades/open-orders', methods=['GET'])
+@jwt_required()
+def get_open_orders():
+    """
+    Lists the user's limit/stop orders, newest first.
+    Query param: status ('open' by default, 'filled', 'cancelled', 'rejected' or 'all')
+    Output: {"orders": [{"id": ..., "order_type": "limit_buy", "status": "open", ...}, ...]}
+    """
+    user_id = current_user().id
+    status = request.args.get('status', 'open')
+    query = OPEN_ORDER_FIELDS.select().where(OpenOrder.user_id == user_id)
+    if status != 'all':
+        query = query.where(OpenOrder.status == status)
+    rows = db.session.execute(query.order_by(OpenOrder.id.desc())).all()
+    return json_response(orders=OPEN_ORDER_FIELDS.encode_list(rows))
+
+@app.route('/trades/open-orders/<int:order_id>', methods=['DELETE'])
+@jwt_required()
+def cancel_open_order(order_id):
+    user_id = current_user().id
+    orders = OpenOrder.__table__
+    # Guarded on status, so an order the matcher is filling can't also be cancelled
+    cancelled = db.session.execute(
+        db.update(orders)
+        .where(orders.c.id == order_id, orders.c.user_id == user_id, orders.c.status == 'open')
+        .values(status='cancelled', closed_at=datetime.now(timezone.utc))
+    ).rowcount
+    db.session.commit()
+    if not cancelled:
+        order = OpenOrder.query.filter_by(id=order_id, user_id=user_id).first()
+        if not order: return jsonify(message="Order not found"), 404
+        return jsonify(message=f"Order is already {order.status}"), 409
+    return jsonify(message="Order cancelled"), 200
+
 @app.route('/portfolio', methods=['GET'])
 @jwt_required()
 def get_portfolio():
-    raw_identity = get_jwt_identity()
-    current_user_identity_dict = json.loads(raw_identity)
-    user_id = current_user_identity_dict['id']
+    user_id = current_user().id
 
-    # Fetch the user object to access cash_balance
-    user = User.query.get(user_id)
-    if not user:
+    cash_balance = db.session.execute(db.select(User.cash_balance).where(User.id == user_id)).scalar()
+    if cash_balance is None:
         # This case should ideally not be reached if JWT identity is valid
         return jsonify(message="User not found for ID in token"), 404
 
-    holdings = PortfolioHolding.query.filter_by(user_id=user_id).all()
+    # One joined query for every position, then one batched price lookup (cache,
+    # stored snapshots, concurrent upstream fetches): a constant number of
+    # statements however many assets the user holds.
+    holdings = db.session.execute(
+        db.select(PortfolioHolding.quantity, PortfolioHolding.average_purchase_price, Asset)
+        .join(Asset, Asset.id == PortfolioHolding.asset_id)
+        .where(PortfolioHolding.user_id == user_id, PortfolioHolding.quantity > 0)
+        .order_by(PortfolioHolding.asset_id)
+    ).all()
+    prices = get_current_prices_for_assets([holding.Asset for holding in holdings])
     portfolio_data = []
     total_portfolio_value = Decimal(0)
     total_portfolio_cost = Decimal(0)
 
-    for holding_item in holdings: 
-        current_holding_qty = Decimal(holding_item.quantity)
-        if current_holding_qty <= Decimal(0): continue # Skip if quantity is zero or less
-        
-        asset_item = Asset.query.get(holding_item.asset_id) 
-        if not asset_item: 
-            app.logger.warning(f"Asset with ID {holding_item.asset_id} not found for holding of user {user_id}.")
-            continue 
-
-        current_price = get_current_price_for_asset(asset_item)
+    for current_holding_qty, avg_purchase_price, asset_item in holdings:
+        current_price = prices.get(asset_item.symbol)
         current_value_str, profit_loss_str, profit_loss_percent_str = "N/A", "N/A", "N/A"
-        
-        avg_purchase_price = Decimal(holding_item.average_purchase_price)
+
         holding_cost = avg_purchase_price * current_holding_qty
         total_portfolio_cost += holding_cost
 
@@ -528,15 +1099,15 @@ def get_portfolio():
             current_value_str = f"{current_value:.2f}"; profit_loss_str = f"{profit_loss:.2f}"
             if holding_cost != Decimal(0): profit_loss_percent_str = f"{(profit_loss / holding_cost) * Decimal(100):.2f}%"
             else: profit_loss_percent_str = "N/A" if profit_loss == Decimal(0) else ("+Inf%" if profit_loss > Decimal(0) else "-Inf%")
-        
+
         portfolio_data.append({
-            'asset_id': holding_item.asset_id, 'symbol': asset_item.symbol, 'name': asset_item.name,
+            'asset_id': asset_item.id, 'symbol': asset_item.symbol, 'name': asset_item.name,
             'quantity': str(current_holding_qty), 'average_purchase_price': f"{avg_purchase_price:.2f}",
             'current_price': f"{current_price:.2f}" if current_price is not None else "N/A",
             'current_value': current_value_str, 'holding_cost': f"{holding_cost:.2f}",
             'profit_loss': profit_loss_str, 'profit_loss_percent': profit_loss_percent_str
         })
-        
+
     overall_profit_loss = total_portfolio_value - total_portfolio_cost
     overall_profit_loss_percent_str = "N/A"
     if total_portfolio_cost != Decimal(0): 
@@ -553,17 +1124,128 @@ def get_portfolio():
         'total_portfolio_cost': f"{total_portfolio_cost:.2f}", 
         'overall_profit_loss': f"{overall_profit_loss:.2f}", 
         'overall_profit_loss_percent': overall_profit_loss_percent_str,
-        'user_cash_balance': f"{user.cash_balance:.2f}" # Added cash balance
+        'user_cash_balance': f"{cash_balance:.2f}" # Added cash balance
     }
 
     return jsonify(holdings=portfolio_data, summary=summary_data), 200
 
+@app.route('/portfolio/history', methods=['GET'])
+@jwt_required()
+def get_portfolio_history():
+    """
+    Account value over time, from the snapshots written by `flask snapshot-portfolios`.
+    Query params: range = '1w', '1m' (default), '3m', '6m', '1y', 'all'
+                  points (optional) = max number of points, downsampled with LTTB on total_value
+    Output: {"history": [{"date": "...", "cash": "...", "holdings_value": "...", "total_value": "..."}, ...]}
+    """
+    user_id = current_user().id
+    range_param = request.args.get('range', '1m')
+    if range_param not in PORTFOLIO_HISTORY_RANGES:
+        return jsonify(message="Invalid range parameter."), 400
+    points = request.args.get('points', type=int)
+    if points is not None and points < 3:
+        return jsonify(message="points must be an integer of at least 3."), 400
+
+    rows = db.session.execute(portfolio_history_query(user_id, range_param, query=SNAPSHOT_FIELDS.select())).all()
+    return json_response(history=SNAPSHOT_FIELDS.encode_list(downsample_history(rows, points, key=lambda row: row.total_value)))
+
+@app.route('/portfolio/performance', methods=['GET'])
+@jwt_required()
+def get_portfolio_performance():
+    """
+    Realized/unrealized P&L from FIFO lots rebuilt from the user's trades, plus
+    risk metrics (max drawdown, annualized volatility, Sharpe) over the daily
+    equity curve from portfolio snapshots.
+    Query param: lots (optional, 'true' to include each asset's open FIFO lots)
+    Output: {"realized_pnl": "...", "unrealized_pnl": "...", "total_pnl": "...", "trade_count": ...,
+             "assets": [{"symbol": ..., "realized_pnl": ..., "open_quantity": ..., "open_cost_basis": ..., ...}],
+             "risk": {"periods": ..., "total_return": ..., "max_drawdown": ..., "volatility": ..., "sharpe_ratio": ...}}
+    """
+    user_id = current_user().id
+    include_lots = request.args.get('lots', 'false').lower() == 'true'
+    version = performance_version(user_id)
+    performance = performance_cache.get_or_load((user_id, *version), lambda: compute_performance(user_id))
+
+    positions = performance['positions']
+    assets = {a.id: a for a in Asset.query.filter(Asset.id.in_(list(positions))).all()} if positions else {}
+    prices = get_current_prices_for_assets([assets[asset_id] for asset_id, p in positions.items()
+                                            if p['open_quantity'] > 0 and asset_id in assets])
+    realized_total = Decimal(0)
+    unrealized_total = Decimal(0)
+    asset_rows = []
+    for asset_id, position in positions.items():
+        asset = assets.get(asset_id)
+        realized = Decimal(f"{position['realized_pnl']:.2f}")
+        realized_total += realized
+        price = prices.get(asset.symbol) if asset else None
+        unrealized = None
+        if position['open_quantity'] > 0 and price is not None:
+            unrealized = Decimal(f"{float(price) * position['open_quantity'] - position['open_cost']:.2f}")
+            unrealized_total += unrealized
+        row = {
+            'asset_id': asset_id,
+            'symbol': asset.symbol if asset else None,
+            'realized_pnl': str(realized),
+            'open_quantity': f"{position['open_quantity']:.8f}",
+            'open_cost_basis': f"{position['open_cost']:.2f}",
+            'average_open_cost': f"{position['open_cost'] / position['open_quantity']:.2f}" if position['open_quantity'] > 0 else None,
+            'current_price': f"{price:.2f}" if price is not None else None,
+            'unrealized_pnl': str(unrealized) if unrealized is not None else None
+        }
+        if include_lots:
+            row['lots'] = [{'quantity': f"{qty:.8f}", 'price': f"{lot_price:.2f}", 'timestamp': ts.isoformat() if ts else None}
+                           for qty, lot_price, ts in position['lots']]
+        asset_rows.append(row)
+
+    risk = {key: (round(value, 6) if isinstance(value, float) else value) for key, value in performance['risk'].items()}
+    return jsonify(
+        realized_pnl=f"{realized_total:.2f}",
+        unrealized_pnl=f"{unrealized_total:.2f}",
+        total_pnl=f"{realized_total + unrealized_total:.2f}",
+        trade_count=performance['trade_count'],
+        assets=sorted(asset_rows, key=lambda row: row['symbol'] or ''),
+        risk=risk
+    ), 200
+
+def refresh_leaderboard():
+    # Runs on the leaderboard's background thread: its own app context, so its own session
+    with app.app_context():
+        leaderboard.refresh()
+
+@app.route('/leaderboard', methods=['GET'])
+@jwt_required()
+def get_leaderboard():
+    """
+    Users ranked by account value (cash + holdings at the latest stored prices).
+    Query params: page (default 1), per_page (default 20), cohort (optional; ranks within that cohort only)
+    Output: {"entries": [{"rank": 1, "user_id": ..., "username": ..., "total_value": "..."}, ...],
+             "page": 1, "per_page": 20, "total": ..., "me": {"rank": ..., "total_value": "..."} or null}
+    """
+    user_id = current_user().id
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 20, type=int)
+    cohort = request.args.get('cohort') or None
+    if page < 1 or not 1 <= per_page <= app.config['LEADERBOARD_MAX_PAGE_SIZE']:
+        return jsonify(message=f"page must be >= 1 and per_page between 1 and {app.config['LEADERBOARD_MAX_PAGE_SIZE']}."), 400
+
+    leaderboard.start(refresh_leaderboard)
+    if not leaderboard.loaded:
+        response = jsonify(message="The leaderboard is being built, please retry shortly.")
+        response.headers['Retry-After'] = str(max(1, int(app.config['LEADERBOARD_SYNC_INTERVAL'])))
+        return response, 503
+    leaderboard.reload_dirty()
+    entries, total = leaderboard.page(page, per_page, cohort)
+    me = leaderboard.rank_of(user_id, cohort)
+    return jsonify(
+        entries=[{**entry, 'total_value': f"{entry['total_value']:.2f}"} for entry in entries],
+        page=page, per_page=per_page, total=total,
+        me={'rank': me[0], 'total_value': f"{me[1]:.2f}"} if me else None
+    ), 200
+
 @app.route('/education/progress', methods=['GET', 'POST'])
 @jwt_required()
 def education_progress():
-    raw_identity = get_jwt_identity()
-    user_id = json.loads(raw_identity)['id']
-    user = User.query.get(user_id)
+    user = current_user().row
     if not user:
         return jsonify(message='User not found'), 404
 
@@ -577,26 +1259,170 @@ def education_progress():
         db.session.commit()
         return jsonify(message='Progress updated'), 200
 
+TRADE_EXPORT_BATCH = 1000
+TRADE_EXPORT_FIELDS = ['id', 'user_id', 'asset_id', 'asset_symbol', 'order_type', 'quantity', 'price_at_execution', 'timestamp']
+
+def trade_timestamp_key():
+    """
+    Sort/compare key for keyset pagination on (timestamp, id). SQLite stores
+    server-default timestamps without fractional seconds but binds datetimes
+    with them, so plain comparisons there miss ties; compare julianday() values.
+    """
+    if db.engine.dialect.name == 'sqlite':
+        return db.func.julianday(Trade.timestamp), db.func.julianday
+    return Trade.timestamp, lambda value: value
+
+def trade_rows_query(user_id, asset_id=None):
+    """Trades with their asset symbol in one joined query (the TRADE_FIELDS plan)."""
+    query = TRADE_FIELDS.select().where(Trade.user_id == user_id)
+    if asset_id is not None:
+        query = query.where(Trade.asset_id == asset_id)
+    return query
+
+def encode_trade_cursor(row):
+    return base64.urlsafe_b64encode(json.dumps([row.timestamp.isoformat(), row.id]).encode()).decode()
+
+def decode_trade_cursor(cursor):
+    timestamp, trade_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return datetime.fromisoformat(timestamp), int(trade_id)
+
+def _trade_asset_filter():
+    """asset_id for the optional ?asset= filter; raises LookupError for an unknown symbol."""
+    asset_symbol = request.args.get('asset')
+    if not asset_symbol:
+        return None
+    asset_id = db.session.execute(db.select(Asset.id).where(Asset.symbol == asset_symbol.upper())).scalar()
+    if asset_id is None:
+        raise LookupError(asset_symbol)
+    return asset_id
+
 @app.route('/trades', methods=['GET'])
 @jwt_required()
 def get_trades():
     """
-    Returns all trades for the current user, optionally filtered by asset symbol.
-    Query param: asset (optional, symbol)
+    Returns trades for the current user, optionally filtered by asset symbol.
+    Query params: asset (optional, symbol)
+                  limit (optional) = page size; enables keyset pagination on (timestamp, id)
+                  cursor (optional) = next_cursor from the previous page
+                  order (optional) = 'asc' (default) or 'desc'
+    Without limit/cursor every trade is returned, as before.
+    Output: {"trades": [...], "next_cursor": "..." or null (only when paginating)}
+    """
+    user_id = current_user().id
+    try:
+        asset_id = _trade_asset_filter()
+    except LookupError as e:
+        return jsonify(message=f"Asset {e.args[0]} not found."), 404
+
+    order = request.args.get('order', 'asc')
+    if order not in ['asc', 'desc']:
+        return jsonify(message="order must be 'asc' or 'desc'."), 400
+    limit = request.args.get('limit', type=int)
+    cursor = request.args.get('cursor')
+    if limit is None and cursor is None:
+        rows = db.session.execute(
+            trade_rows_query(user_id, asset_id)
+            .order_by(Trade.timestamp.asc(), Trade.id.asc())
+            .execution_options(yield_per=TRADE_EXPORT_BATCH)
+        )
+        return stream_json_response('trades', TRADE_FIELDS.iter_list(rows))
+
+    limit = limit or app.config['TRADES_PAGE_SIZE']
+    if not 1 <= limit <= app.config['TRADES_MAX_PAGE_SIZE']:
+        return jsonify(message=f"limit must be between 1 and {app.config['TRADES_MAX_PAGE_SIZE']}."), 400
+    timestamp_key, as_key = trade_timestamp_key()
+    query = trade_rows_query(user_id, asset_id)
+    if cursor:
+        try:
+            after_timestamp, after_id = decode_trade_cursor(cursor)
+        except (ValueError, TypeError, binascii.Error):
+            return jsonify(message="Invalid cursor."), 400
+        after = db.tuple_(as_key(after_timestamp), after_id)
+        query = query.where(db.tuple_(timestamp_key, Trade.id) > after if order == 'asc' else db.tuple_(timestamp_key, Trade.id) < after)
+    if order == 'asc':
+        query = query.order_by(timestamp_key.asc(), Trade.id.asc())
+    else:
+        query = query.order_by(timestamp_key.desc(), Trade.id.desc())
+    rows = db.session.execute(query.limit(limit + 1)).all()
+    next_cursor = encode_trade_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return json_response(trades=TRADE_FIELDS.encode_list(rows[:limit]), next_cursor=next_cursor)
+
+@app.route('/trades/export', methods=['GET'])
+@jwt_required()
+def export_trades():
+    """
+    Streams every trade of the current user, oldest first, without loading them all.
+    Query params: format = 'ndjson' (default) or 'csv'; asset (optional, symbol)
     """
-    raw_identity = get_jwt_identity()
-    current_user_identity_dict = json.loads(raw_identity)
-    user_id = current_user_identity_dict['id']
+    user_id = current_user().id
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ['ndjson', 'csv']:
+        return jsonify(message="format must be 'ndjson' or 'csv'."), 400
+    try:
+        asset_id = _trade_asset_filter()
+    except LookupError as e:
+        return jsonify(message=f"Asset {e.args[0]} not found."), 404
+
+    def generate():
+        rows = db.session.execute(
+            trade_rows_query(user_id, asset_id)
+            .order_by(Trade.timestamp.asc(), Trade.id.asc())
+            .execution_options(yield_per=TRADE_EXPORT_BATCH)
+        )
+        if export_format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(TRADE_EXPORT_FIELDS)
+            for partition in rows.partitions():
+                for row in partition:
+                    trade = TRADE_FIELDS.as_dict(row)
+                    writer.writerow([trade[field] for field in TRADE_EXPORT_FIELDS])
+                yield buffer.getvalue()
+                buffer.seek(0); buffer.truncate()
+            if buffer.getvalue(): # header only: no trades
+                yield buffer.getvalue()
+        else:
+            yield from TRADE_FIELDS.iter_lines(rows, chunk_rows=TRADE_EXPORT_BATCH)
 
-    asset_symbol = request.args.get('asset')
-    query = Trade.query.filter_by(user_id=user_id)
-    if asset_symbol:
-        asset = Asset.query.filter_by(symbol=asset_symbol.upper()).first()
-        if not asset:
-            return jsonify(message=f"Asset {asset_symbol} not found."), 404
-        query = query.filter_by(asset_id=asset.id)
-    trades = query.order_by(Trade.timestamp.asc()).all()
-    return jsonify(trades=[t.to_dict() for t in trades]), 200
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=trades.{export_format}'})
+
+def hot_queries(ids):
+    """
+    The statements behind the busiest endpoints, for `flask explain-hot-queries`.
+    `ids` holds a user_id, asset_id, lesson_id and quiz_id to bind.
+    """
+    user_id, asset_id = ids['user_id'], ids['asset_id']
+    timestamp_key, as_key = trade_timestamp_key()
+    page_size = app.config['TRADES_PAGE_SIZE']
+    return [
+        HotQuery('GET /trades', trade_rows_query(user_id).order_by(Trade.timestamp.asc(), Trade.id.asc()), ('assets',)),
+        HotQuery('GET /trades?asset=', trade_rows_query(user_id, asset_id).order_by(Trade.timestamp.asc(), Trade.id.asc()), ('assets',)),
+        HotQuery('GET /trades?limit=&order=desc',
+                 trade_rows_query(user_id)
+                 .where(db.tuple_(timestamp_key, Trade.id) < db.tuple_(as_key(datetime.now(timezone.utc)), 2 ** 31 - 1))
+                 .order_by(timestamp_key.desc(), Trade.id.desc()).limit(page_size + 1), ('assets',)),
+        HotQuery('GET /portfolio/performance (trades)',
+                 db.select(Trade.id, Trade.asset_id, Trade.order_type, Trade.quantity, Trade.price_at_execution, Trade.timestamp)
+                 .where(Trade.user_id == user_id).order_by(Trade.id)),
+        HotQuery('GET /portfolio',
+                 db.select(PortfolioHolding.quantity, PortfolioHolding.average_purchase_price, Asset)
+                 .join(Asset, Asset.id == PortfolioHolding.asset_id)
+                 .where(PortfolioHolding.user_id == user_id, PortfolioHolding.quantity > 0)
+                 .order_by(PortfolioHolding.asset_id), ('assets',)),
+        HotQuery('GET /portfolio/history', portfolio_history_query(user_id, '1m', query=SNAPSHOT_FIELDS.select())),
+        HotQuery('GET /trades/open-orders',
+                 OPEN_ORDER_FIELDS.select().where(OpenOrder.user_id == user_id, OpenOrder.status == 'open').order_by(OpenOrder.id.desc()), ('assets',)),
+        HotQuery('holders of an asset', db.select(PortfolioHolding.user_id).where(PortfolioHolding.asset_id == asset_id)),
+        HotQuery('GET /content',
+                 CONTENT_FIELDS.select().order_by(EducationalContent.created_at.desc()).limit(10), ('users',)),
+        # /admin/news returns every row, so reading the whole table is the plan
+        HotQuery('GET /admin/news', NEWS_FIELDS.select().order_by(News.created_at.desc()), ('news',)),
+        HotQuery('GET /admin/quizzes?lesson_id=', QUIZ_FIELDS.select().where(Quiz.lesson_id == ids['lesson_id']).order_by(Quiz.id)),
+        HotQuery('GET /admin/quizzes/<id>/questions',
+                 QUIZ_QUESTION_FIELDS.select().where(QuizQuestion.quiz_id == ids['quiz_id']).order_by(QuizQuestion.id)),
+    ]
 
 # Admin required decorator
 def admin_required(fn):
@@ -604,15 +1430,30 @@ def admin_required(fn):
     @wraps(fn)
     @jwt_required()
     def wrapper(*args, **kwargs):
-        raw_identity = get_jwt_identity()
-        current_user_identity_dict = json.loads(raw_identity)
-        user_id = current_user_identity_dict['id']
-        user = User.query.get(user_id)
-        if not user or not user.is_admin:
+        # A non-admin claim is refused without touching the database; an admin claim (or a token
+        # from before the claim existed) is confirmed against the role cache, so demotions apply within ROLE_CACHE_TTL
+        user = current_user()
+        if user.is_admin_claim is False or not role_cache.is_admin(user.id):
             return jsonify(message="Admin privileges required."), 403
         return fn(*args, **kwargs)
     return wrapper
 
+@app.route('/admin/price-cache', methods=['GET'])
+@admin_required
+def admin_price_cache_stats():
+    stats = price_cache.stats()
+    stats['ttl_seconds'] = {
+        'stock': app.config['PRICE_CACHE_TTL_STOCK'],
+        'crypto': app.config['PRICE_CACHE_TTL_CRYPTO'],
+        'default': app.config['PRICE_CACHE_TTL_DEFAULT']
+    }
+    return jsonify(stats), 200
+
+@app.route('/admin/market-data', methods=['GET'])
+@admin_required
+def admin_market_data_stats():
+    return jsonify({**market_data.stats(), 'stream': price_broker.stats()}), 200
+
 # Example: Admin endpoint to set user cash balance
 @app.route('/admin/set-cash', methods=['POST'])
 @admin_required
@@ -628,6 +1469,7 @@ def admin_set_cash():
     try:
         user.cash_balance = Decimal(str(amount))
         db.session.commit()
+        leaderboard.mark_dirty(user.id)
         return jsonify(message=f"Set cash for {username} to {amount}"), 200
     except Exception as e:
         db.session.rollback()
@@ -636,8 +1478,8 @@ def admin_set_cash():
 @app.route('/admin/news', methods=['GET'])
 @admin_required
 def admin_get_news():
-    news = News.query.order_by(News.created_at.desc()).all()
-    return jsonify(news=[n.to_dict() for n in news]), 200
+    rows = db.session.execute(NEWS_FIELDS.select().order_by(News.created_at.desc())).all()
+    return json_response(news=NEWS_FIELDS.encode_list(rows))
 
 @app.route('/admin/news', methods=['POST'])
 @admin_required
@@ -679,8 +1521,8 @@ def admin_delete_news(news_id):
 @app.route('/admin/lessons', methods=['GET'])
 @admin_required
 def admin_get_lessons():
-    lessons = EducationalContent.query.order_by(EducationalContent.id.asc()).all()
-    return jsonify(lessons=[l.to_dict() for l in lessons]), 200
+    rows = db.session.execute(CONTENT_FIELDS.select().order_by(EducationalContent.id.asc())).all()
+    return json_response(lessons=CONTENT_FIELDS.encode_list(rows))
 
 @app.route('/admin/lessons', methods=['POST'])
 @admin_required
@@ -696,6 +1538,7 @@ def admin_add_lesson():
     lesson = EducationalContent(title=title, content_type=content_type, body=body, video_url=video_url, author_id=author_id)
     db.session.add(lesson)
     db.session.commit()
+    content_responses.invalidate()
     return jsonify(lesson=lesson.to_dict()), 201
 
 @app.route('/admin/lessons/<int:lesson_id>', methods=['PUT'])
@@ -710,6 +1553,7 @@ def admin_edit_lesson(lesson_id):
     lesson.body = data.get('body', lesson.body)
     lesson.video_url = data.get('video_url', lesson.video_url)
     db.session.commit()
+    content_responses.invalidate(lesson_id)
     return jsonify(lesson=lesson.to_dict()), 200
 
 @app.route('/admin/lessons/<int:lesson_id>', methods=['DELETE'])
@@ -720,16 +1564,14 @@ def admin_delete_lesson(lesson_id):
         return jsonify(message="Lesson not found."), 404
     db.session.delete(lesson)
     db.session.commit()
+    content_responses.invalidate(lesson_id)
     return jsonify(message="Deleted."), 200
 
 @app.route('/admin/users', methods=['GET'])
 @admin_required
 def admin_list_users():
-    users = User.query.all()
-    return jsonify(users=[{
-        'id': u.id, 'username': u.username, 'email': u.email,
-        'is_admin': u.is_admin, 'cash_balance': str(u.cash_balance)
-    } for u in users]), 200
+    rows = db.session.execute(ADMIN_USER_FIELDS.select().order_by(User.id)).all()
+    return json_response(users=ADMIN_USER_FIELDS.encode_list(rows))
 
 @app.route('/admin/users/<int:user_id>/set-cash', methods=['POST'])
 @admin_required
@@ -741,8 +1583,24 @@ def admin_set_user_cash(user_id):
         return jsonify(message="User or amount missing."), 400
     user.cash_balance = Decimal(str(amount))
     db.session.commit()
+    leaderboard.mark_dirty(user_id)
     return jsonify(message="Cash updated."), 200
 
+@app.route('/admin/users/<int:user_id>/set-cohort', methods=['POST'])
+@admin_required
+def admin_set_user_cohort(user_id):
+    data = request.get_json() or {}
+    cohort = data.get('cohort') or None # empty clears it
+    user = User.query.get(user_id)
+    if not user:
+        return jsonify(message="User not found."), 404
+    if cohort is not None and len(cohort) > 50:
+        return jsonify(message="Cohort name too long."), 400
+    user.cohort = cohort
+    db.session.commit()
+    leaderboard.mark_dirty(user_id)
+    return jsonify(message="Cohort updated."), 200
+
 @app.route('/admin/users/<int:user_id>/set-admin', methods=['POST'])
 @admin_required
 def admin_set_user_admin(user_id):
@@ -753,18 +1611,22 @@ def admin_set_user_admin(user_id):
         return jsonify(message="User not found."), 404
     user.is_admin = bool(is_admin)
     db.session.commit()
+    role_cache.invalidate(user_id)
     return jsonify(message="Admin status updated."), 200
 
 # --- Admin Quiz Management ---
 @app.route('/admin/quizzes', methods=['GET'])
 @admin_required
 def admin_list_quizzes():
-    lesson_id = request.args.get('lesson_id')
-    query = Quiz.query
+    lesson_id = request.args.get('lesson_id', type=int)
+    query = QUIZ_FIELDS.select()
     if lesson_id:
-        query = query.filter_by(lesson_id=lesson_id)
-    quizzes = query.order_by(Quiz.id.asc()).all()
-    return jsonify(quizzes=[q.to_dict(include_questions=True) for q in quizzes]), 200
+        query = query.where(Quiz.lesson_id == lesson_id)
+    quizzes = db.session.execute(query.order_by(Quiz.id.asc())).all()
+    questions = db.session.execute(
+        QUIZ_QUESTION_FIELDS.select().where(QuizQuestion.quiz_id.in_([quiz.id for quiz in quizzes])).order_by(QuizQuestion.id)
+    ).all() if quizzes else []
+    return json_response(quizzes=encode_with_children(QUIZ_FIELDS, quizzes, 'id', 'questions', QUIZ_QUESTION_FIELDS, questions, 'quiz_id'))
 
 @app.route('/admin/quizzes', methods=['POST'])
 @admin_required
@@ -810,7 +1672,8 @@ def admin_list_quiz_questions(quiz_id):
     quiz = Quiz.query.get(quiz_id)
     if not quiz:
         return jsonify(message="Quiz not found."), 404
-    return jsonify(questions=[q.to_dict() for q in quiz.questions]), 200
+    rows = db.session.execute(QUIZ_QUESTION_FIELDS.select().where(QuizQuestion.quiz_id == quiz_id).order_by(QuizQuestion.id)).all()
+    return json_response(questions=QUIZ_QUESTION_FIELDS.encode_list(rows))
 
 @app.route('/admin/quizzes/<int:quiz_id>/questions', methods=['POST'])
 @admin_required
@@ -867,8 +1730,11 @@ def admin_delete_quiz_question(quiz_id, question_id):
 @app.route('/admin/modules', methods=['GET'])
 @admin_required
 def admin_list_modules():
-    modules = Module.query.order_by(Module.order.asc().nullslast(), Module.id.asc()).all()
-    return jsonify(modules=[m.to_dict(include_lessons=True) for m in modules]), 200
+    modules = db.session.execute(MODULE_FIELDS.select().order_by(Module.order.asc().nullslast(), Module.id.asc())).all()
+    lessons = db.session.execute(
+        CONTENT_FIELDS.select().where(EducationalContent.module_id.in_([module.id for module in modules])).order_by(EducationalContent.id)
+    ).all() if modules else []
+    return json_response(modules=encode_with_children(MODULE_FIELDS, modules, 'id', 'lessons', CONTENT_FIELDS, lessons, 'module_id'))
 
 @app.route('/admin/modules', methods=['POST'])
 @admin_required
@@ -905,6 +1771,8 @@ def admin_delete_module(module_id):
         return jsonify(message="Module not found."), 404
     db.session.delete(module)
     db.session.commit()
+    # ON DELETE SET NULL unassigns the module's lessons, changing their module_id
+    content_responses.clear()
     return jsonify(message="Deleted."), 200
 
 # --- Admin Lesson Ordering/Assignment ---
@@ -920,6 +1788,7 @@ def admin_set_lesson_module(lesson_id):
     lesson.module_id = module_id
     lesson.order = order
     db.session.commit()
+    content_responses.invalidate(lesson_id)
     return jsonify(lesson=lesson.to_dict()), 200
 
 if __name__ == '__main__':
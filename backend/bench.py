@@ -0,0 +1,255 @@
+"""
+Micro-benchmarks for the hot paths of the backend. Run from backend/:
+
+    python bench.py order-book --orders 100000 --ticks 2000
+    python bench.py performance --trades 50000
+    python bench.py serialization --rows 10000
+    python bench.py login --logins 64 --threads 8 --workers 4
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import numpy as np
+
+from order_book import OrderBook, RESTING_ORDER_TYPES
+from performance import fifo_positions, risk_metrics
+
+
+def bench_order_book(args):
+    rng = random.Random(args.seed)
+    order_types = list(RESTING_ORDER_TYPES)
+    start_price = 100.0
+
+    def trigger():
+        return Decimal(f'{start_price * (1 + rng.gauss(0, 0.05)):.2f}')
+
+    orders = [(order_id, rng.randrange(args.assets), rng.choice(order_types), trigger()) for order_id in range(1, args.orders + 1)]
+    book = OrderBook()
+    started = time.perf_counter()
+    for order in orders:
+        book.add(*order)
+    load_seconds = time.perf_counter() - started
+
+    # Every asset follows its own random walk; each tick also rests one new order so the book stays deep
+    prices = [start_price] * args.assets
+    ticks = []
+    for _ in range(args.ticks):
+        asset_id = rng.randrange(args.assets)
+        prices[asset_id] *= 1 + rng.gauss(0, 0.002)
+        ticks.append((asset_id, Decimal(f'{prices[asset_id]:.2f}')))
+    next_id = args.orders + 1
+
+    filled = 0
+    cancelled = 0
+    started = time.perf_counter()
+    for asset_id, price in ticks:
+        filled += len(book.crossing(asset_id, price))
+        book.add(next_id, asset_id, rng.choice(order_types), trigger())
+        if next_id % 10 == 0:
+            book.discard(next_id - rng.randrange(1, 1000))
+            cancelled += 1
+        next_id += 1
+    match_seconds = time.perf_counter() - started
+
+    print(f"loaded {args.orders} orders over {args.assets} assets in {load_seconds * 1000:.1f} ms "
+          f"({args.orders / load_seconds:,.0f} orders/s)")
+    print(f"{args.ticks} ticks: {filled} fills, {cancelled} cancels, {match_seconds * 1000:.1f} ms total, "
+          f"{match_seconds / args.ticks * 1e6:.1f} us/tick")
+    print(f"book after run: {book.stats()}")
+
+    if args.compare_scan:
+        # Baseline: scanning every open order on every tick
+        resting = {order_id: (asset_id, order_type, price) for order_id, asset_id, order_type, price in orders}
+        started = time.perf_counter()
+        for asset_id, price in ticks[:args.scan_ticks]:
+            for order_id, (order_asset, order_type, trigger_price) in list(resting.items()):
+                if order_asset != asset_id:
+                    continue
+                falls = RESTING_ORDER_TYPES[order_type][1] == 'falls'
+                if (falls and price <= trigger_price) or (not falls and price >= trigger_price):
+                    del resting[order_id]
+        scan_seconds = time.perf_counter() - started
+        print(f"full-scan baseline: {scan_seconds / args.scan_ticks * 1e6:.1f} us/tick over {args.scan_ticks} ticks")
+
+
+def bench_performance(args):
+    rng = np.random.default_rng(args.seed)
+    n = args.trades
+    asset_ids = rng.integers(0, args.assets, n)
+    quantities = rng.uniform(0.5, 10, n).round(4)
+    prices = rng.uniform(50, 150, n).round(2)
+    timestamps = np.datetime64('2024-01-01T00:00:00') + np.arange(n).astype('timedelta64[m]')
+    # Sell at most what is held: a trade is a sell only if its asset's running position covers it
+    is_buy = np.ones(n, dtype=bool)
+    held = np.zeros(args.assets)
+    for i in range(n):
+        if held[asset_ids[i]] >= quantities[i] and rng.random() < 0.4:
+            is_buy[i] = False
+            held[asset_ids[i]] -= quantities[i]
+        else:
+            held[asset_ids[i]] += quantities[i]
+
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        positions = fifo_positions(asset_ids, is_buy, quantities, prices, timestamps)
+    fifo_seconds = (time.perf_counter() - started) / args.repeat
+    equity = 10000 * np.cumprod(1 + rng.normal(0.0005, 0.01, args.days))
+    started = time.perf_counter()
+    risk_metrics(equity)
+    risk_seconds = time.perf_counter() - started
+
+    open_lots = sum(len(p['lots']) for p in positions.values())
+    print(f"{n} trades over {args.assets} assets ({int((~is_buy).sum())} sells): FIFO rebuild {fifo_seconds * 1000:.1f} ms, "
+          f"{open_lots} open lots")
+    print(f"risk metrics over {args.days} daily values: {risk_seconds * 1000:.2f} ms")
+
+
+def bench_serialization(args):
+    # Throwaway in-memory database; the app binds it when first imported
+    os.environ['DATABASE_URL'] = 'sqlite://'
+    from app import app
+    from models import db, User, Asset, Trade
+    from serialization import TRADE_FIELDS
+
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(id=1, username='bench', email='bench@example.com', password_hash='-'))
+        db.session.add_all([Asset(id=i, symbol=f'SYM{i}', name=f'Asset {i}', asset_type='stock') for i in range(1, 21)])
+        rng = random.Random(args.seed)
+        db.session.execute(db.insert(Trade.__table__), [
+            {'user_id': 1, 'asset_id': rng.randint(1, 20), 'order_type': rng.choice(['market_buy', 'market_sell']),
+             'quantity': Decimal(f'{rng.uniform(0.1, 50):.8f}'), 'price_at_execution': Decimal(f'{rng.uniform(10, 500):.8f}')}
+            for _ in range(args.rows)
+        ])
+        db.session.commit()
+
+        def to_dict_path():
+            # The old list path: ORM objects, to_dict per row (asset via relationship), then jsonify's encoder
+            trades = Trade.query.filter_by(user_id=1).order_by(Trade.id).all()
+            return app.json.dumps({'trades': [trade.to_dict() for trade in trades]}).encode()
+
+        def plan_path():
+            rows = db.session.execute(TRADE_FIELDS.select().where(Trade.user_id == 1).order_by(Trade.id)).all()
+            return ('{"trades":' + TRADE_FIELDS.encode_list(rows) + '}').encode()
+
+        for name, path in (('to_dict + jsonify', to_dict_path), ('compiled field plan', plan_path)):
+            timings = []
+            for _ in range(args.repeat):
+                db.session.expunge_all()
+                started = time.process_time()
+                body = path()
+                timings.append(time.process_time() - started)
+            db.session.expunge_all()
+            tracemalloc.start()
+            path()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"{name:>20}: {min(timings) * 1000:7.1f} ms CPU (best of {args.repeat}), "
+                  f"peak {peak / 2 ** 20:6.1f} MiB, {len(body):,} bytes for {args.rows} rows")
+
+
+def bench_login(args):
+    # Throwaway SQLite file shared by the client threads; the app binds it when first imported
+    db_fd, db_path = tempfile.mkstemp(suffix='.db')
+    os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+    import app as app_module
+    from models import db, User
+    from passwords import PasswordHasher
+
+    app = app_module.app
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(username='bench', email='bench@example.com',
+                            password_hash=PasswordHasher(method=args.method, workers=0).hash('password')))
+        db.session.commit()
+
+    def run(hasher):
+        app_module.password_hasher = hasher
+        client = app.test_client()
+        stop = threading.Event()
+        health_latencies = []
+
+        def reads():
+            # Cheap requests on the same process while the login burst runs
+            while not stop.is_set():
+                started = time.perf_counter()
+                client.get('/health')
+                health_latencies.append(time.perf_counter() - started)
+
+        def login(_):
+            response = client.post('/auth/login', json={'username_or_email': 'bench', 'password': 'password'})
+            return response.status_code
+
+        hasher.verify(hasher.hash('warm-up'), 'warm-up') # start the worker processes outside the timing
+        reader = threading.Thread(target=reads)
+        reader.start()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            statuses = list(pool.map(login, range(args.logins)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        reader.join()
+        hasher.shutdown()
+        latencies = sorted(health_latencies)
+        p99 = latencies[int(len(latencies) * 0.99)] if latencies else float('nan')
+        return elapsed, statuses, statistics.median(latencies) if latencies else float('nan'), p99
+
+    for name, hasher in (('inline', PasswordHasher(method=args.method, workers=0)),
+                         (f'pool ({args.workers} processes)', PasswordHasher(method=args.method, workers=args.workers,
+                                                                            max_pending=args.logins, timeout=60))):
+        elapsed, statuses, p50, p99 = run(hasher)
+        ok = statuses.count(200)
+        print(f"{name:>20}: {ok}/{len(statuses)} logins in {elapsed:.2f}s ({ok / elapsed:.1f}/s); "
+              f"/health during the burst p50 {p50 * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms")
+    os.close(db_fd)
+    os.remove(db_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    order_book = subparsers.add_parser('order-book', help="Tick matching throughput of the in-memory limit/stop order book")
+    order_book.add_argument('--orders', type=int, default=100000)
+    order_book.add_argument('--assets', type=int, default=20)
+    order_book.add_argument('--ticks', type=int, default=2000)
+    order_book.add_argument('--seed', type=int, default=7)
+    order_book.add_argument('--compare-scan', action='store_true', help="Also time a scan-every-order baseline")
+    order_book.add_argument('--scan-ticks', type=int, default=50)
+    order_book.set_defaults(func=bench_order_book)
+
+    performance = subparsers.add_parser('performance', help="FIFO P&L rebuild and risk metrics for a large trade history")
+    performance.add_argument('--trades', type=int, default=50000)
+    performance.add_argument('--assets', type=int, default=25)
+    performance.add_argument('--days', type=int, default=1000)
+    performance.add_argument('--repeat', type=int, default=5)
+    performance.add_argument('--seed', type=int, default=7)
+    performance.set_defaults(func=bench_performance)
+
+    serialization = subparsers.add_parser('serialization', help="List serialization: to_dict + jsonify against compiled field plans")
+    serialization.add_argument('--rows', type=int, default=10000)
+    serialization.add_argument('--repeat', type=int, default=5)
+    serialization.add_argument('--seed', type=int, default=7)
+    serialization.set_defaults(func=bench_serialization)
+
+    login = subparsers.add_parser('login', help="Login throughput and concurrent request latency, hashing inline vs in the process pool")
+    login.add_argument('--logins', type=int, default=64)
+    login.add_argument('--threads', type=int, default=8, help="Concurrent login requests")
+    login.add_argument('--workers', type=int, default=4, help="Hashing processes for the pooled run")
+    login.add_argument('--method', default='scrypt')
+    login.set_defaults(func=bench_login)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
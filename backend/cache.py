@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Flight:
+    """A load in progress; concurrent callers for the same key wait on it."""
+    __slots__ = ('event', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    """
+    Thread-safe, process-wide LRU cache with per-entry TTL.
+    get_or_load() deduplicates concurrent misses: only one caller runs the
+    loader for a given key, the others wait for its result (single-flight).
+    """
+
+    def __init__(self, max_entries=1024, default_ttl=60.0, cache_none=False, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.cache_none = cache_none # None usually means "fetch failed", so retry by default
+        self._clock = clock
+        self._entries = OrderedDict() # key -> (value, expires_at), oldest first
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stale': 0, 'loads': 0, 'load_errors': 0, 'coalesced': 0, 'evictions': 0}
+
+    def _lookup(self, key, now):
+        # Must be called with self._lock held. Returns (found, value).
+        entry = self._entries.get(key)
+        if entry is None:
+            self._stats['misses'] += 1
+            return False, None
+        value, expires_at = entry
+        if expires_at <= now:
+            self._stats['stale'] += 1
+            return False, None
+        self._entries.move_to_end(key)
+        self._stats['hits'] += 1
+        return True, value
+
+    def _store(self, key, value, ttl):
+        # Must be called with self._lock held.
+        if value is None and not self.cache_none:
+            return
+        self._entries[key] = (value, self._clock() + (self.default_ttl if ttl is None else ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            found, value = self._lookup(key, self._clock())
+        return value if found else default
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def get_or_load(self, key, loader, ttl=None):
+        with self._lock:
+            found, value = self._lookup(key, self._clock())
+        if found:
+            return value
+        return self.load(key, loader, ttl)
+
+    def load(self, key, loader, ttl=None):
+        """
+        Runs loader and caches its result, skipping the lookup. Callers that
+        already know the key is missing use this so the miss isn't counted twice.
+        """
+        with self._lock:
+            flight = self._inflight.get(key)
+            if flight is None:
+                flight = self._inflight[key] = _Flight()
+                leader = True
+            else:
+                self._stats['coalesced'] += 1
+                leader = False
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+        except Exception as e:
+            flight.error = e
+            with self._lock:
+                self._stats['load_errors'] += 1
+            raise
+        else:
+            with self._lock:
+                self._stats['loads'] += 1
+                self._store(key, flight.value, ttl)
+            return flight.value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data['size'] = len(self._entries)
+            data['max_entries'] = self.max_entries
+            lookups = data['hits'] + data['misses'] + data['stale']
+            data['hit_ratio'] = round(data['hits'] / lookups, 4) if lookups else None
+        return data
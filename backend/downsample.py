@@ -0,0 +1,53 @@
+import numpy as np
+
+
+def lttb_indices(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling.
+    Returns the indices of the `threshold` points of (x, y) that best preserve
+    the visual shape of the series; first and last points are always kept.
+
+    Bucket boundaries and the "next bucket" averages are computed for all
+    buckets at once; the selection then walks the buckets (not the points),
+    scoring every candidate of a bucket with one vectorized area computation.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # Interior points 1..n-2 split into threshold-2 buckets
+    edges = (np.arange(threshold - 1) * ((n - 2) / (threshold - 2))).astype(np.int64) + 1
+    edges[-1] = n - 1
+    starts, ends = edges[:-1], edges[1:]
+
+    # Average point of every bucket; the bucket after the last one is the final point
+    counts = ends - starts
+    avg_x = np.append(np.add.reduceat(x[:-1], starts) / counts, x[-1])
+    avg_y = np.append(np.add.reduceat(y[:-1], starts) / counts, y[-1])
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = starts[i], ends[i]
+        cx, cy = avg_x[i + 1], avg_y[i + 1]
+        ax, ay = x[a], y[a]
+        areas = np.abs((ax - cx) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (cy - ay))
+        a = lo + int(np.argmax(areas))
+        selected[i + 1] = a
+    return selected
+
+
+def downsample_history(history, points, key='price'):
+    """
+    Downsamples a [{"date": ..., "price": ...}] list to at most `points` entries with LTTB on `key`.
+    `key` may also be a function returning the value of an entry (e.g. for result rows).
+    """
+    if points is None or len(history) <= points:
+        return history
+    value = key if callable(key) else lambda h: h[key]
+    prices = np.fromiter((float(value(h)) for h in history), dtype=np.float64, count=len(history))
+    keep = lttb_indices(np.arange(len(history)), prices, points)
+    return [history[i] for i in keep.tolist()]
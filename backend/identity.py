@@ -0,0 +1,71 @@
+import json
+
+from flask import g
+from flask_jwt_extended import get_jwt, get_jwt_identity
+
+from models import db, User
+
+
+class CurrentUser:
+    """
+    The authenticated user of a request, decoded once from the JWT: id and
+    username from the identity, is_admin from the signed claim. The User row
+    is only loaded when a handler asks for it (.row), and then once.
+    """
+    __slots__ = ('id', 'username', 'is_admin_claim', '_row')
+
+    def __init__(self, id, username, is_admin_claim):
+        self.id = id
+        self.username = username
+        self.is_admin_claim = is_admin_claim # None for tokens issued before the claim existed
+        self._row = None
+
+    @property
+    def row(self):
+        if self._row is None:
+            self._row = db.session.get(User, self.id)
+        return self._row
+
+    def identity(self):
+        return {'id': self.id, 'username': self.username}
+
+
+def current_user():
+    """The request's CurrentUser (call inside a @jwt_required view); decoded on first use and kept on flask.g."""
+    user = g.get('current_user')
+    if user is None:
+        identity = json.loads(get_jwt_identity())
+        user = g.current_user = CurrentUser(identity['id'], identity.get('username'), get_jwt().get('is_admin'))
+    return user
+
+
+def role_claims(user):
+    """Extra claims signed into a user's access tokens."""
+    return {'is_admin': bool(user.is_admin)}
+
+
+class RoleCache:
+    """
+    Current admin flag per user, read from the database at most once per TTL.
+    The JWT claim alone would let a demoted admin keep access until the token
+    expires; confirming admin claims here bounds that to the TTL (and to zero
+    in the process that made the change, which calls invalidate()).
+    Non-admin claims are trusted as is: they never grant anything.
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    def is_admin(self, user_id):
+        return self._cache.get_or_load(user_id, lambda: bool(
+            db.session.execute(db.select(User.is_admin).where(User.id == user_id)).scalar()
+        ))
+
+    def invalidate(self, user_id):
+        self._cache.invalidate(user_id)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
@@ -0,0 +1,115 @@
+import math
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Bars per year, used to annualize volatility
+PERIODS_PER_YEAR = {'30min': 252 * 13, 'daily': 252, 'weekly': 52}
+
+# 'bb' takes window and an optional band width (default 2 standard deviations); the others take a window
+SUPPORTED = ('sma', 'ema', 'rsi', 'bb', 'vol')
+MAX_INDICATORS = 10
+MAX_WINDOW = 500
+
+# EMA weights below this are dropped, which bounds the convolution kernel length
+EMA_WEIGHT_CUTOFF = 1e-12
+
+
+def parse_indicator_spec(spec):
+    """
+    Parses 'sma:20,ema:50,rsi:14,bb:20:2,vol:20' into [('sma:20', 'sma', 20, None), ...].
+    Raises ValueError with a user-facing message on bad input.
+    """
+    parsed = []
+    for item in dict.fromkeys(part.strip().lower() for part in spec.split(',') if part.strip()):
+        name, *args = item.split(':')
+        if name not in SUPPORTED:
+            raise ValueError(f"Unknown indicator '{name}'. Supported: {', '.join(SUPPORTED)}.")
+        if (name == 'bb' and len(args) not in (1, 2)) or (name != 'bb' and len(args) != 1):
+            raise ValueError(f"Invalid parameters for '{item}'.")
+        try:
+            window = int(args[0])
+            width = float(args[1]) if len(args) > 1 else (2.0 if name == 'bb' else None)
+        except ValueError:
+            raise ValueError(f"Invalid parameters for '{item}'.")
+        if not 1 <= window <= MAX_WINDOW or (width is not None and width <= 0):
+            raise ValueError(f"Invalid parameters for '{item}'.")
+        parsed.append((item, name, window, width))
+    if not parsed:
+        raise ValueError("At least one indicator is required.")
+    if len(parsed) > MAX_INDICATORS:
+        raise ValueError(f"At most {MAX_INDICATORS} indicators per request.")
+    return parsed
+
+
+def _rolling_mean(x, window):
+    out = np.full(len(x), np.nan)
+    if window <= len(x):
+        csum = np.cumsum(np.insert(x, 0, 0.0))
+        out[window - 1:] = (csum[window:] - csum[:-window]) / window
+    return out
+
+
+def _rolling_std(x, window):
+    out = np.full(len(x), np.nan)
+    if window <= len(x):
+        out[window - 1:] = sliding_window_view(x, window).std(axis=1)
+    return out
+
+
+def _ewm(x, alpha):
+    """
+    Exponentially weighted mean (bias-adjusted, like pandas' adjust=True) as one
+    convolution with a kernel truncated where weights fall below EMA_WEIGHT_CUTOFF.
+    """
+    n = len(x)
+    if n == 0:
+        return x
+    length = min(n, int(math.ceil(math.log(EMA_WEIGHT_CUTOFF) / math.log(1 - alpha))) if alpha < 1 else 1)
+    weights = (1 - alpha) ** np.arange(length)
+    return np.convolve(x, weights)[:n] / np.convolve(np.ones(n), weights)[:n]
+
+
+def compute_indicators(closes, specs, interval='daily'):
+    """Returns {key: values or {band: values}}, every array aligned with `closes` (NaN during warm-up)."""
+    closes = np.asarray(closes, dtype=np.float64)
+    n = len(closes)
+    results = {}
+    for key, name, window, width in specs:
+        if name == 'sma':
+            results[key] = _rolling_mean(closes, window)
+        elif name == 'ema':
+            values = _ewm(closes, 2 / (window + 1))
+            values[:window - 1] = np.nan
+            results[key] = values
+        elif name == 'rsi':
+            # Wilder's RSI: smoothed average gain vs. average loss
+            values = np.full(n, np.nan)
+            if n > window:
+                change = np.diff(closes)
+                avg_gain = _ewm(np.clip(change, 0, None), 1 / window)
+                avg_loss = _ewm(np.clip(-change, 0, None), 1 / window)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    rsi = np.where(avg_loss == 0, 100.0, 100 - 100 / (1 + avg_gain / avg_loss))
+                values[window:] = rsi[window - 1:]
+            results[key] = values
+        elif name == 'bb':
+            middle = _rolling_mean(closes, window)
+            spread = width * _rolling_std(closes, window)
+            results[key] = {'upper': middle + spread, 'middle': middle, 'lower': middle - spread}
+        elif name == 'vol':
+            # Annualized volatility of log returns over the window
+            values = np.full(n, np.nan)
+            if n > 1:
+                values[1:] = _rolling_std(np.diff(np.log(closes)), window) * math.sqrt(PERIODS_PER_YEAR.get(interval, 252))
+            results[key] = values
+    return results
+
+
+def to_json_lists(results, decimals=4):
+    """NaN -> None, rounded, so the payload stays compact."""
+    def convert(values):
+        rounded = np.round(values, decimals)
+        return [None if math.isnan(v) else v for v in rounded.tolist()]
+    return {key: ({band: convert(v) for band, v in value.items()} if isinstance(value, dict) else convert(value))
+            for key, value in results.items()}
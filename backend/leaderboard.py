@@ -0,0 +1,367 @@
+import bisect
+import logging
+import threading
+import time
+
+from models import db, User, Trade, PortfolioHolding, AssetPrice
+
+logger = logging.getLogger(__name__)
+
+# Users reloaded per round of queries when many traded since the last sync
+SYNC_CHUNK_SIZE = 500
+
+
+class RankedList:
+    """
+    Sorted keys with O(log n) add, remove and rank (index of a key). Keys are
+    kept in blocks of at most 2 * `load`, found by bisecting the blocks'
+    maxima; a Fenwick tree over the block lengths turns a block number into a
+    position and back. Moves within a block are bounded by the block size, not
+    by n, and the tree is only rebuilt when a block splits or empties.
+    """
+
+    def __init__(self, load=256):
+        self.load = load
+        self._blocks = []
+        self._maxes = []
+        self._tree = [0] # 1-based Fenwick tree of block lengths
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def _rebuild_tree(self):
+        tree = [0] * (len(self._blocks) + 1)
+        for i, block in enumerate(self._blocks, 1):
+            tree[i] += len(block)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, block_index, delta):
+        i = block_index + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _count_before(self, block_index):
+        total, i = 0, block_index
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def _locate(self, position):
+        # (block index, offset in block) of the key at `position`
+        block_index, step = 0, 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            following = block_index + step
+            if following < len(self._tree) and self._tree[following] <= position:
+                block_index = following
+                position -= self._tree[following]
+            step >>= 1
+        return block_index, position
+
+    def add(self, key):
+        if not self._blocks:
+            self._blocks, self._maxes = [[key]], [key]
+            self._rebuild_tree()
+            self._len = 1
+            return
+        b = min(bisect.bisect_left(self._maxes, key), len(self._blocks) - 1)
+        block = self._blocks[b]
+        bisect.insort(block, key)
+        self._maxes[b] = block[-1]
+        self._len += 1
+        if len(block) > 2 * self.load:
+            self._blocks[b:b + 1] = [block[:self.load], block[self.load:]]
+            self._maxes[b:b + 1] = [self._blocks[b][-1], self._blocks[b + 1][-1]]
+            self._rebuild_tree()
+        else:
+            self._tree_add(b, 1)
+
+    def remove(self, key):
+        b = bisect.bisect_left(self._maxes, key)
+        block = self._blocks[b] if b < len(self._blocks) else []
+        i = bisect.bisect_left(block, key)
+        if i == len(block) or block[i] != key:
+            raise ValueError(f"{key!r} is not in the list")
+        del block[i]
+        self._len -= 1
+        if block:
+            self._maxes[b] = block[-1]
+            self._tree_add(b, -1)
+        else:
+            del self._blocks[b], self._maxes[b]
+            self._rebuild_tree()
+
+    def index(self, key):
+        """Number of keys smaller than `key` (its 0-based rank if present)."""
+        b = bisect.bisect_left(self._maxes, key)
+        if b == len(self._blocks):
+            return self._len
+        return self._count_before(b) + bisect.bisect_left(self._blocks[b], key)
+
+    def islice(self, start, stop):
+        """The keys at positions start..stop-1, as a list."""
+        stop = min(stop, self._len)
+        if start >= stop:
+            return []
+        b, offset = self._locate(start)
+        keys = []
+        while len(keys) < stop - start:
+            keys.extend(self._blocks[b][offset:offset + stop - start - len(keys)])
+            b, offset = b + 1, 0
+        return keys
+
+
+class Leaderboard:
+    """
+    Users ranked by total value (cash + holdings at the stored asset_prices
+    snapshots; positions without one count at their average purchase price).
+
+    Rankings are RankedLists of (-value, user_id), one overall and one per
+    cohort, so re-placing a user, a page and "my rank" are all O(log n).
+    Nothing is recomputed wholesale on a change: a trade reloads that one
+    user, and a price move only revalues the holders of that asset (asset ->
+    holders index).
+
+    Every worker keeps its own copy, maintained off the request path by a
+    background thread (start()): refresh() syncs what other processes wrote
+    (new trades by id, refreshed prices by fetched_at, new users) every
+    `sync_interval` seconds, and rebuilds everything every
+    `full_reload_interval` seconds to pick up the rest (admin cash or cohort
+    edits). A rebuild is built aside and swapped in, so reads never wait for
+    it. Requests only read, after reloading the few users this worker just
+    changed (reload_dirty()).
+    """
+
+    # Attributes replaced as a whole by a full rebuild
+    _STATE = ('_users', '_values', '_holders', '_prices', '_rankings', '_last_trade_id', '_last_user_id', '_prices_as_of')
+
+    def __init__(self, sync_interval=5.0, full_reload_interval=600.0, clock=time.monotonic, sleep=time.sleep):
+        self.sync_interval = sync_interval
+        self.full_reload_interval = full_reload_interval
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.RLock()
+        self._refreshing = threading.Lock() # single flight for refresh()
+        self._thread = None
+        self._loaded_at = None
+        self._synced_at = None
+        self._dirty = set() # users changed by this process since the last read
+        self._reset()
+
+    def _reset(self):
+        self._users = {} # user_id -> {'username', 'cohort', 'cash', 'positions': {asset_id: (quantity, average_price)}}
+        self._values = {} # user_id -> total value
+        self._holders = {} # asset_id -> set of user ids
+        self._prices = {} # asset_id -> price
+        self._rankings = {None: RankedList()} # cohort (None = everyone) -> (-value, user_id) in order
+        self._last_trade_id = 0
+        self._last_user_id = 0
+        self._prices_as_of = None
+
+    # --- Incremental maintenance ---
+
+    def _value_of(self, user):
+        total = user['cash']
+        for asset_id, (quantity, average_price) in user['positions'].items():
+            price = self._prices.get(asset_id)
+            total += quantity * (price if price is not None else average_price)
+        return total
+
+    def _cohorts(self, user_id):
+        cohort = self._users[user_id]['cohort']
+        return (None,) if cohort is None else (None, cohort)
+
+    def _unrank(self, user_id):
+        value = self._values.pop(user_id, None)
+        if value is None:
+            return
+        for cohort in self._cohorts(user_id):
+            self._rankings[cohort].remove((-value, user_id))
+
+    def _rank(self, user_id):
+        value = self._value_of(self._users[user_id])
+        self._values[user_id] = value
+        for cohort in self._cohorts(user_id):
+            if cohort not in self._rankings:
+                self._rankings[cohort] = RankedList()
+            self._rankings[cohort].add((-value, user_id))
+
+    def _set_user(self, user_id, username, cohort, cash, positions):
+        with self._lock:
+            if user_id in self._users:
+                self._unrank(user_id)
+                for asset_id in self._users[user_id]['positions']:
+                    self._holders.get(asset_id, set()).discard(user_id)
+            self._users[user_id] = {'username': username, 'cohort': cohort, 'cash': cash, 'positions': positions}
+            for asset_id in positions:
+                self._holders.setdefault(asset_id, set()).add(user_id)
+            self._rank(user_id)
+
+    def mark_dirty(self, user_id):
+        """Call after committing a trade or edit for a user; they are reloaded before the next read."""
+        with self._lock:
+            self._dirty.add(user_id)
+
+    def on_price(self, asset_id, price):
+        """Revalues only the holders of `asset_id`."""
+        with self._lock:
+            if self._prices.get(asset_id) == price:
+                return
+            holders = self._holders.get(asset_id, ())
+            for user_id in holders:
+                self._unrank(user_id)
+            self._prices[asset_id] = price
+            for user_id in holders:
+                self._rank(user_id)
+
+    def reload_users(self, user_ids):
+        """Re-reads cash and positions for these users (after a trade or an admin edit), in two queries."""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        users = db.session.execute(
+            db.select(User.id, User.username, User.cohort, User.cash_balance).where(User.id.in_(user_ids))
+        ).all()
+        positions = {user_id: {} for user_id in user_ids}
+        for user_id, asset_id, quantity, average_price in db.session.execute(
+            db.select(PortfolioHolding.user_id, PortfolioHolding.asset_id, PortfolioHolding.quantity,
+                      PortfolioHolding.average_purchase_price)
+            .where(PortfolioHolding.user_id.in_(user_ids))
+        ):
+            positions[user_id][asset_id] = (quantity, average_price)
+        with self._lock:
+            for user in users:
+                self._set_user(user.id, user.username, user.cohort, user.cash_balance, positions[user.id])
+                self._last_user_id = max(self._last_user_id, user.id)
+            for user_id in set(user_ids) - {user.id for user in users}:
+                self._remove_user(user_id)
+
+    def _remove_user(self, user_id):
+        if user_id not in self._users:
+            return
+        self._unrank(user_id)
+        for asset_id in self._users.pop(user_id)['positions']:
+            self._holders.get(asset_id, set()).discard(user_id)
+
+    # --- Loading and syncing ---
+
+    def load(self):
+        """Full rebuild: every user, position and stored price, built in a scratch Leaderboard and swapped in."""
+        fresh = Leaderboard()
+        prices = db.session.execute(db.select(AssetPrice.asset_id, AssetPrice.price, AssetPrice.fetched_at)).all()
+        fresh._prices = {row.asset_id: row.price for row in prices}
+        fresh._prices_as_of = max((row.fetched_at for row in prices), default=None)
+        fresh._last_trade_id = db.session.execute(db.select(db.func.max(Trade.id))).scalar() or 0
+        user_ids = list(db.session.execute(db.select(User.id)).scalars())
+        for start in range(0, len(user_ids), SYNC_CHUNK_SIZE):
+            fresh.reload_users(user_ids[start:start + SYNC_CHUNK_SIZE])
+        with self._lock:
+            for name in self._STATE:
+                setattr(self, name, getattr(fresh, name))
+            self._loaded_at = self._synced_at = self._clock()
+
+    def sync(self):
+        """Applies trades, price refreshes and sign-ups written since the last sync (by any process)."""
+        with self._lock:
+            last_trade_id, last_user_id, prices_as_of = self._last_trade_id, self._last_user_id, self._prices_as_of
+        traded = db.session.execute(
+            db.select(Trade.user_id, db.func.max(Trade.id)).where(Trade.id > last_trade_id).group_by(Trade.user_id)
+        ).all()
+        new_users = db.session.execute(db.select(User.id).where(User.id > last_user_id)).scalars()
+        changed = list({user_id for user_id, _ in traded} | set(new_users))
+        for start in range(0, len(changed), SYNC_CHUNK_SIZE):
+            self.reload_users(changed[start:start + SYNC_CHUNK_SIZE])
+
+        price_query = db.select(AssetPrice.asset_id, AssetPrice.price, AssetPrice.fetched_at)
+        if prices_as_of is not None:
+            price_query = price_query.where(AssetPrice.fetched_at > prices_as_of)
+        for row in db.session.execute(price_query).all():
+            self.on_price(row.asset_id, row.price)
+            with self._lock:
+                if self._prices_as_of is None or row.fetched_at > self._prices_as_of:
+                    self._prices_as_of = row.fetched_at
+        with self._lock:
+            self._last_trade_id = max([self._last_trade_id] + [trade_id for _, trade_id in traded])
+            self._synced_at = self._clock()
+
+    @property
+    def loaded(self):
+        return self._loaded_at is not None
+
+    def refresh(self):
+        """
+        Loads, syncs or fully reloads, whichever is due. Single flight: returns
+        False at once if another refresh is running. Runs on the background thread.
+        """
+        if not self._refreshing.acquire(blocking=False):
+            return False
+        try:
+            now = self._clock()
+            if self._loaded_at is None or now - self._loaded_at >= self.full_reload_interval:
+                self.load()
+            elif now - self._synced_at >= self.sync_interval:
+                self.sync()
+            return True
+        finally:
+            self._refreshing.release()
+
+    def start(self, run_refresh):
+        """
+        Starts the background thread (once per process) that calls
+        run_refresh() now and then every sync_interval seconds; run_refresh
+        wraps refresh() in whatever context the database session needs.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, args=(run_refresh,), name='leaderboard-refresh', daemon=True)
+        self._thread.start()
+
+    def _run(self, run_refresh):
+        while True:
+            try:
+                run_refresh()
+            except Exception as e:
+                logger.error(f"Leaderboard refresh failed: {str(e)}")
+            self._sleep(self.sync_interval)
+
+    def reload_dirty(self):
+        """Reloads the users this process changed since the last read (a handful of rows), so they see their own trades."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        self.reload_users(dirty)
+
+    # --- Reads ---
+
+    def page(self, page, per_page, cohort=None):
+        """(entries, total) for one page of a ranking; entries are dicts with rank, user_id, username, total_value."""
+        with self._lock:
+            ranking = self._rankings.get(cohort, RankedList())
+            start = (page - 1) * per_page
+            entries = [
+                {'rank': start + i + 1, 'user_id': user_id, 'username': self._users[user_id]['username'], 'total_value': -neg_value}
+                for i, (neg_value, user_id) in enumerate(ranking.islice(start, start + per_page))
+            ]
+            return entries, len(ranking)
+
+    def rank_of(self, user_id, cohort=None):
+        """(rank, total_value) of a user within a ranking, or None if they aren't in it."""
+        with self._lock:
+            value = self._values.get(user_id)
+            if value is None or (cohort is not None and self._users[user_id]['cohort'] != cohort):
+                return None
+            return self._rankings[cohort].index((-value, user_id)) + 1, value
+
+    def stats(self):
+        with self._lock:
+            return {
+                'users': len(self._users),
+                'cohorts': len(self._rankings) - 1,
+                'assets_held': sum(1 for holders in self._holders.values() if holders),
+                'last_trade_id': self._last_trade_id,
+            }
@@ -0,0 +1,320 @@
+import threading
+import time
+import logging
+from collections import deque, namedtuple
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+ALPHA_VANTAGE_URL = 'https://www.alphavantage.co/query'
+
+# A price with the time it was fetched; stale quotes are a last known value served while the upstream can't answer
+Quote = namedtuple('Quote', ['price', 'as_of', 'stale'])
+
+
+class MarketDataError(Exception):
+    pass
+
+class RateLimited(MarketDataError):
+    pass
+
+class CircuitOpen(MarketDataError):
+    pass
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, at most `capacity` banked."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        # Returns seconds to wait before a token is ours (0 = take it now). Called with the lock held.
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout):
+        """Takes a token, waiting up to `timeout` seconds. Returns False if none became available in time."""
+        deadline = self._clock() + timeout
+        while True:
+            with self._lock:
+                wait = self._reserve()
+            if wait == 0.0:
+                return True
+            if self._clock() + wait > deadline:
+                return False
+            self._sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures (or immediately on
+    trip()), rejects calls for `reset_timeout` seconds, then lets a single
+    trial call through (half-open) to decide whether to close again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=60.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if self._clock() - self._opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def release(self):
+        """Gives back a half-open trial slot when the call was never made."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = self._clock()
+
+    def trip(self):
+        with self._lock:
+            self._trial_in_flight = False
+            self._opened_at = self._clock()
+
+
+class LatencyStats:
+    """Per-call latency recorder; percentiles are taken over the last `window` calls."""
+
+    def __init__(self, window=500):
+        self._recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds, ok=True):
+        with self._lock:
+            self.calls += 1
+            self.errors += 0 if ok else 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+            self._recent.append(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            recent = sorted(self._recent)
+            def pct(p):
+                return round(recent[min(len(recent) - 1, int(p * len(recent)))] * 1000, 1) if recent else None
+            return {
+                'calls': self.calls,
+                'errors': self.errors,
+                'avg_ms': round(self.total_seconds / self.calls * 1000, 1) if self.calls else None,
+                'p50_ms': pct(0.50),
+                'p95_ms': pct(0.95),
+                'max_ms': round(self.max_seconds * 1000, 1),
+            }
+
+
+def _crypto_base(symbol):
+    return symbol[:-3] if len(symbol) > 3 and symbol.endswith('USD') else None
+
+
+class AlphaVantageClient:
+    """
+    The one shared Alpha Vantage client for the process. Calls go through a
+    pooled keep-alive session, a token bucket shared by all threads and a
+    circuit breaker; when the upstream is rate limiting or down, quotes fail
+    fast and fall back to the last value we saw for the symbol.
+    """
+
+    def __init__(self, api_key, calls_per_minute=5, burst=5, max_wait=2.0, timeout=10.0, pool_size=10,
+                 failure_threshold=5, reset_timeout=60.0, session=None):
+        self.api_key = api_key
+        self.timeout = timeout
+        self.max_wait = max_wait
+        self.limiter = TokenBucket(rate=calls_per_minute / 60.0, capacity=burst)
+        self.breaker = CircuitBreaker(failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+        self.latency = LatencyStats()
+        self._last_quotes = {}
+        self._counters = {'rate_limited': 0, 'rejected_open': 0, 'rejected_budget': 0, 'served_last_known': 0}
+        self._lock = threading.Lock()
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+            session.mount('https://', adapter)
+        self.session = session
+
+    @property
+    def configured(self):
+        return bool(self.api_key) and not self.api_key.startswith('YOUR_ALPHA_VANTAGE_API_KEY')
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _call(self, params):
+        if not self.configured:
+            raise MarketDataError("Alpha Vantage API Key not configured.")
+        if not self.breaker.allow():
+            self._count('rejected_open')
+            raise CircuitOpen("Alpha Vantage circuit open; upstream is rate limiting or unavailable.")
+        if not self.limiter.acquire(timeout=self.max_wait):
+            self._count('rejected_budget')
+            self.breaker.release()
+            raise RateLimited("Alpha Vantage call budget exhausted.")
+
+        started = time.perf_counter()
+        try:
+            response = self.session.get(ALPHA_VANTAGE_URL, params={**params, 'apikey': self.api_key}, timeout=self.timeout)
+            response.raise_for_status()
+            payload = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self.latency.record(time.perf_counter() - started, ok=False)
+            self.breaker.record_failure()
+            raise MarketDataError(f"Alpha Vantage request failed: {str(e)}") from e
+        self.latency.record(time.perf_counter() - started)
+
+        if 'Note' in payload or 'Information' in payload:
+            # "Thank you for using Alpha Vantage! Our standard API call frequency is ..."
+            self._count('rate_limited')
+            self.breaker.trip()
+            raise RateLimited(payload.get('Note') or payload.get('Information'))
+        self.breaker.record_success()
+        if 'Error Message' in payload:
+            raise MarketDataError(payload['Error Message'])
+        return payload
+
+    def get_quote(self, asset):
+        """Current price as a Decimal; the last known price if the upstream can't answer; None if neither."""
+        quote = self.fetch_quote(asset)
+        return quote.price if quote else None
+
+    def fetch_quote(self, asset):
+        """
+        A Quote fetched now; the last known Quote (with its original as_of, and
+        stale=True) if the upstream can't answer; None if neither.
+        """
+        asset_type = asset.asset_type.lower()
+        try:
+            if asset_type == 'stock':
+                payload = self._call({'function': 'GLOBAL_QUOTE', 'symbol': asset.symbol})
+                price_str = payload.get('Global Quote', {}).get('05. price')
+            elif asset_type == 'crypto' and _crypto_base(asset.symbol):
+                payload = self._call({'function': 'CURRENCY_EXCHANGE_RATE', 'from_currency': _crypto_base(asset.symbol), 'to_currency': 'USD'})
+                price_str = payload.get('Realtime Currency Exchange Rate', {}).get('5. Exchange Rate')
+            else:
+                logger.warning(f"Unsupported asset for price fetching: {asset.symbol} ({asset.asset_type})")
+                return None
+            if not price_str:
+                logger.warning(f"Price not found for {asset.symbol} via Alpha Vantage. AV Data: {payload}")
+                return None
+            price = Decimal(price_str)
+        except MarketDataError as e:
+            last_known = self._last_quotes.get(asset.symbol)
+            if last_known is not None:
+                self._count('served_last_known')
+                logger.warning(f"Serving last known price for {asset.symbol} (as of {last_known.as_of.isoformat()}): {str(e)}")
+                return last_known._replace(stale=True)
+            logger.error(f"Error fetching price for {asset.symbol}: {str(e)}")
+            return None
+        except ArithmeticError as e:
+            logger.error(f"Alpha Vantage data error for {asset.symbol}: {str(e)}")
+            return None
+        quote = self._last_quotes[asset.symbol] = Quote(price, datetime.now(timezone.utc), False)
+        return quote
+
+    def get_bars(self, asset, interval, outputsize):
+        """
+        OHLC bars for HistoryStore: [(datetime, open, high, low, close, volume), ...].
+        Raises MarketDataError when the upstream can't answer.
+        """
+        asset_type = asset.asset_type.lower()
+        if asset_type == 'stock':
+            if interval == '30min':
+                params, key = {'function': 'TIME_SERIES_INTRADAY', 'interval': '30min', 'outputsize': outputsize}, 'Time Series (30min)'
+            elif interval == 'daily':
+                params, key = {'function': 'TIME_SERIES_DAILY', 'outputsize': outputsize}, 'Time Series (Daily)'
+            else:
+                params, key = {'function': 'TIME_SERIES_WEEKLY'}, 'Weekly Time Series'
+            params['symbol'] = asset.symbol
+        elif asset_type == 'crypto':
+            # Only daily history is available for crypto; outputsize doesn't apply
+            params = {'function': 'DIGITAL_CURRENCY_DAILY', 'symbol': _crypto_base(asset.symbol) or asset.symbol, 'market': 'USD'}
+            key = 'Time Series (Digital Currency Daily)'
+        else:
+            raise MarketDataError(f"Unsupported asset type for history: {asset.asset_type}")
+        series = self._call(params).get(key, {})
+
+        def field(values, n, name):
+            # Crypto payloads use e.g. '4a. close (USD)' where stocks use '4. close'
+            value = values.get(f'{n}. {name}', values.get(f'{n}a. {name} (USD)'))
+            return Decimal(value) if value is not None else None
+
+        bars = []
+        for date_str, values in series.items():
+            fmt = '%Y-%m-%d %H:%M:%S' if len(date_str) > 10 else '%Y-%m-%d'
+            bar_time = datetime.strptime(date_str, fmt).replace(tzinfo=timezone.utc)
+            close = field(values, 4, 'close')
+            if close is None:
+                continue
+            bars.append((
+                bar_time,
+                field(values, 1, 'open') or close,
+                field(values, 2, 'high') or close,
+                field(values, 3, 'low') or close,
+                close,
+                field(values, 5, 'volume')
+            ))
+        return bars
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        return {
+            'circuit': self.breaker.state,
+            'latency': self.latency.snapshot(),
+            'last_known_symbols': len(self._last_quotes),
+            **counters
+        }
@@ -0,0 +1,154 @@
+import os
+import zlib
+import threading
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+import numpy as np
+
+# Day 0 of every simulated path; paths are generated for HORIZON_DAYS from here
+EPOCH = date(2020, 1, 1)
+HORIZON_DAYS = 8192
+STEPS_PER_DAY = 48 # 30-minute bars
+# Intraday paths kept in memory per symbol: today's and yesterday's (the 1d history spans both)
+INTRADAY_DAYS_KEPT = 2
+
+# Annual drift/volatility, starting price, and how strongly each asset follows its type's common factor
+TYPE_PARAMS = {
+    'stock': {'mu': 0.07, 'sigma': 0.25, 'beta': 0.6, 's0': 150.75},
+    'crypto': {'mu': 0.15, 'sigma': 0.70, 'beta': 0.8, 's0': 2500.50},
+}
+DEFAULT_PARAMS = {'mu': 0.05, 'sigma': 0.20, 'beta': 0.5, 's0': 100.00}
+# Correlation between the stock and crypto factors (both load on one global factor)
+GLOBAL_FACTOR_WEIGHT = 0.3
+
+
+def _stream_id(name):
+    return zlib.crc32(name.encode('utf-8'))
+
+
+class MarketSimulator:
+    """
+    Seeded, correlated geometric Brownian motion for every asset.
+
+    Each asset's daily shocks mix a global factor, a per-asset-type factor and
+    an idiosyncratic term, each drawn from its own seeded stream: a symbol's
+    path only depends on (seed, symbol, asset type), so adding assets never
+    changes existing ones. Intraday 30-minute paths are Brownian bridges
+    between consecutive daily closes, generated once per (symbol, day), so
+    quotes and history are views of the same path and runs are reproducible;
+    only the latest two days per symbol are kept in memory (all that quotes
+    and the 1d history read), older ones are regenerated if asked for.
+    With cache_dir set, paths are written as .npy files and memory-mapped, so
+    every worker process shares one copy through the page cache.
+    """
+
+    def __init__(self, seed=42, cache_dir=None):
+        self.seed = seed
+        self.cache_dir = cache_dir
+        self._daily = {}
+        self._intraday = {} # symbol -> {day: path}, the latest INTRADAY_DAYS_KEPT days
+        self._lock = threading.Lock()
+
+    def _params(self, asset_type):
+        return TYPE_PARAMS.get((asset_type or '').lower(), DEFAULT_PARAMS)
+
+    def _normals(self, shape, *stream):
+        return np.random.default_rng([self.seed, *stream]).standard_normal(shape)
+
+    def _shocks(self, symbol, asset_type, shape, *stream):
+        """Correlated N(0, 1) shocks for one asset."""
+        beta = self._params(asset_type)['beta']
+        global_factor = self._normals(shape, _stream_id('global'), *stream)
+        type_factor = self._normals(shape, _stream_id(f'type:{asset_type.lower()}'), *stream)
+        factor = np.sqrt(GLOBAL_FACTOR_WEIGHT) * global_factor + np.sqrt(1 - GLOBAL_FACTOR_WEIGHT) * type_factor
+        idiosyncratic = self._normals(shape, _stream_id(f'asset:{symbol}'), *stream)
+        return np.sqrt(beta) * factor + np.sqrt(1 - beta) * idiosyncratic
+
+    def _cached(self, memo, key, filename, build):
+        with self._lock:
+            if key in memo:
+                return memo[key]
+        path = os.path.join(self.cache_dir, str(self.seed), filename) if self.cache_dir else None
+        if path and os.path.exists(path):
+            values = np.load(path, mmap_mode='r')
+        else:
+            values = build()
+            if path:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+                np.save(tmp_path, values)
+                os.replace(tmp_path, path) # atomic, so concurrent workers never read a partial file
+                values = np.load(path, mmap_mode='r')
+        with self._lock:
+            memo[key] = values
+        return values
+
+    def daily_closes(self, symbol, asset_type):
+        """Closing price for every day since EPOCH (index = days since EPOCH)."""
+        def build():
+            p = self._params(asset_type)
+            dt = 1 / 365
+            shocks = self._shocks(symbol, asset_type, HORIZON_DAYS, 0)
+            log_returns = (p['mu'] - 0.5 * p['sigma'] ** 2) * dt + p['sigma'] * np.sqrt(dt) * shocks
+            # Vary the starting price per symbol so assets of one type don't all start alike
+            s0 = p['s0'] * (0.5 + (_stream_id(symbol) % 1000) / 1000)
+            return s0 * np.exp(np.cumsum(log_returns))
+        return self._cached(self._daily, symbol, f'daily-{symbol}.npy', build)
+
+    def intraday_path(self, symbol, asset_type, day):
+        """STEPS_PER_DAY + 1 prices from the previous day's close to this day's close."""
+        def build():
+            closes = self.daily_closes(symbol, asset_type)
+            start = closes[day - 1] if day > 0 else closes[0]
+            end = closes[day]
+            step_sigma = self._params(asset_type)['sigma'] * np.sqrt(1 / 365 / STEPS_PER_DAY)
+            walk = np.concatenate(([0.0], np.cumsum(self._shocks(symbol, asset_type, STEPS_PER_DAY, 1, day) * step_sigma)))
+            t = np.linspace(0.0, 1.0, STEPS_PER_DAY + 1)
+            bridge = walk - t * walk[-1] # pinned to 0 at both ends
+            return np.exp(np.log(start) + t * (np.log(end) - np.log(start)) + bridge)
+        with self._lock:
+            days = self._intraday.setdefault(symbol, {})
+        path = self._cached(days, day, f'{day}/{symbol}.npy', build)
+        with self._lock:
+            newest = max(days)
+            for old_day in [d for d in days if d <= newest - INTRADAY_DAYS_KEPT]:
+                del days[old_day]
+        return path
+
+    @staticmethod
+    def _position(now):
+        day = (now.date() - EPOCH).days
+        if not 0 < day < HORIZON_DAYS:
+            raise ValueError(f"Simulated market only covers {EPOCH} + {HORIZON_DAYS} days")
+        seconds = now.hour * 3600 + now.minute * 60 + now.second + now.microsecond / 1e6
+        return day, seconds / 86400 * STEPS_PER_DAY
+
+    def price_at(self, symbol, asset_type, now):
+        day, step = self._position(now)
+        path = self.intraday_path(symbol, asset_type, day)
+        return float(np.interp(step, np.arange(STEPS_PER_DAY + 1), path))
+
+    def quote(self, asset, now):
+        return Decimal(f'{self.price_at(asset.symbol, asset.asset_type, now):.2f}')
+
+    def history(self, asset, range_param, points, now):
+        """[{"date": ..., "price": ...}] for a history range, ending with the current price."""
+        day, step = self._position(now)
+        current = self.price_at(asset.symbol, asset.asset_type, now)
+        if range_param == '1d':
+            # 30-minute bars over the last `points` steps, spanning yesterday's path if needed
+            step_index = int(step)
+            bars = np.concatenate((self.intraday_path(asset.symbol, asset.asset_type, day - 1)[:-1],
+                                   self.intraday_path(asset.symbol, asset.asset_type, day)[:step_index + 1]))
+            prices = np.append(bars[-(points - 1):], current)
+            midnight = datetime(now.year, now.month, now.day, tzinfo=now.tzinfo)
+            times = [midnight + timedelta(minutes=30 * (step_index - i)) for i in range(points - 2, -1, -1)] + [now]
+            labels = [t.strftime('%H:%M') for t in times]
+        else:
+            stride = 7 if range_param == '3y' else 1
+            closes = self.daily_closes(asset.symbol, asset.asset_type)
+            days = np.clip(day - stride * np.arange(points - 1, 0, -1), 0, None)
+            prices = np.append(closes[days], current)
+            labels = [(EPOCH + timedelta(days=int(d))).strftime('%Y-%m-%d') for d in days] + [now.strftime('%Y-%m-%d')]
+        return [{"date": label, "price": round(float(price), 2)} for label, price in zip(labels, prices)]
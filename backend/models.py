@@ -17,6 +17,7 @@ class User(db.Model):
     education_progress = db.Column(db.JSON, nullable=True)
     education_quiz = db.Column(db.JSON, nullable=True)
     is_admin = db.Column(db.Boolean, default=False, nullable=False) # Admin rights
+    cohort = db.Column(db.String(50), nullable=True, index=True) # Competition group, ranked separately on the leaderboard
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -46,6 +47,10 @@ class EducationalContent(db.Model):
     author = db.relationship('User', backref=db.backref('educational_contents', lazy=True))
     module = db.relationship('Module', back_populates='lessons')
 
+    __table_args__ = (
+        db.Index('ix_educational_content_created_at', 'created_at'), # GET /content, newest first
+    )
+
     def __repr__(self):
         return f'<EducationalContent {self.id}: {self.title[:30]}...>'
 
@@ -86,13 +91,47 @@ class Asset(db.Model):
             'asset_type': self.asset_type
         }
 
+class AssetPrice(db.Model):
+    __tablename__ = 'asset_prices'
+
+    # Latest quote per asset, written by the background price refresher (flask refresh-prices)
+    asset_id = db.Column(db.Integer, db.ForeignKey('assets.id', ondelete='CASCADE'), primary_key=True)
+    price = db.Column(db.Numeric(18, 8), nullable=False)
+    fetched_at = db.Column(db.TIMESTAMP(timezone=True), nullable=False)
+
+    def __repr__(self):
+        return f'<AssetPrice asset_id {self.asset_id}: {self.price} at {self.fetched_at}>'
+
+    def to_dict(self):
+        return {
+            'asset_id': self.asset_id,
+            'price': str(self.price),
+            'fetched_at': self.fetched_at.isoformat() if self.fetched_at else None
+        }
+
+class PriceHistory(db.Model):
+    __tablename__ = 'price_history'
+
+    # OHLC bars, backfilled incrementally from Alpha Vantage. interval: '30min', 'daily', 'weekly'
+    asset_id = db.Column(db.Integer, db.ForeignKey('assets.id', ondelete='CASCADE'), primary_key=True)
+    interval = db.Column(db.String(10), primary_key=True)
+    timestamp = db.Column(db.TIMESTAMP(timezone=True), primary_key=True)
+    open = db.Column(db.Numeric(18, 8), nullable=False)
+    high = db.Column(db.Numeric(18, 8), nullable=False)
+    low = db.Column(db.Numeric(18, 8), nullable=False)
+    close = db.Column(db.Numeric(18, 8), nullable=False)
+    volume = db.Column(db.Numeric(28, 8), nullable=True)
+
+    def __repr__(self):
+        return f'<PriceHistory asset_id {self.asset_id} {self.interval} {self.timestamp}: {self.close}>'
+
 class Trade(db.Model):
     __tablename__ = 'trades'
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     asset_id = db.Column(db.Integer, db.ForeignKey('assets.id', ondelete='RESTRICT'), nullable=False)
-    # 'market_buy', 'market_sell', potentially 'limit_buy', 'limit_sell' in future
+    # 'market_buy', 'market_sell', or the resting order type that triggered it ('limit_buy', 'stop_sell', ...)
     order_type = db.Column(db.String(20), nullable=False)
     # Using Numeric for precision, especially with crypto
     quantity = db.Column(db.Numeric(18, 8), nullable=False)
@@ -102,6 +141,12 @@ class Trade(db.Model):
     user = db.relationship('User', backref=db.backref('trades', lazy='dynamic'))
     asset = db.relationship('Asset', backref=db.backref('trades', lazy='dynamic'))
 
+    __table_args__ = (
+        # A user's trades in (timestamp, id) order: /trades, keyset pages and exports, with and without an asset filter
+        db.Index('ix_trades_user_timestamp', 'user_id', 'timestamp', 'id'),
+        db.Index('ix_trades_user_asset_timestamp', 'user_id', 'asset_id', 'timestamp', 'id'),
+    )
+
     def __repr__(self):
         return f'<Trade {self.id}: {self.order_type} {self.quantity} of asset_id {self.asset_id} by user_id {self.user_id}>'
 
@@ -117,6 +162,50 @@ class Trade(db.Model):
             'timestamp': self.timestamp.isoformat() if self.timestamp else None
         }
 
+class OpenOrder(db.Model):
+    __tablename__ = 'open_orders'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    asset_id = db.Column(db.Integer, db.ForeignKey('assets.id', ondelete='RESTRICT'), nullable=False)
+    # 'limit_buy', 'limit_sell', 'stop_buy', 'stop_sell'
+    order_type = db.Column(db.String(20), nullable=False)
+    quantity = db.Column(db.Numeric(18, 8), nullable=False)
+    # Limit price, or stop price for stop orders
+    trigger_price = db.Column(db.Numeric(18, 8), nullable=False)
+    # 'open', 'filled', 'cancelled', 'rejected' (triggered but funds/holdings were insufficient)
+    status = db.Column(db.String(20), nullable=False, default='open')
+    reason = db.Column(db.String(255), nullable=True)
+    trade_id = db.Column(db.Integer, db.ForeignKey('trades.id', ondelete='SET NULL'), nullable=True)
+    created_at = db.Column(db.TIMESTAMP(timezone=True), server_default=db.func.now())
+    closed_at = db.Column(db.TIMESTAMP(timezone=True), nullable=True)
+
+    asset = db.relationship('Asset')
+
+    __table_args__ = (
+        db.Index('ix_open_orders_status_id', 'status', 'id'),
+        db.Index('ix_open_orders_user_id', 'user_id'),
+    )
+
+    def __repr__(self):
+        return f'<OpenOrder {self.id}: {self.order_type} {self.quantity} of asset_id {self.asset_id} at {self.trigger_price} ({self.status})>'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'asset_id': self.asset_id,
+            'asset_symbol': self.asset.symbol if self.asset else None,
+            'order_type': self.order_type,
+            'quantity': str(self.quantity),
+            'trigger_price': str(self.trigger_price),
+            'status': self.status,
+            'reason': self.reason,
+            'trade_id': self.trade_id,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'closed_at': self.closed_at.isoformat() if self.closed_at else None
+        }
+
 class PortfolioHolding(db.Model):
     __tablename__ = 'portfolio_holdings'
 
@@ -130,6 +219,10 @@ class PortfolioHolding(db.Model):
     user = db.relationship('User', backref=db.backref('portfolio_holdings', lazy='dynamic'))
     asset = db.relationship('Asset', backref=db.backref('portfolio_holdings', lazy='dynamic'))
 
+    __table_args__ = (
+        db.Index('ix_portfolio_holdings_asset_id', 'asset_id'), # Holders of an asset (price refresh priority, leaderboard)
+    )
+
     def __repr__(self):
         return f'<PortfolioHolding: User {self.user_id} owns {self.quantity} of Asset {self.asset_id}>'
 
@@ -143,6 +236,46 @@ class PortfolioHolding(db.Model):
             'average_purchase_price': str(self.average_purchase_price) # Convert Decimal
         }
 
+class PortfolioSnapshot(db.Model):
+    __tablename__ = 'portfolio_snapshots'
+
+    # Account value over time, written by `flask snapshot-portfolios`; the primary key serves range reads per user
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    taken_at = db.Column(db.TIMESTAMP(timezone=True), primary_key=True)
+    cash = db.Column(db.Numeric(18, 2), nullable=False)
+    holdings_value = db.Column(db.Numeric(18, 2), nullable=False)
+    total_value = db.Column(db.Numeric(18, 2), nullable=False)
+    # Newest trade included in this valuation, so the job can tell which users traded since
+    last_trade_id = db.Column(db.Integer, nullable=True)
+
+    def __repr__(self):
+        return f'<PortfolioSnapshot user_id {self.user_id} at {self.taken_at}: {self.total_value}>'
+
+    def to_dict(self):
+        return {
+            'date': self.taken_at.isoformat() if self.taken_at else None,
+            'cash': str(self.cash),
+            'holdings_value': str(self.holdings_value),
+            'total_value': str(self.total_value)
+        }
+
+class RevokedToken(db.Model):
+    __tablename__ = 'revoked_tokens'
+
+    # Logged-out / revoked JWTs by their jti; rows can be pruned once expires_at has passed
+    jti = db.Column(db.String(36), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    token_type = db.Column(db.String(10), nullable=False) # 'access' or 'refresh'
+    expires_at = db.Column(db.TIMESTAMP(timezone=True), nullable=False)
+    revoked_at = db.Column(db.TIMESTAMP(timezone=True), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_revoked_tokens_revoked_at', 'revoked_at'), # Workers sync recent revocations
+    )
+
+    def __repr__(self):
+        return f'<RevokedToken {self.token_type} {self.jti} of user {self.user_id}>'
+
 class News(db.Model):
     __tablename__ = 'news'
     id = db.Column(db.Integer, primary_key=True)
@@ -151,6 +284,10 @@ class News(db.Model):
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.TIMESTAMP(timezone=True), server_default=db.func.now())
 
+    __table_args__ = (
+        db.Index('ix_news_created_at', 'created_at'), # /admin/news, newest first
+    )
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -165,7 +302,7 @@ class Quiz(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), nullable=False)
     description = db.Column(db.Text, nullable=True)
-    lesson_id = db.Column(db.Integer, db.ForeignKey('educational_content.id', ondelete='CASCADE'), nullable=True)
+    lesson_id = db.Column(db.Integer, db.ForeignKey('educational_content.id', ondelete='CASCADE'), nullable=True, index=True)
     created_at = db.Column(db.TIMESTAMP(timezone=True), server_default=db.func.now())
     updated_at = db.Column(db.TIMESTAMP(timezone=True), server_default=db.func.now(), onupdate=db.func.now())
 
@@ -188,7 +325,7 @@ class Quiz(db.Model):
 class QuizQuestion(db.Model):
     __tablename__ = 'quiz_questions'
     id = db.Column(db.Integer, primary_key=True)
-    quiz_id = db.Column(db.Integer, db.ForeignKey('quizzes.id', ondelete='CASCADE'), nullable=False)
+    quiz_id = db.Column(db.Integer, db.ForeignKey('quizzes.id', ondelete='CASCADE'), nullable=False, index=True)
     question_text = db.Column(db.Text, nullable=False)
     choices = db.Column(db.JSON, nullable=False)  # List of choices
     correct_answer = db.Column(db.String(255), nullable=False)  # Could be index or value
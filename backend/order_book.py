@@ -0,0 +1,223 @@
+import heapq
+import itertools
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+from models import db, OpenOrder
+from orders import OrderRejected, lock_user_row, execute_market_order
+
+logger = logging.getLogger(__name__)
+
+# Orders are looked up with this much overlap, so clock skew between workers can't hide a cancellation, and an
+# order whose (lower) id committed after a higher one was synced is still picked up
+SYNC_OVERLAP = timedelta(seconds=60)
+# Every open order is re-read this often, catching anything that committed later than the overlap allows
+FULL_RESCAN_INTERVAL = timedelta(minutes=10)
+
+# Resting order types, the market order each one becomes when triggered, and
+# whether it triggers when the price falls to (<=) or rises to (>=) its trigger price
+RESTING_ORDER_TYPES = {
+    'limit_buy': ('market_buy', 'falls'),
+    'limit_sell': ('market_sell', 'rises'),
+    'stop_buy': ('market_buy', 'rises'),
+    'stop_sell': ('market_sell', 'falls'),
+}
+
+
+class AssetBook:
+    """
+    Resting orders for one asset, in two heaps keyed by trigger price: orders
+    that fire when the price falls to their trigger (limit buys, stop sells;
+    highest trigger on top) and orders that fire when it rises to it (limit
+    sells, stop buys; lowest on top). A tick only pops the orders that cross,
+    O(log n) each; ties fill in arrival order.
+    """
+
+    def __init__(self):
+        self._falls = [] # (-trigger, seq, order_id)
+        self._rises = [] # (trigger, seq, order_id)
+        self.dead = 0 # entries of cancelled orders still in the heaps
+
+    def __len__(self):
+        return len(self._falls) + len(self._rises)
+
+    def compact(self, live):
+        """Rebuilds both heaps without the entries whose ids aren't in `live`."""
+        self._falls = [entry for entry in self._falls if entry[2] in live]
+        self._rises = [entry for entry in self._rises if entry[2] in live]
+        heapq.heapify(self._falls)
+        heapq.heapify(self._rises)
+        self.dead = 0
+
+    def push(self, order_id, direction, trigger_price, seq):
+        if direction == 'falls':
+            heapq.heappush(self._falls, (-trigger_price, seq, order_id))
+        else:
+            heapq.heappush(self._rises, (trigger_price, seq, order_id))
+
+    def pop_crossing(self, price):
+        """Removes and returns the ids of every order triggered at `price` (may include cancelled ids)."""
+        crossed = []
+        while self._falls and -self._falls[0][0] >= price:
+            crossed.append(heapq.heappop(self._falls))
+        while self._rises and self._rises[0][0] <= price:
+            crossed.append(heapq.heappop(self._rises))
+        crossed.sort(key=lambda entry: entry[1])
+        return [order_id for _, _, order_id in crossed]
+
+
+class OrderBook:
+    """
+    Per-asset in-memory books of open orders. Cancelled orders are deleted
+    lazily: they are dropped from the live set immediately and skipped when
+    they surface at the top of a heap, so cancel is O(1). A book whose dead
+    entries outnumber its live ones is compacted, so heaps don't grow with
+    cancellations.
+    """
+
+    def __init__(self):
+        self._books = {} # asset_id -> AssetBook
+        self._live = {} # order id still resting -> (asset_id, order_type, trigger_price)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._live)
+
+    def add(self, order_id, asset_id, order_type, trigger_price):
+        """Idempotent: an order already resting is left where it is."""
+        direction = RESTING_ORDER_TYPES[order_type][1]
+        with self._lock:
+            if order_id in self._live:
+                return
+            self._live[order_id] = (asset_id, order_type, trigger_price)
+            self._books.setdefault(asset_id, AssetBook()).push(order_id, direction, trigger_price, next(self._seq))
+
+    def discard(self, order_id):
+        with self._lock:
+            entry = self._live.pop(order_id, None)
+            if entry is None:
+                return
+            book = self._books[entry[0]]
+            book.dead += 1
+            if book.dead > len(book) - book.dead:
+                book.compact(self._live)
+                if not book:
+                    del self._books[entry[0]]
+
+    def take_crossing(self, asset_id, price):
+        """
+        (order_id, order_type, trigger_price) of the live orders triggered by a
+        tick at `price`, oldest first; they leave the book (add() puts one back).
+        """
+        with self._lock:
+            book = self._books.get(asset_id)
+            if book is None:
+                return []
+            crossed = book.pop_crossing(price)
+            triggered = [(order_id,) + self._live.pop(order_id)[1:] for order_id in crossed if order_id in self._live]
+            book.dead -= len(crossed) - len(triggered)
+            if not book:
+                del self._books[asset_id]
+            return triggered
+
+    def crossing(self, asset_id, price):
+        """Ids of the live orders triggered by a tick at `price`, oldest first; they leave the book."""
+        return [order_id for order_id, _, _ in self.take_crossing(asset_id, price)]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'open_orders': len(self._live),
+                'heap_entries': sum(len(book) for book in self._books.values()),
+                'assets': len(self._books),
+            }
+
+
+class OrderMatcher:
+    """
+    Keeps an OrderBook in sync with the open_orders table and fills triggered
+    orders on every price tick. Orders are placed and cancelled by the web
+    workers, so each tick first picks up orders created since the last sync
+    and drops the ones closed elsewhere. A fill claims its row with a guarded
+    UPDATE (status 'open' -> 'filled') before touching cash or holdings, so
+    an order cancelled in the meantime, or claimed by another matcher, is
+    never filled twice.
+    """
+
+    def __init__(self, book=None, clock=lambda: datetime.now(timezone.utc), full_rescan_interval=FULL_RESCAN_INTERVAL):
+        self.book = book or OrderBook()
+        self._clock = clock
+        self.full_rescan_interval = full_rescan_interval
+        self._last_order_id = 0
+        self._synced_at = None
+        self._rescanned_at = None
+        self.fills = 0
+        self.rejections = 0
+
+    def sync(self):
+        now = self._clock()
+        query = db.session.query(OpenOrder.id, OpenOrder.asset_id, OpenOrder.order_type, OpenOrder.trigger_price)
+        query = query.filter(OpenOrder.status == 'open')
+        if self._rescanned_at is None or now - self._rescanned_at >= self.full_rescan_interval:
+            self._rescanned_at = now
+        else:
+            # Ids are assigned at insert but seen at commit, so a lower id can show up after a higher one was synced
+            query = query.filter(db.or_(OpenOrder.id > self._last_order_id, OpenOrder.created_at >= self._synced_at - SYNC_OVERLAP))
+        for row in query.order_by(OpenOrder.id):
+            self.book.add(row.id, row.asset_id, row.order_type, row.trigger_price)
+            self._last_order_id = max(self._last_order_id, row.id)
+        if self._synced_at is not None:
+            closed = db.session.query(OpenOrder.id).filter(OpenOrder.status != 'open', OpenOrder.closed_at >= self._synced_at - SYNC_OVERLAP)
+            for (order_id,) in closed:
+                self.book.discard(order_id)
+        self._synced_at = now
+
+    def on_price(self, asset, price):
+        """Price tick hook (PriceRefreshScheduler on_price). Returns the number of orders filled."""
+        self.sync()
+        filled = 0
+        for order_id, order_type, trigger_price in self.book.take_crossing(asset.id, price):
+            try:
+                if self.fill(order_id, asset, price):
+                    filled += 1
+            except Exception as e:
+                # Nothing was committed: the row is still open, so it goes back in the book for the next tick
+                db.session.rollback()
+                self.book.add(order_id, asset.id, order_type, trigger_price)
+                logger.error(f"Filling order {order_id} failed: {str(e)}")
+        return filled
+
+    def fill(self, order_id, asset, price):
+        orders = OpenOrder.__table__
+        order = db.session.execute(
+            db.update(orders)
+            .where(orders.c.id == order_id, orders.c.status == 'open')
+            .values(status='filled', closed_at=self._clock())
+            .returning(orders.c.user_id, orders.c.order_type, orders.c.quantity)
+        ).first()
+        if order is None:
+            db.session.rollback()
+            return False
+        try:
+            lock_user_row(order.user_id)
+            result = execute_market_order(order.user_id, asset, RESTING_ORDER_TYPES[order.order_type][0],
+                                          order.quantity, price, trade_order_type=order.order_type)
+        except OrderRejected as e:
+            db.session.rollback()
+            db.session.execute(
+                db.update(orders).where(orders.c.id == order_id, orders.c.status == 'open')
+                .values(status='rejected', closed_at=self._clock(), reason=e.message)
+            )
+            db.session.commit()
+            self.rejections += 1
+            logger.info(f"Order {order_id} rejected at {price}: {e.message}")
+            return False
+        db.session.execute(db.update(orders).where(orders.c.id == order_id).values(trade_id=result['trade']['id']))
+        db.session.commit()
+        self.fills += 1
+        return True
+
+    def stats(self):
+        return {**self.book.stats(), 'fills': self.fills, 'rejections': self.rejections}
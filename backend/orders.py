@@ -0,0 +1,128 @@
+from decimal import Decimal
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, User, Trade, PortfolioHolding
+
+EIGHT_PLACES = Decimal('0.00000001')
+
+
+class OrderRejected(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def _dialect():
+    return db.session.get_bind().dialect.name
+
+
+def lock_user_row(user_id):
+    """
+    Serializes order execution per user for the rest of the transaction.
+    Postgres: SELECT ... FOR UPDATE on the users row. SQLite has no row locks,
+    so a no-op UPDATE takes the database write lock instead (pysqlite only
+    opens the transaction at the first write, so nothing was read under a
+    weaker lock before this point).
+    """
+    users = User.__table__
+    if _dialect() == 'postgresql':
+        found = db.session.execute(db.select(users.c.id).where(users.c.id == user_id).with_for_update()).first()
+    else:
+        found = db.session.execute(
+            db.update(users).where(users.c.id == user_id).values(cash_balance=users.c.cash_balance)
+        ).rowcount
+    if not found:
+        raise OrderRejected("User not found for ID in token", 404)
+
+
+def _upsert_holding(user_id, asset_id, quantity, price):
+    holdings = PortfolioHolding.__table__
+    insert = postgresql.insert if _dialect() == 'postgresql' else sqlite.insert
+    stmt = insert(holdings).values(user_id=user_id, asset_id=asset_id, quantity=quantity, average_purchase_price=price)
+    new_quantity = holdings.c.quantity + stmt.excluded.quantity
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[holdings.c.user_id, holdings.c.asset_id],
+        set_={
+            'quantity': new_quantity,
+            'average_purchase_price': (holdings.c.average_purchase_price * holdings.c.quantity
+                                       + stmt.excluded.quantity * stmt.excluded.average_purchase_price) / new_quantity,
+        }
+    ).returning(holdings.c.quantity, holdings.c.average_purchase_price)
+    return db.session.execute(stmt).first()
+
+
+def execute_market_order(user_id, asset, order_type, quantity, price, trade_order_type=None):
+    """
+    Applies one fill inside the current transaction; the caller holds the user
+    row lock (lock_user_row) and commits. Cash and holding changes are guarded
+    UPDATEs, so a failed check changes nothing and raises OrderRejected.
+    trade_order_type is what gets recorded on the trade (e.g. 'limit_buy');
+    order_type ('market_buy'/'market_sell') decides the accounting.
+    Returns {'trade': ..., 'holding': ... or None, 'cash_balance': ...}, built
+    from RETURNING values, with no re-fetch after commit.
+    """
+    users = User.__table__
+    holdings = PortfolioHolding.__table__
+    trades = Trade.__table__
+    amount = quantity * price
+
+    if order_type == 'market_buy':
+        cash = db.session.execute(
+            db.update(users)
+            .where(users.c.id == user_id, users.c.cash_balance >= amount)
+            .values(cash_balance=users.c.cash_balance - amount)
+            .returning(users.c.cash_balance)
+        ).scalar()
+        if cash is None:
+            raise OrderRejected("Insufficient funds to complete this purchase.")
+        holding = _upsert_holding(user_id, asset.id, quantity, price)
+    elif order_type == 'market_sell':
+        holding = db.session.execute(
+            db.update(holdings)
+            .where(holdings.c.user_id == user_id, holdings.c.asset_id == asset.id, holdings.c.quantity >= quantity)
+            .values(quantity=holdings.c.quantity - quantity)
+            .returning(holdings.c.quantity, holdings.c.average_purchase_price)
+        ).first()
+        if holding is None:
+            raise OrderRejected("Insufficient holdings to sell")
+        cash = db.session.execute(
+            db.update(users).where(users.c.id == user_id)
+            .values(cash_balance=users.c.cash_balance + amount)
+            .returning(users.c.cash_balance)
+        ).scalar()
+        if holding.quantity == 0:
+            db.session.execute(db.delete(holdings).where(holdings.c.user_id == user_id, holdings.c.asset_id == asset.id))
+            holding = None
+    else:
+        raise OrderRejected("Invalid order_type")
+
+    trade = db.session.execute(
+        db.insert(trades)
+        .values(user_id=user_id, asset_id=asset.id, order_type=trade_order_type or order_type,
+                quantity=quantity, price_at_execution=price)
+        .returning(trades.c.id, trades.c.timestamp)
+    ).first()
+
+    return {
+        'trade': {
+            'id': trade.id,
+            'user_id': user_id,
+            'asset_id': asset.id,
+            'asset_symbol': asset.symbol,
+            'order_type': trade_order_type or order_type,
+            'quantity': str(Decimal(quantity).quantize(EIGHT_PLACES)),
+            'price_at_execution': str(Decimal(price).quantize(EIGHT_PLACES)),
+            'timestamp': trade.timestamp.isoformat() if trade.timestamp else None
+        },
+        'holding': {
+            'user_id': user_id,
+            'asset_id': asset.id,
+            'asset_symbol': asset.symbol,
+            'asset_name': asset.name,
+            'quantity': str(holding.quantity),
+            'average_purchase_price': str(holding.average_purchase_price)
+        } if holding is not None else None,
+        'cash_balance': cash
+    }
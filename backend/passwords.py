@@ -0,0 +1,106 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashingUnavailable(Exception):
+    """The hashing pool is saturated or too slow; the request should be retried later (503)."""
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+def _hash(password, method):
+    return generate_password_hash(password, method=method)
+
+def _verify(password_hash, password):
+    return check_password_hash(password_hash, password)
+
+
+class PasswordHasher:
+    """
+    Password hashing and verification off the request threads, in a small
+    process pool (scrypt is memory-hard and CPU-bound, so threads would only
+    contend for the GIL and the worker's RAM).
+
+    At most workers + max_pending calls are admitted at once; a caller beyond
+    that fails immediately with HashingUnavailable instead of queueing behind
+    a login burst, and an admitted call that isn't done within `timeout`
+    seconds fails the same way. workers=0 hashes inline (tests, one-off scripts).
+    `method` is any werkzeug method string ('scrypt', 'scrypt:16384:8:1',
+    'pbkdf2:sha256:600000', ...); stored hashes made with other parameters
+    are reported by needs_rehash().
+    """
+
+    def __init__(self, method='scrypt', workers=2, max_pending=16, timeout=5.0):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers + max_pending) if workers else None
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._method_prefix = None
+        self._stats_lock = threading.Lock()
+        self._stats = {'hashed': 0, 'verified': 0, 'rejected_busy': 0, 'timed_out': 0}
+
+    def _pool(self):
+        with self._executor_lock:
+            if self._executor is None:
+                # spawn: forking a threaded server can copy held locks into the children
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _count(self, key):
+        with self._stats_lock:
+            self._stats[key] += 1
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            self._count('rejected_busy')
+            raise HashingUnavailable("Too many sign-ins in progress, please retry shortly.")
+        try:
+            future = self._pool().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the work is really over: a hash abandoned after a timeout keeps its process busy
+        # (cancel() only stops one that hasn't started, and then runs this callback at once)
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            future.cancel()
+            self._count('timed_out')
+            raise HashingUnavailable("Password check timed out, please retry shortly.")
+
+    def hash(self, password):
+        password_hash = self._run(_hash, password, self.method)
+        self._count('hashed')
+        return password_hash
+
+    def verify(self, password_hash, password):
+        matches = self._run(_verify, password_hash, password)
+        self._count('verified')
+        return matches
+
+    def needs_rehash(self, password_hash):
+        """True if a stored hash was made with other parameters than `method` (e.g. after a config change)."""
+        if self._method_prefix is None:
+            # werkzeug expands defaults ('scrypt' -> 'scrypt:32768:8:1'), so compare against a real hash's prefix
+            self._method_prefix = generate_password_hash('', method=self.method).split('$', 1)[0]
+        return password_hash.split('$', 1)[0] != self._method_prefix
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats, workers=self.workers, method=self.method)
+
+    def shutdown(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
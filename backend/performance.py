@@ -0,0 +1,142 @@
+import math
+
+import numpy as np
+
+from models import db, Trade, PortfolioSnapshot
+
+# Rows fetched per round trip while streaming a user's trades
+TRADE_STREAM_BATCH = 5000
+# Daily returns per year, used to annualize volatility and Sharpe
+PERIODS_PER_YEAR = 252
+
+
+def load_trade_arrays(user_id):
+    """
+    Streams a user's trades once, oldest first, into column arrays:
+    (trade_id, asset_id, is_buy, quantity, price, timestamp as datetime64[s]).
+    """
+    rows = db.session.execute(
+        db.select(Trade.id, Trade.asset_id, Trade.order_type, Trade.quantity, Trade.price_at_execution, Trade.timestamp)
+        .where(Trade.user_id == user_id)
+        .order_by(Trade.id)
+        .execution_options(yield_per=TRADE_STREAM_BATCH)
+    )
+    ids, asset_ids, is_buy, quantities, prices, timestamps = [], [], [], [], [], []
+    for row in rows:
+        ids.append(row.id)
+        asset_ids.append(row.asset_id)
+        is_buy.append(row.order_type.endswith('_buy'))
+        quantities.append(float(row.quantity))
+        prices.append(float(row.price_at_execution))
+        timestamps.append(row.timestamp.replace(tzinfo=None) if row.timestamp else None)
+    return (
+        np.array(ids, dtype=np.int64),
+        np.array(asset_ids, dtype=np.int64),
+        np.array(is_buy, dtype=bool),
+        np.array(quantities, dtype=np.float64),
+        np.array(prices, dtype=np.float64),
+        np.array(timestamps, dtype='datetime64[s]'),
+    )
+
+
+def fifo_positions(asset_ids, is_buy, quantities, prices, timestamps):
+    """
+    FIFO lots and realized P&L per asset, without walking trades one by one.
+
+    Under FIFO the units sold so far are always the first units ever bought,
+    so the cost of the first q units is the cumulative buy cost interpolated
+    at q on the cumulative buy quantity. Each sell's cost basis is that
+    function's increase over the sell, and the open lots are the buys past
+    the total quantity sold (found with searchsorted).
+    Returns {asset_id: {'realized_pnl', 'open_quantity', 'open_cost', 'lots': [(quantity, price, timestamp), ...]}}.
+    """
+    positions = {}
+    order = np.argsort(asset_ids, kind='stable') # stays in trade order within each asset
+    boundaries = np.flatnonzero(np.diff(asset_ids[order])) + 1
+    for group in np.split(order, boundaries):
+        if not len(group):
+            continue
+        buys = group[is_buy[group]]
+        sells = group[~is_buy[group]]
+        cum_qty = np.concatenate(([0.0], np.cumsum(quantities[buys])))
+        cum_cost = np.concatenate(([0.0], np.cumsum(quantities[buys] * prices[buys])))
+
+        cum_sold = np.concatenate(([0.0], np.cumsum(quantities[sells])))
+        sold_cost = np.diff(np.interp(cum_sold, cum_qty, cum_cost))
+        realized = float(np.sum(quantities[sells] * prices[sells] - sold_cost))
+
+        # Buys whose cumulative quantity reaches past everything sold are (partly) still open
+        total_sold = cum_sold[-1]
+        first_open = int(np.searchsorted(cum_qty[1:], total_sold, side='right'))
+        open_qty = quantities[buys][first_open:].copy()
+        if len(open_qty):
+            open_qty[0] = cum_qty[first_open + 1] - total_sold
+        open_buys = buys[first_open:]
+        keep = open_qty > 1e-12
+        positions[int(asset_ids[group[0]])] = {
+            'realized_pnl': realized,
+            'open_quantity': float(np.sum(open_qty[keep])),
+            'open_cost': float(np.sum(open_qty[keep] * prices[open_buys][keep])),
+            'lots': list(zip(open_qty[keep].tolist(), prices[open_buys][keep].tolist(), timestamps[open_buys][keep].tolist())),
+        }
+    return positions
+
+
+def daily_equity(taken_at, values):
+    """Last snapshot value of each day, oldest first."""
+    if not len(values):
+        return values
+    days = taken_at.astype('datetime64[D]')
+    # np.unique keeps the first occurrence, so look at the series backwards to get each day's last value
+    _, last_from_end = np.unique(days[::-1], return_index=True)
+    return values[len(values) - 1 - last_from_end]
+
+
+def risk_metrics(equity, periods_per_year=PERIODS_PER_YEAR):
+    """Total return, max drawdown, annualized volatility and Sharpe ratio (risk-free rate 0) of an equity series."""
+    metrics = {'periods': int(len(equity)), 'total_return': None, 'max_drawdown': None, 'volatility': None, 'sharpe_ratio': None}
+    if len(equity) < 2:
+        return metrics
+    peaks = np.maximum.accumulate(equity)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        drawdowns = np.where(peaks > 0, 1 - equity / peaks, 0.0)
+        returns = np.diff(equity) / equity[:-1]
+    returns = returns[np.isfinite(returns)]
+    metrics['total_return'] = float(equity[-1] / equity[0] - 1) if equity[0] else None
+    metrics['max_drawdown'] = float(drawdowns.max())
+    if len(returns) >= 2:
+        std = float(returns.std(ddof=1))
+        metrics['volatility'] = std * math.sqrt(periods_per_year)
+        metrics['sharpe_ratio'] = float(returns.mean()) / std * math.sqrt(periods_per_year) if std > 0 else None
+    return metrics
+
+
+def load_equity_series(user_id):
+    rows = db.session.execute(
+        db.select(PortfolioSnapshot.taken_at, PortfolioSnapshot.total_value)
+        .where(PortfolioSnapshot.user_id == user_id)
+        .order_by(PortfolioSnapshot.taken_at)
+    ).all()
+    taken_at = np.array([row.taken_at.replace(tzinfo=None) for row in rows], dtype='datetime64[s]')
+    values = np.array([float(row.total_value) for row in rows], dtype=np.float64)
+    return taken_at, values
+
+
+def performance_version(user_id):
+    """(last trade id, last snapshot time) for a user: memoized results are valid while this is unchanged."""
+    last_trade_id = db.session.execute(db.select(db.func.max(Trade.id)).where(Trade.user_id == user_id)).scalar()
+    last_snapshot = db.session.execute(
+        db.select(db.func.max(PortfolioSnapshot.taken_at)).where(PortfolioSnapshot.user_id == user_id)
+    ).scalar()
+    return last_trade_id, last_snapshot
+
+
+def compute_performance(user_id):
+    """The price-independent part of /portfolio/performance: FIFO positions per asset and equity-curve risk metrics."""
+    _, asset_ids, is_buy, quantities, prices, timestamps = load_trade_arrays(user_id)
+    taken_at, values = load_equity_series(user_id)
+    return {
+        'trade_count': int(len(asset_ids)),
+        'positions': fifo_positions(asset_ids, is_buy, quantities, prices, timestamps),
+        'risk': risk_metrics(daily_equity(taken_at, values)),
+    }
@@ -0,0 +1,107 @@
+import logging
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+from models import db, User, Trade, PortfolioHolding, AssetPrice, PortfolioSnapshot
+
+logger = logging.getLogger(__name__)
+
+# /portfolio/history ranges, in days back from now (None = everything)
+PORTFOLIO_HISTORY_RANGES = {'1w': 7, '1m': 30, '3m': 91, '6m': 182, '1y': 365, 'all': None}
+# Users valued per round of queries/inserts
+SNAPSHOT_CHUNK_SIZE = 500
+TWO_PLACES = Decimal('0.01')
+
+
+def changed_user_ids():
+    """
+    Ids of users whose account value may have moved since their last snapshot:
+    no snapshot yet, a trade newer than the one the snapshot was taken after,
+    or a held asset whose stored price was refreshed after the snapshot.
+    Cash edits made outside of trades (admin set-cash) only show up on a full run.
+    """
+    latest = (
+        db.select(
+            PortfolioSnapshot.user_id,
+            db.func.max(PortfolioSnapshot.taken_at).label('taken_at'),
+            db.func.max(PortfolioSnapshot.last_trade_id).label('last_trade_id')
+        )
+        .group_by(PortfolioSnapshot.user_id)
+        .subquery()
+    )
+    new_trade = db.exists().where(Trade.user_id == User.id, Trade.id > db.func.coalesce(latest.c.last_trade_id, 0))
+    new_price = (
+        db.exists()
+        .where(PortfolioHolding.user_id == User.id, AssetPrice.asset_id == PortfolioHolding.asset_id,
+               AssetPrice.fetched_at > latest.c.taken_at)
+    )
+    query = (
+        db.select(User.id)
+        .outerjoin(latest, latest.c.user_id == User.id)
+        .where(db.or_(latest.c.taken_at.is_(None), new_trade, new_price))
+        .order_by(User.id)
+    )
+    return list(db.session.execute(query).scalars())
+
+
+def value_users(user_ids):
+    """
+    {user_id: (cash, holdings_value, last_trade_id)} from holdings and the stored
+    price snapshots, in three queries. Positions without a stored price are
+    valued at their average purchase price.
+    """
+    cash = dict(db.session.execute(db.select(User.id, User.cash_balance).where(User.id.in_(user_ids))).all())
+    last_trades = dict(db.session.execute(
+        db.select(Trade.user_id, db.func.max(Trade.id)).where(Trade.user_id.in_(user_ids)).group_by(Trade.user_id)
+    ).all())
+    holdings_value = dict.fromkeys(cash, Decimal(0))
+    positions = db.session.execute(
+        db.select(PortfolioHolding.user_id, PortfolioHolding.quantity, PortfolioHolding.average_purchase_price, AssetPrice.price)
+        .outerjoin(AssetPrice, AssetPrice.asset_id == PortfolioHolding.asset_id)
+        .where(PortfolioHolding.user_id.in_(user_ids))
+    )
+    for user_id, quantity, average_purchase_price, price in positions:
+        if user_id in holdings_value:
+            holdings_value[user_id] += quantity * (price if price is not None else average_purchase_price)
+    return {user_id: (cash[user_id], holdings_value[user_id], last_trades.get(user_id)) for user_id in cash}
+
+
+def take_portfolio_snapshots(full=False, now=None):
+    """
+    Writes one portfolio_snapshots row per changed user (every user when `full`)
+    and returns how many were written. Work is done in chunks, so the job's
+    memory use stays flat however many users there are.
+    """
+    now = now or datetime.now(timezone.utc)
+    user_ids = list(db.session.execute(db.select(User.id).order_by(User.id)).scalars()) if full else changed_user_ids()
+    written = 0
+    for start in range(0, len(user_ids), SNAPSHOT_CHUNK_SIZE):
+        values = value_users(user_ids[start:start + SNAPSHOT_CHUNK_SIZE])
+        rows = [
+            {
+                'user_id': user_id,
+                'taken_at': now,
+                'cash': cash.quantize(TWO_PLACES),
+                'holdings_value': holdings_value.quantize(TWO_PLACES),
+                'total_value': (cash + holdings_value).quantize(TWO_PLACES),
+                'last_trade_id': last_trade_id
+            }
+            for user_id, (cash, holdings_value, last_trade_id) in values.items()
+        ]
+        if rows:
+            db.session.execute(db.insert(PortfolioSnapshot), rows)
+            db.session.commit()
+            written += len(rows)
+    return written
+
+
+def portfolio_history_query(user_id, range_param, now=None, query=None):
+    """
+    A user's snapshots for a PORTFOLIO_HISTORY_RANGES key, oldest first (one
+    range scan on the primary key). `query` picks the columns (whole rows by default).
+    """
+    query = (query if query is not None else db.select(PortfolioSnapshot)).where(PortfolioSnapshot.user_id == user_id)
+    days = PORTFOLIO_HISTORY_RANGES[range_param]
+    if days is not None:
+        query = query.where(PortfolioSnapshot.taken_at >= (now or datetime.now(timezone.utc)) - timedelta(days=days))
+    return query.order_by(PortfolioSnapshot.taken_at)
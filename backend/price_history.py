@@ -0,0 +1,111 @@
+import threading
+import time
+import logging
+from datetime import datetime, timezone
+
+from models import db, PriceHistory
+from price_refresh import as_utc
+
+logger = logging.getLogger(__name__)
+
+# range -> (bar interval, number of most recent bars returned)
+HISTORY_RANGES = {
+    '1d': ('30min', 24),
+    '1m': ('daily', 22),
+    '6m': ('daily', 132),
+    'ytd': ('daily', 252),
+    '1y': ('daily', 252),
+    '3y': ('weekly', 156),
+}
+
+INTERVAL_SECONDS = {'30min': 30 * 60, 'daily': 24 * 3600, 'weekly': 7 * 24 * 3600}
+
+# Alpha Vantage 'compact' responses hold the last 100 bars; anything beyond needs 'full'
+COMPACT_BARS = 100
+
+
+class HistoryStore:
+    """
+    Local OHLC store in front of the upstream history API. ensure_fresh()
+    fetches only what is missing (compact when the gap fits in 100 bars) and
+    appends bars newer than the latest stored one; reads are range scans on
+    the (asset_id, interval, timestamp) primary key.
+
+    The latest stored bar may have been fetched while its period was still
+    open (today's daily bar, this week's weekly bar), so every fetch replaces
+    it with what the upstream now returns from its timestamp on. Weekly bars
+    are keyed by the week's latest trading day, so a partial week stored
+    under its Wednesday is dropped when the finished week comes back under
+    its Friday.
+    """
+
+    def __init__(self, fetch_bars, recheck_seconds=900, clock=time.monotonic):
+        # fetch_bars(asset, interval, outputsize) -> [(datetime, open, high, low, close, volume), ...]
+        self.fetch_bars = fetch_bars
+        self.recheck_seconds = recheck_seconds
+        self._clock = clock
+        self._checked_at = {} # (asset_id, interval) -> monotonic time of last upstream check
+        self._lock = threading.Lock()
+
+    def latest_timestamp(self, asset_id, interval):
+        latest = db.session.query(db.func.max(PriceHistory.timestamp)).filter(
+            PriceHistory.asset_id == asset_id, PriceHistory.interval == interval
+        ).scalar()
+        return as_utc(latest)
+
+    def _recently_checked(self, key):
+        with self._lock:
+            checked_at = self._checked_at.get(key)
+            if checked_at is not None and self._clock() - checked_at < self.recheck_seconds:
+                return True
+            self._checked_at[key] = self._clock()
+            return False
+
+    def ensure_fresh(self, asset, interval, needed_bars):
+        """Stores upstream bars from the latest stored one on (replacing it). Returns the number of bars written."""
+        latest = self.latest_timestamp(asset.id, interval)
+        now = datetime.now(timezone.utc)
+        if latest is not None and (now - latest).total_seconds() < INTERVAL_SECONDS[interval]:
+            return 0 # The next bar isn't due yet
+        if self._recently_checked((asset.id, interval)):
+            return 0
+
+        if latest is None:
+            outputsize = 'full' if needed_bars > COMPACT_BARS else 'compact'
+        else:
+            missing_bars = (now - latest).total_seconds() / INTERVAL_SECONDS[interval]
+            outputsize = 'full' if missing_bars > COMPACT_BARS else 'compact'
+
+        bars = self.fetch_bars(asset, interval, outputsize)
+        rows = [
+            {'asset_id': asset.id, 'interval': interval, 'timestamp': ts,
+             'open': o, 'high': h, 'low': l, 'close': c, 'volume': v}
+            for ts, o, h, l, c, v in bars
+            if latest is None or as_utc(ts) >= latest
+        ]
+        if not rows:
+            return 0
+        try:
+            if latest is not None:
+                db.session.execute(db.delete(PriceHistory).where(
+                    PriceHistory.asset_id == asset.id, PriceHistory.interval == interval, PriceHistory.timestamp >= latest
+                ))
+            db.session.execute(db.insert(PriceHistory), rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        logger.info(f"History backfill: stored {len(rows)} {interval} bars for {asset.symbol} ({outputsize})")
+        return len(rows)
+
+    def read_bars(self, asset_id, interval, limit):
+        """The most recent `limit` bars, oldest first."""
+        bars = (
+            PriceHistory.query
+            .filter(PriceHistory.asset_id == asset_id, PriceHistory.interval == interval)
+            .order_by(PriceHistory.timestamp.desc())
+            .limit(limit)
+            .all()
+        )
+        bars.reverse()
+        return bars
@@ -0,0 +1,114 @@
+import time
+import logging
+from datetime import datetime, timezone
+
+from models import db, Asset, AssetPrice, PortfolioHolding
+
+logger = logging.getLogger(__name__)
+
+
+def as_utc(dt):
+    """SQLite hands back naive datetimes; treat them as UTC so comparisons work on every backend."""
+    if dt is None:
+        return None
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def read_price_snapshot(asset_id, max_age_seconds):
+    """Returns the stored price for an asset if it is younger than max_age_seconds, else None."""
+    snapshot = db.session.get(AssetPrice, asset_id)
+    if snapshot is None:
+        return None
+    age = (datetime.now(timezone.utc) - as_utc(snapshot.fetched_at)).total_seconds()
+    if age > max_age_seconds:
+        return None
+    return snapshot.price
+
+
+def read_price_snapshots(asset_ids, max_age_seconds):
+    """Batch version of read_price_snapshot: one query, returns {asset_id: price} for fresh snapshots only."""
+    if not asset_ids:
+        return {}
+    cutoff = datetime.now(timezone.utc).timestamp() - max_age_seconds
+    snapshots = AssetPrice.query.filter(AssetPrice.asset_id.in_(asset_ids)).all()
+    return {s.asset_id: s.price for s in snapshots if as_utc(s.fetched_at).timestamp() >= cutoff}
+
+
+def store_price_snapshot(asset_id, price, fetched_at=None):
+    db.session.merge(AssetPrice(asset_id=asset_id, price=price, fetched_at=fetched_at or datetime.now(timezone.utc)))
+    db.session.commit()
+
+
+class PriceRefreshScheduler:
+    """
+    Walks the Asset table and refreshes each quote into asset_prices, never
+    exceeding calls_per_minute upstream calls. Assets that users hold come
+    first (most holders first), then everything else; within each group the
+    oldest snapshot is refreshed first.
+
+    fetch_quote returns a market_data.Quote or None. Stale quotes (the last
+    known price during an outage) are neither stored nor passed to on_price:
+    the existing snapshot keeps its own fetched_at and ages out, and resting
+    orders don't fill at an old price.
+    """
+
+    def __init__(self, fetch_quote, calls_per_minute, on_price=None, sleep=time.sleep, clock=time.monotonic):
+        if calls_per_minute <= 0:
+            raise ValueError("calls_per_minute must be positive")
+        self.fetch_quote = fetch_quote
+        self.on_price = on_price
+        self.min_interval = 60.0 / calls_per_minute
+        self._sleep = sleep
+        self._clock = clock
+        self._next_call_at = None
+
+    def prioritized_assets(self):
+        holders = db.func.count(PortfolioHolding.user_id)
+        rows = (
+            db.session.query(Asset, holders.label('holders'), AssetPrice.fetched_at)
+            .outerjoin(PortfolioHolding, PortfolioHolding.asset_id == Asset.id)
+            .outerjoin(AssetPrice, AssetPrice.asset_id == Asset.id)
+            .group_by(Asset.id, AssetPrice.fetched_at)
+            .all()
+        )
+        oldest = datetime.min.replace(tzinfo=timezone.utc)
+        rows.sort(key=lambda r: (r.holders == 0, -r.holders, as_utc(r.fetched_at) or oldest))
+        return [r.Asset for r in rows]
+
+    def _wait_for_budget(self):
+        now = self._clock()
+        if self._next_call_at is not None and now < self._next_call_at:
+            self._sleep(self._next_call_at - now)
+            now = self._next_call_at
+        self._next_call_at = now + self.min_interval
+
+    def refresh_asset(self, asset):
+        self._wait_for_budget()
+        quote = self.fetch_quote(asset)
+        if quote is None:
+            logger.warning(f"Price refresh: no price for {asset.symbol}")
+            return None
+        if quote.stale:
+            logger.warning(f"Price refresh: upstream unavailable for {asset.symbol}, keeping the snapshot as of {quote.as_of.isoformat()}")
+            return None
+        store_price_snapshot(asset.id, quote.price, fetched_at=quote.as_of)
+        if self.on_price:
+            self.on_price(asset, quote.price)
+        return quote.price
+
+    def run_cycle(self):
+        refreshed = 0
+        for asset in self.prioritized_assets():
+            try:
+                if self.refresh_asset(asset) is not None:
+                    refreshed += 1
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Price refresh failed for {asset.symbol}: {str(e)}")
+        return refreshed
+
+    def run_forever(self):
+        while True:
+            if not self.run_cycle():
+                # Nothing to refresh (empty asset table or upstream down): don't spin
+                self._sleep(self.min_interval)
@@ -0,0 +1,131 @@
+import threading
+import time
+import logging
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class TooManyConnections(Exception):
+    pass
+
+
+class Subscription:
+    """
+    One connected client. Holds at most one pending tick per symbol: a slow
+    reader only ever gets the newest price, so memory stays bounded and the
+    pollers never block on it (superseded ticks are counted in `dropped`).
+    """
+
+    def __init__(self, user_id, symbols):
+        self.user_id = user_id
+        self.symbols = symbols
+        self.dropped = 0
+        self.closed = False
+        self._pending = {}
+        self._cond = threading.Condition()
+
+    def push(self, tick):
+        with self._cond:
+            if tick['symbol'] in self._pending:
+                self.dropped += 1
+            self._pending[tick['symbol']] = tick
+            self._cond.notify()
+
+    def next_ticks(self, timeout):
+        """Waits up to `timeout` seconds; returns the pending ticks (empty list on timeout)."""
+        with self._cond:
+            if not self._pending:
+                self._cond.wait(timeout)
+            ticks = list(self._pending.values())
+            self._pending.clear()
+        return ticks
+
+
+class PriceBroker:
+    """
+    In-process pub/sub for price ticks. Exactly one poller thread runs per
+    subscribed symbol, however many clients watch it; it stops once the last
+    subscriber for the symbol leaves. Upstream load therefore grows with the
+    number of distinct symbols, not with the number of viewers.
+    """
+
+    def __init__(self, get_price, poll_interval=5.0, max_connections_per_user=3):
+        # get_price(asset) -> Decimal or None; called from the poller threads
+        self.get_price = get_price
+        self.poll_interval = poll_interval
+        self.max_connections_per_user = max_connections_per_user
+        self._subscribers = {} # symbol -> set of Subscription
+        self._connections = {} # user_id -> open connection count
+        self._pollers = {} # symbol -> Thread
+        self._last_ticks = {} # symbol -> last published tick
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id, assets):
+        symbols = [asset.symbol for asset in assets]
+        subscription = Subscription(user_id, symbols)
+        with self._lock:
+            if self._connections.get(user_id, 0) >= self.max_connections_per_user:
+                raise TooManyConnections(f"At most {self.max_connections_per_user} price streams per user.")
+            self._connections[user_id] = self._connections.get(user_id, 0) + 1
+            for asset in assets:
+                self._subscribers.setdefault(asset.symbol, set()).add(subscription)
+                if asset.symbol in self._last_ticks:
+                    subscription.push(self._last_ticks[asset.symbol])
+                if asset.symbol not in self._pollers:
+                    poller = threading.Thread(target=self._poll, args=(asset,), name=f'price-poller-{asset.symbol}', daemon=True)
+                    self._pollers[asset.symbol] = poller
+                    poller.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription.closed:
+                return
+            subscription.closed = True
+            for symbol in subscription.symbols:
+                subscribers = self._subscribers.get(symbol)
+                if subscribers:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[symbol]
+            remaining = self._connections.get(subscription.user_id, 1) - 1
+            if remaining > 0:
+                self._connections[subscription.user_id] = remaining
+            else:
+                self._connections.pop(subscription.user_id, None)
+
+    def publish(self, symbol, price):
+        tick = {'symbol': symbol, 'price': str(price), 'timestamp': datetime.now(timezone.utc).isoformat()}
+        with self._lock:
+            self._last_ticks[symbol] = tick
+            subscribers = list(self._subscribers.get(symbol, ()))
+        for subscription in subscribers:
+            subscription.push(tick)
+
+    def _poll(self, asset):
+        symbol = asset.symbol
+        last_price = None
+        while True:
+            with self._lock:
+                if not self._subscribers.get(symbol):
+                    # Deregister under the lock so a concurrent subscribe() starts a fresh poller
+                    del self._pollers[symbol]
+                    return
+            try:
+                price = self.get_price(asset)
+            except Exception as e:
+                logger.error(f"Price stream poll failed for {symbol}: {str(e)}")
+                price = None
+            if price is not None and price != last_price:
+                last_price = price
+                self.publish(symbol, price)
+            time.sleep(self.poll_interval)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'symbols_polled': sorted(self._pollers),
+                'connections': sum(self._connections.values()),
+                'users_connected': len(self._connections),
+            }
@@ -0,0 +1,144 @@
+import json
+import re
+import random
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+from models import db, User, Asset, Trade, PortfolioHolding, OpenOrder, PortfolioSnapshot, EducationalContent, News, Quiz, QuizQuestion
+
+# A query the endpoints issue: name, SQLAlchemy statement, and tables a full scan of is expected
+# for (tiny lookup tables, or a listing that really reads every row)
+HotQuery = namedtuple('HotQuery', ['name', 'statement', 'full_scan_ok'], defaults=[()])
+
+AUDIT_PREFIX = 'qaudit'
+SEED_ASSETS = 20
+# Rows inserted per executemany round trip
+SEED_BATCH = 5000
+
+_SQLITE_SCAN = re.compile(r'\bSCAN (?:TABLE )?(\w+)')
+
+
+def _insert(table, rows):
+    for start in range(0, len(rows), SEED_BATCH):
+        db.session.execute(db.insert(table), rows[start:start + SEED_BATCH])
+
+
+def seed_dataset(trades, seed=7):
+    """
+    Inserts a synthetic dataset into the current transaction (the caller rolls
+    it back): `trades` trades spread over trades // 100 users, plus content,
+    news, quizzes, holdings, open orders and snapshots in proportion, so the
+    planner sees realistic table sizes.
+    Returns the ids the hot queries are parameterized with.
+    """
+    rng = random.Random(seed)
+    user_count = max(10, trades // 100)
+    content_count = max(10, trades // 10)
+    now = datetime.now(timezone.utc)
+
+    _insert(User.__table__, [
+        {'username': f'{AUDIT_PREFIX}{i}', 'email': f'{AUDIT_PREFIX}{i}@example.invalid', 'password_hash': '-',
+         'cash_balance': Decimal('10000.00'), 'is_admin': False}
+        for i in range(user_count)
+    ])
+    _insert(Asset.__table__, [
+        {'symbol': f'QA{i:04d}', 'name': f'Audit asset {i}', 'asset_type': 'stock'} for i in range(SEED_ASSETS)
+    ])
+    user_ids = list(db.session.execute(db.select(User.id).where(User.username.startswith(AUDIT_PREFIX))).scalars())
+    asset_ids = list(db.session.execute(db.select(Asset.id).where(Asset.symbol.startswith('QA'))).scalars())
+
+    _insert(Trade.__table__, [
+        {'user_id': rng.choice(user_ids), 'asset_id': rng.choice(asset_ids), 'order_type': rng.choice(['market_buy', 'market_sell']),
+         'quantity': Decimal('1'), 'price_at_execution': Decimal('100'), 'timestamp': now - timedelta(minutes=i)}
+        for i in range(trades)
+    ])
+    _insert(PortfolioHolding.__table__, [
+        {'user_id': user_id, 'asset_id': asset_id, 'quantity': Decimal('1'), 'average_purchase_price': Decimal('100')}
+        for user_id in user_ids for asset_id in rng.sample(asset_ids, 3)
+    ])
+    _insert(OpenOrder.__table__, [
+        {'user_id': rng.choice(user_ids), 'asset_id': rng.choice(asset_ids), 'order_type': 'limit_buy',
+         'quantity': Decimal('1'), 'trigger_price': Decimal('90'), 'status': rng.choice(['open', 'filled', 'cancelled'])}
+        for _ in range(user_count * 5)
+    ])
+    _insert(PortfolioSnapshot.__table__, [
+        {'user_id': user_id, 'taken_at': now - timedelta(days=day), 'cash': Decimal('10000.00'),
+         'holdings_value': Decimal('0.00'), 'total_value': Decimal('10000.00')}
+        for user_id in user_ids for day in range(30)
+    ])
+    _insert(EducationalContent.__table__, [
+        {'title': f'{AUDIT_PREFIX} lesson {i}', 'content_type': 'article', 'body': '-', 'created_at': now - timedelta(minutes=i)}
+        for i in range(content_count)
+    ])
+    _insert(News.__table__, [
+        {'title': f'{AUDIT_PREFIX} news {i}', 'preview': '-', 'content': '-', 'created_at': now - timedelta(minutes=i)}
+        for i in range(content_count)
+    ])
+    lesson_ids = list(db.session.execute(
+        db.select(EducationalContent.id).where(EducationalContent.title.startswith(AUDIT_PREFIX))
+    ).scalars())
+    _insert(Quiz.__table__, [{'title': f'{AUDIT_PREFIX} quiz {lesson_id}', 'lesson_id': lesson_id} for lesson_id in lesson_ids])
+    quiz_ids = list(db.session.execute(db.select(Quiz.id).where(Quiz.title.startswith(AUDIT_PREFIX))).scalars())
+    _insert(QuizQuestion.__table__, [
+        {'quiz_id': quiz_id, 'question_text': '-', 'choices': ['a', 'b'], 'correct_answer': 'a'}
+        for quiz_id in quiz_ids for _ in range(3)
+    ])
+    return {'user_id': user_ids[0], 'asset_id': asset_ids[0], 'lesson_id': lesson_ids[0], 'quiz_id': quiz_ids[0]}
+
+
+def _compile(statement):
+    dialect = db.session.get_bind().dialect
+    return str(statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+
+
+def explain(statement):
+    """
+    Plan of a statement on the current connection, as (full scans, notes, plan text).
+    Postgres: EXPLAIN (FORMAT JSON), full scans are Seq Scan nodes. SQLite:
+    EXPLAIN QUERY PLAN, full scans are SCAN steps that use no index. Sorts and
+    temp B-trees are reported as notes, not flagged.
+    """
+    sql = _compile(statement)
+    connection = db.session.connection()
+    scans, notes = [], []
+    if connection.dialect.name == 'postgresql':
+        plan = connection.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {sql}').scalar()
+        plan = json.loads(plan) if isinstance(plan, str) else plan
+        def walk(node):
+            if node['Node Type'] == 'Seq Scan':
+                scans.append(node['Relation Name'])
+            elif node['Node Type'] in ('Sort', 'Incremental Sort'):
+                notes.append(f"sort on {', '.join(node.get('Sort Key', []))}")
+            for child in node.get('Plans', []):
+                walk(child)
+        walk(plan[0]['Plan'])
+        return scans, notes, json.dumps(plan[0]['Plan'], indent=2)
+
+    rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {sql}').all()
+    for row in rows:
+        detail = row[-1]
+        match = _SQLITE_SCAN.search(detail)
+        if match and 'USING' not in detail:
+            scans.append(match.group(1))
+        if 'TEMP B-TREE' in detail:
+            notes.append(detail.lower())
+    return scans, notes, '\n'.join(row[-1] for row in rows)
+
+
+def audit(build_queries, seed_rows=10000):
+    """
+    Seeds a dataset, refreshes planner statistics and EXPLAINs every hot query,
+    all inside one transaction that is rolled back afterwards.
+    `build_queries(sample_ids)` returns the HotQuery list. Yields
+    (query, flagged tables, notes, plan text) per query.
+    """
+    try:
+        sample_ids = seed_dataset(seed_rows) if seed_rows else {'user_id': 1, 'asset_id': 1, 'lesson_id': 1, 'quiz_id': 1}
+        db.session.connection().exec_driver_sql('ANALYZE')
+        for query in build_queries(sample_ids):
+            scans, notes, plan = explain(query.statement)
+            flagged = sorted({table for table in scans if table not in query.full_scan_ok})
+            yield query, flagged, notes, plan
+    finally:
+        db.session.rollback()
@@ -0,0 +1,199 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal, ROUND_HALF_UP
+
+from models import db, User, Trade, PortfolioHolding
+
+logger = logging.getLogger(__name__)
+
+EIGHT_PLACES = Decimal('0.00000001')
+# Trades fetched per round trip from the server-side cursor, and rows per bulk repair statement
+STREAM_BATCH = 10000
+REPAIR_BATCH = 1000
+# Mismatches kept per partition for the report (all of them are counted and repaired)
+SAMPLE_SIZE = 20
+
+
+def _q8(value):
+    # Numeric(18, 8) columns round half away from zero on store (Postgres numeric semantics)
+    return value.quantize(EIGHT_PLACES, rounding=ROUND_HALF_UP)
+
+
+def replay_trades(rows):
+    """
+    Expected holdings from the ledger, applying the same accounting as
+    orders.execute_market_order: buys move the average cost, sells only
+    reduce the quantity, and a position sold down to zero starts fresh.
+    `rows` yields (user_id, asset_id, order_type, quantity, price) sorted by
+    (user_id, asset_id, trade id); one (user, asset) is held at a time, so
+    memory doesn't grow with the ledger.
+    Yields ((user_id, asset_id), quantity, average_price) per pair with trades.
+    """
+    key = None
+    quantity = average_price = None
+    for user_id, asset_id, order_type, trade_quantity, price in rows:
+        if (user_id, asset_id) != key:
+            if key is not None:
+                yield key, quantity, average_price
+            key = (user_id, asset_id)
+            quantity, average_price = Decimal(0), Decimal(0)
+        trade_quantity = Decimal(trade_quantity); price = Decimal(price)
+        if order_type.endswith('_buy'):
+            new_quantity = quantity + trade_quantity
+            average_price = _q8((average_price * quantity + trade_quantity * price) / new_quantity) if quantity > 0 else price
+            quantity = new_quantity
+        else:
+            quantity -= trade_quantity
+            if quantity == 0:
+                average_price = Decimal(0)
+    if key is not None:
+        yield key, quantity, average_price
+
+
+def partition_user_ids(partitions):
+    """Splits [min user id, max user id] into at most `partitions` contiguous (low, high) ranges."""
+    low, high = db.session.execute(db.select(db.func.min(User.id), db.func.max(User.id))).one()
+    if low is None:
+        return []
+    step = max(1, -(-(high - low + 1) // partitions))
+    return [(start, min(start + step - 1, high)) for start in range(low, high + 1, step)]
+
+
+def reconcile_partition(low, high, repair=False, tolerance=Decimal('0.000001'), starting_cash=Decimal('10000.00')):
+    """
+    Checks users low..high: replays their trades (streamed with yield_per)
+    against portfolio_holdings and, with `repair`, fixes holdings in bulk.
+    Cash is only reported: admin set-cash writes aren't in the ledger, so a
+    balance that differs from starting_cash plus net trade flows is flagged
+    as an adjustment rather than corrected.
+    Returns a summary dict of counts plus a sample of the mismatches.
+    """
+    holdings = {
+        (row.user_id, row.asset_id): (row.quantity, row.average_purchase_price)
+        for row in db.session.execute(
+            db.select(PortfolioHolding.user_id, PortfolioHolding.asset_id, PortfolioHolding.quantity,
+                      PortfolioHolding.average_purchase_price)
+            .where(PortfolioHolding.user_id.between(low, high))
+        )
+    }
+    trades = db.session.execute(
+        db.select(Trade.user_id, Trade.asset_id, Trade.order_type, Trade.quantity, Trade.price_at_execution)
+        .where(Trade.user_id.between(low, high))
+        .order_by(Trade.user_id, Trade.asset_id, Trade.id)
+        .execution_options(yield_per=STREAM_BATCH)
+    )
+    report = {'users': (low, high), 'trades': 0, 'pairs': 0, 'holdings': len(holdings), 'missing': 0, 'unexpected': 0,
+              'quantity': 0, 'average_cost': 0, 'negative_ledger': 0, 'cash_adjusted': 0, 'negative_cash': 0,
+              'repaired': 0, 'samples': []}
+    to_insert, to_update, to_delete = [], [], []
+
+    def note(kind, user_id, asset_id, expected, actual):
+        report[kind] += 1
+        if len(report['samples']) < SAMPLE_SIZE:
+            report['samples'].append({'kind': kind, 'user_id': user_id, 'asset_id': asset_id,
+                                      'expected': expected, 'actual': actual})
+
+    def counted(rows):
+        for row in rows:
+            report['trades'] += 1
+            yield row
+
+    for (user_id, asset_id), quantity, average_price in replay_trades(counted(trades)):
+        report['pairs'] += 1
+        actual = holdings.pop((user_id, asset_id), None)
+        if quantity < 0:
+            note('negative_ledger', user_id, asset_id, str(quantity), str(actual[0]) if actual else None)
+            continue
+        expected_row = {'u': user_id, 'a': asset_id, 'q': _q8(quantity), 'p': average_price}
+        if quantity == 0:
+            if actual is not None:
+                note('unexpected', user_id, asset_id, None, str(actual[0]))
+                to_delete.append(expected_row)
+        elif actual is None:
+            note('missing', user_id, asset_id, str(expected_row['q']), None)
+            to_insert.append(expected_row)
+        elif abs(actual[0] - expected_row['q']) > EIGHT_PLACES / 2:
+            note('quantity', user_id, asset_id, str(expected_row['q']), str(actual[0]))
+            to_update.append(expected_row)
+        elif abs(actual[1] - average_price) > tolerance:
+            note('average_cost', user_id, asset_id, str(average_price), str(actual[1]))
+            to_update.append(expected_row)
+    # Holdings left over have no trades at all behind them
+    for (user_id, asset_id), (quantity, _) in holdings.items():
+        note('unexpected', user_id, asset_id, None, str(quantity))
+        to_delete.append({'u': user_id, 'a': asset_id})
+
+    flows = db.func.sum(db.case((Trade.order_type.endswith('_buy', autoescape=True), -Trade.quantity * Trade.price_at_execution),
+                                else_=Trade.quantity * Trade.price_at_execution))
+    net_flow = (
+        db.select(Trade.user_id, flows.label('net'))
+        .where(Trade.user_id.between(low, high))
+        .group_by(Trade.user_id)
+        .subquery()
+    )
+    for user_id, cash, net in db.session.execute(
+        db.select(User.id, User.cash_balance, net_flow.c.net)
+        .outerjoin(net_flow, net_flow.c.user_id == User.id)
+        .where(User.id.between(low, high))
+    ):
+        expected_cash = (starting_cash + Decimal(net or 0)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+        if cash < 0:
+            note('negative_cash', user_id, None, str(expected_cash), str(cash))
+        elif abs(cash - expected_cash) >= Decimal('0.01'):
+            note('cash_adjusted', user_id, None, str(expected_cash), str(cash))
+
+    if repair:
+        report['repaired'] = repair_holdings(to_insert, to_update, to_delete)
+    return report
+
+
+def repair_holdings(to_insert, to_update, to_delete):
+    """Applies the fixes as executemany statements, REPAIR_BATCH rows at a time. Returns rows changed."""
+    holdings = PortfolioHolding.__table__
+    match = (holdings.c.user_id == db.bindparam('u')) & (holdings.c.asset_id == db.bindparam('a'))
+    update = db.update(holdings).where(match).values(quantity=db.bindparam('q'), average_purchase_price=db.bindparam('p'))
+    delete = db.delete(holdings).where(match)
+    for start in range(0, len(to_delete), REPAIR_BATCH):
+        db.session.execute(delete, to_delete[start:start + REPAIR_BATCH])
+    for start in range(0, len(to_update), REPAIR_BATCH):
+        db.session.execute(update, to_update[start:start + REPAIR_BATCH])
+    for start in range(0, len(to_insert), REPAIR_BATCH):
+        db.session.execute(db.insert(holdings), [
+            {'user_id': row['u'], 'asset_id': row['a'], 'quantity': row['q'], 'average_purchase_price': row['p']}
+            for row in to_insert[start:start + REPAIR_BATCH]
+        ])
+    db.session.commit()
+    return len(to_insert) + len(to_update) + len(to_delete)
+
+
+_worker_app = None
+
+def _init_worker():
+    # Each worker process opens its own connections instead of sharing the parent's pool
+    global _worker_app
+    from app import app
+    _worker_app = app
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+def _run_partition(args):
+    with _worker_app.app_context():
+        return reconcile_partition(*args)
+
+
+def reconcile(partitions, workers=1, repair=False, tolerance=Decimal('0.000001'), starting_cash=Decimal('10000.00')):
+    """
+    Runs reconcile_partition over user id ranges and yields each partition's
+    report as it finishes. workers=1 runs everything in this process;
+    otherwise a process pool works through the partitions in parallel.
+    """
+    ranges = partition_user_ids(partitions)
+    if workers <= 1:
+        for low, high in ranges:
+            yield reconcile_partition(low, high, repair, tolerance, starting_cash)
+        return
+    # The parent's connections must not leak into forked workers
+    db.session.remove()
+    db.engine.dispose()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        yield from pool.map(_run_partition, [(low, high, repair, tolerance, starting_cash) for low, high in ranges])
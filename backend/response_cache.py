@@ -0,0 +1,75 @@
+import hashlib
+import threading
+from collections import namedtuple
+
+from flask import Response, request
+
+# An encoded JSON body with its validators; last_modified may be None
+CachedBody = namedtuple('CachedBody', ['body', 'etag', 'last_modified'])
+
+
+def cached_body(body, last_modified=None):
+    """
+    The ETag is a digest of the body rather than of updated_at alone: some
+    backends store updated_at to the second, so two edits within one second
+    would otherwise share a validator.
+    """
+    return CachedBody(body, hashlib.blake2b(body.encode(), digest_size=12).hexdigest(), last_modified)
+
+
+class ResponseCache:
+    """
+    Encoded responses of public read endpoints, keyed per item or per list
+    page. Writes invalidate precisely: an item's own entry, and every list
+    page at once by moving lists to a new generation (old pages age out of
+    the LRU). Other workers converge within the TTL.
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def item(self, item_id, build):
+        key = ('item', item_id)
+        with self._lock:
+            generation = self._generation
+        cached = self._cache.get_or_load(key, build)
+        with self._lock:
+            if self._generation != generation:
+                # A write landed while this was built; don't let a pre-write body outlive its invalidation
+                self._cache.invalidate(key)
+        return cached
+
+    def page(self, key, build):
+        with self._lock:
+            generation = self._generation
+        return self._cache.get_or_load(('list', generation) + tuple(key), build)
+
+    def invalidate(self, item_id=None):
+        """After a write: drops the item's entry (if given) and all list pages."""
+        if item_id is not None:
+            self._cache.invalidate(('item', item_id))
+        with self._lock:
+            self._generation += 1
+
+    def clear(self):
+        """After a write that touches many items (e.g. a deleted module unassigning its lessons)."""
+        with self._lock:
+            self._generation += 1
+        self._cache.clear()
+
+    def stats(self):
+        return dict(self._cache.stats(), generation=self._generation)
+
+
+def conditional_response(cached, max_age=0):
+    """A 200 with ETag/Last-Modified, or a 304 when the request's If-None-Match/If-Modified-Since still matches."""
+    response = Response(cached.body, mimetype='application/json')
+    response.set_etag(cached.etag)
+    if cached.last_modified is not None:
+        response.last_modified = cached.last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.must_revalidate = True
+    return response.make_conditional(request)
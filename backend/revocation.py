@@ -0,0 +1,136 @@
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from models import db, RevokedToken
+
+# Revocations re-read on every sync, so rows committed late by another process (or stamped by a skewed clock) aren't missed
+SYNC_OVERLAP = timedelta(seconds=60)
+# Confirmed "is it really revoked?" answers kept for bloom filter hits
+CONFIRMED_MAX_ENTRIES = 4096
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings: no false negatives, false positives at about `error_rate` when full."""
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        # Double hashing: two 64-bit halves of one digest give every position
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class RevocationStore:
+    """
+    Revoked token ids (jti), persisted in revoked_tokens and checked on every
+    authenticated request without a query in the common case.
+
+    A Bloom filter holds every unexpired revoked jti: a miss means "not
+    revoked" outright; a hit (a revoked token, or a rare false positive) is
+    confirmed with one primary-key lookup whose answer is kept in a small LRU.
+    Revocations made in this process are added immediately; sync() picks up
+    other processes' every `sync_interval` seconds, and a rebuild every
+    `full_reload_interval` seconds drops expired entries from the filter.
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.001, sync_interval=5.0, full_reload_interval=3600.0, clock=time.monotonic):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_interval = sync_interval
+        self.full_reload_interval = full_reload_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._filter = BloomFilter(capacity, error_rate)
+        self._confirmed = {} # jti -> revoked?, oldest first
+        self._loaded_at = None
+        self._synced_at = None
+        self._seen_until = None # newest revoked_at read from the table
+        self._stats = {'checks': 0, 'filter_hits': 0, 'lookups': 0, 'revoked': 0}
+
+    def _remember(self, jti, revoked):
+        # Must be called with self._lock held.
+        self._confirmed.pop(jti, None)
+        self._confirmed[jti] = revoked
+        if len(self._confirmed) > CONFIRMED_MAX_ENTRIES:
+            del self._confirmed[next(iter(self._confirmed))]
+
+    def _read_since(self, since):
+        query = db.select(RevokedToken.jti, RevokedToken.revoked_at).where(RevokedToken.expires_at > datetime.now(timezone.utc))
+        if since is not None:
+            query = query.where(RevokedToken.revoked_at > since - SYNC_OVERLAP)
+        return db.session.execute(query).all()
+
+    def load(self):
+        rows = self._read_since(None)
+        bloom = BloomFilter(max(self.capacity, len(rows) * 2), self.error_rate)
+        for row in rows:
+            bloom.add(row.jti)
+        with self._lock:
+            self._filter = bloom
+            self._confirmed = {}
+            self._seen_until = max((row.revoked_at for row in rows), default=None)
+            self._loaded_at = self._synced_at = self._clock()
+
+    def sync(self):
+        with self._lock:
+            since = self._seen_until
+        rows = self._read_since(since)
+        with self._lock:
+            for row in rows:
+                self._filter.add(row.jti)
+                self._confirmed.pop(row.jti, None)
+                if self._seen_until is None or row.revoked_at > self._seen_until:
+                    self._seen_until = row.revoked_at
+            self._synced_at = self._clock()
+
+    def ensure_fresh(self):
+        now = self._clock()
+        if self._loaded_at is None or now - self._loaded_at >= self.full_reload_interval:
+            self.load()
+        elif now - self._synced_at >= self.sync_interval:
+            self.sync()
+
+    def is_revoked(self, jti):
+        self.ensure_fresh()
+        with self._lock:
+            self._stats['checks'] += 1
+            if jti not in self._filter:
+                return False
+            self._stats['filter_hits'] += 1
+            if jti in self._confirmed:
+                return self._confirmed[jti]
+        revoked = db.session.get(RevokedToken, jti) is not None
+        with self._lock:
+            self._stats['lookups'] += 1
+            self._remember(jti, revoked)
+        return revoked
+
+    def revoke(self, jti, user_id, token_type, expires_at):
+        """Records a revocation (idempotent) and commits it."""
+        if db.session.get(RevokedToken, jti) is None:
+            db.session.add(RevokedToken(jti=jti, user_id=user_id, token_type=token_type, expires_at=expires_at,
+                                        revoked_at=datetime.now(timezone.utc)))
+            db.session.commit()
+        with self._lock:
+            self._filter.add(jti)
+            self._remember(jti, True)
+            self._stats['revoked'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, bloom_bits=self._filter.size, bloom_hashes=self._filter.hashes,
+                        confirmed=len(self._confirmed))
@@ -7,8 +7,10 @@ CREATE TABLE users (
     username VARCHAR(50) UNIQUE NOT NULL,
     email VARCHAR(100) UNIQUE NOT NULL,
     password_hash VARCHAR(255) NOT NULL,
+    cohort VARCHAR(50), -- Competition group; users are also ranked within their cohort on /leaderboard
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
+CREATE INDEX IF NOT EXISTS ix_users_cohort ON users (cohort);
 
 -- Educational Content table
 CREATE TABLE educational_content (
@@ -48,7 +50,7 @@ CREATE TABLE trades (
     id SERIAL PRIMARY KEY,
     user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
     asset_id INTEGER NOT NULL REFERENCES assets(id) ON DELETE RESTRICT,
-    order_type VARCHAR(10) NOT NULL, -- 'market_buy', 'market_sell'
+    order_type VARCHAR(20) NOT NULL, -- 'market_buy', 'market_sell', or the resting order type that triggered it
     quantity DECIMAL(18, 8) NOT NULL, -- Using DECIMAL for precision with crypto
     price_at_execution DECIMAL(18, 8) NOT NULL,
     timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
@@ -111,3 +113,76 @@ CREATE TRIGGER update_educational_content_updated_at
 BEFORE UPDATE ON educational_content
 FOR EACH ROW
 EXECUTE FUNCTION update_updated_at_column();
+
+-- Latest price snapshot per asset, refreshed in the background by `flask refresh-prices`
+CREATE TABLE asset_prices (
+    asset_id INTEGER PRIMARY KEY REFERENCES assets(id) ON DELETE CASCADE,
+    price DECIMAL(18, 8) NOT NULL,
+    fetched_at TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+-- OHLC price history, appended incrementally by /assets/<symbol>/history
+CREATE TABLE price_history (
+    asset_id INTEGER NOT NULL REFERENCES assets(id) ON DELETE CASCADE,
+    interval VARCHAR(10) NOT NULL, -- '30min', 'daily', 'weekly'
+    timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+    open DECIMAL(18, 8) NOT NULL,
+    high DECIMAL(18, 8) NOT NULL,
+    low DECIMAL(18, 8) NOT NULL,
+    close DECIMAL(18, 8) NOT NULL,
+    volume DECIMAL(28, 8),
+    PRIMARY KEY (asset_id, interval, timestamp) -- Range scans per asset/interval use this index
+);
+
+-- Resting limit/stop orders; loaded into the in-memory order book and filled on price ticks
+CREATE TABLE open_orders (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    asset_id INTEGER NOT NULL REFERENCES assets(id) ON DELETE RESTRICT,
+    order_type VARCHAR(20) NOT NULL, -- 'limit_buy', 'limit_sell', 'stop_buy', 'stop_sell'
+    quantity DECIMAL(18, 8) NOT NULL,
+    trigger_price DECIMAL(18, 8) NOT NULL, -- Limit price, or stop price for stop orders
+    status VARCHAR(20) NOT NULL DEFAULT 'open', -- 'open', 'filled', 'cancelled', 'rejected'
+    reason VARCHAR(255),
+    trade_id INTEGER REFERENCES trades(id) ON DELETE SET NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    closed_at TIMESTAMP WITH TIME ZONE
+);
+CREATE INDEX ix_open_orders_status_id ON open_orders (status, id); -- Matcher sync: new open orders
+CREATE INDEX ix_open_orders_user_id ON open_orders (user_id);
+
+-- Account value over time, written by `flask snapshot-portfolios` for users whose holdings or prices changed
+CREATE TABLE portfolio_snapshots (
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    taken_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    cash DECIMAL(18, 2) NOT NULL,
+    holdings_value DECIMAL(18, 2) NOT NULL,
+    total_value DECIMAL(18, 2) NOT NULL,
+    last_trade_id INTEGER, -- Newest trade included in this valuation
+    PRIMARY KEY (user_id, taken_at) -- /portfolio/history range reads use this index
+);
+
+-- Secondary indexes for the hot access paths (`flask explain-hot-queries` checks they are used).
+-- IF NOT EXISTS keeps this block safe to rerun on an existing database; `flask create-indexes` does the same from the models.
+CREATE INDEX IF NOT EXISTS ix_trades_user_timestamp ON trades (user_id, timestamp, id); -- /trades, keyset pages, exports
+CREATE INDEX IF NOT EXISTS ix_trades_user_asset_timestamp ON trades (user_id, asset_id, timestamp, id); -- /trades?asset=
+CREATE INDEX IF NOT EXISTS ix_portfolio_holdings_asset_id ON portfolio_holdings (asset_id); -- Holders of an asset
+CREATE INDEX IF NOT EXISTS ix_educational_content_created_at ON educational_content (created_at); -- /content, newest first
+CREATE INDEX IF NOT EXISTS ix_news_created_at ON news (created_at); -- /admin/news, newest first
+CREATE INDEX IF NOT EXISTS ix_quizzes_lesson_id ON quizzes (lesson_id);
+CREATE INDEX IF NOT EXISTS ix_quiz_questions_quiz_id ON quiz_questions (quiz_id);
+
+-- Revoked JWTs (logout), checked through an in-memory Bloom filter that each worker syncs from this table
+CREATE TABLE revoked_tokens (
+    jti VARCHAR(36) PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    token_type VARCHAR(10) NOT NULL, -- 'access' or 'refresh'
+    expires_at TIMESTAMP WITH TIME ZONE NOT NULL, -- Safe to delete after this
+    revoked_at TIMESTAMP WITH TIME ZONE NOT NULL
+);
+CREATE INDEX ix_revoked_tokens_revoked_at ON revoked_tokens (revoked_at);
+
+-- Migration for databases created before competition cohorts (a no-op on a fresh schema, safe to rerun).
+-- `flask create-indexes` also creates ix_users_cohort from the models.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS cohort VARCHAR(50);
+CREATE INDEX IF NOT EXISTS ix_users_cohort ON users (cohort);
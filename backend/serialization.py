@@ -0,0 +1,232 @@
+import json
+from datetime import date, datetime
+from json.encoder import encode_basestring_ascii
+
+from flask import Response, stream_with_context
+
+from models import db, User, EducationalContent, Asset, Trade, OpenOrder, PortfolioSnapshot, News, Quiz, QuizQuestion, Module
+
+# Rows encoded per chunk when streaming a list
+STREAM_CHUNK_ROWS = 500
+
+
+class RawJSON(str):
+    """Already-encoded JSON text; json_response() embeds it as is."""
+
+
+def _encode_int(value):
+    return 'null' if value is None else str(int(value))
+
+def _encode_bool(value):
+    return 'null' if value is None else ('true' if value else 'false')
+
+def _encode_str(value):
+    return 'null' if value is None else encode_basestring_ascii(value)
+
+def _encode_decimal(value):
+    # Decimals go out as strings, exactly as str() prints them (no float rounding)
+    return 'null' if value is None else '"' + str(value) + '"'
+
+def _encode_datetime(value):
+    return 'null' if value is None else '"' + value.isoformat() + '"'
+
+def _encode_json(value):
+    return json.dumps(value)
+
+def _plain_decimal(value):
+    return None if value is None else str(value)
+
+def _plain_datetime(value):
+    return None if value is None else value.isoformat()
+
+
+def _converters(column_type):
+    """(JSON text encoder, plain Python converter) for a column type."""
+    python_type = None
+    try:
+        python_type = column_type.python_type
+    except NotImplementedError:
+        pass
+    if isinstance(column_type, db.Numeric) and getattr(column_type, 'asdecimal', True):
+        return _encode_decimal, _plain_decimal
+    if python_type is bool:
+        return _encode_bool, None
+    if python_type is int:
+        return _encode_int, None
+    if python_type is str:
+        return _encode_str, None
+    if python_type in (datetime, date):
+        return _encode_datetime, _plain_datetime
+    return _encode_json, None
+
+
+class RowEncoder:
+    """
+    A compiled field plan for one list shape: the output keys, the columns
+    they are read from (joined columns included, so nothing is lazy loaded),
+    and one converter per field picked from the column type when the plan is
+    built. Rows come from plan.select() as plain tuples, never ORM objects,
+    and are written straight to JSON text: Decimals as their str(), datetimes
+    as isoformat(), strings through the C escaper.
+    """
+
+    def __init__(self, fields, joins=()):
+        # fields: [(output key, column expression)]; joins: [(target, onclause)] outer-joined in order
+        self.keys = [key for key, _ in fields]
+        self.columns = [column.label(key) for key, column in fields]
+        self.joins = list(joins)
+        encoders, plain = zip(*(_converters(column.type) for _, column in fields))
+        self._encoders = encoders
+        self._plain = plain
+        self._prefixes = ['{' + encode_basestring_ascii(self.keys[0]) + ':'] + \
+                         [',' + encode_basestring_ascii(key) + ':' for key in self.keys[1:]]
+
+    def select(self):
+        query = db.select(*self.columns)
+        for target, onclause in self.joins:
+            query = query.outerjoin(target, onclause)
+        return query
+
+    def _encode_fields(self, row):
+        return ''.join([prefix + encode(value) for prefix, encode, value in zip(self._prefixes, self._encoders, row)])
+
+    def encode(self, row, **nested):
+        """One row as a JSON object; `nested` adds keys whose values are RawJSON (e.g. a child list)."""
+        text = self._encode_fields(row)
+        for key, value in nested.items():
+            text += ',' + encode_basestring_ascii(key) + ':' + value
+        return text + '}'
+
+    def encode_list(self, rows):
+        return RawJSON('[' + ','.join([self._encode_fields(row) + '}' for row in rows]) + ']')
+
+    def iter_list(self, rows, chunk_rows=STREAM_CHUNK_ROWS):
+        """A JSON array in chunks of `chunk_rows` rows, for streaming responses."""
+        yield '['
+        chunk, first = [], True
+        for row in rows:
+            chunk.append(self._encode_fields(row) + '}')
+            if len(chunk) >= chunk_rows:
+                yield ('' if first else ',') + ','.join(chunk)
+                chunk, first = [], False
+        if chunk:
+            yield ('' if first else ',') + ','.join(chunk)
+        yield ']'
+
+    def iter_lines(self, rows, chunk_rows=STREAM_CHUNK_ROWS):
+        """Newline-delimited JSON, `chunk_rows` lines per chunk."""
+        chunk = []
+        for row in rows:
+            chunk.append(self._encode_fields(row) + '}\n')
+            if len(chunk) >= chunk_rows:
+                yield ''.join(chunk)
+                chunk = []
+        if chunk:
+            yield ''.join(chunk)
+
+    def as_dict(self, row):
+        """A row as a dict of plain JSON-ready values (CSV writers, in-process consumers)."""
+        return {key: value if convert is None else convert(value) for key, convert, value in zip(self.keys, self._plain, row)}
+
+
+def _encode_value(value):
+    return value if isinstance(value, RawJSON) else json.dumps(value)
+
+
+def json_object(**parts):
+    """A JSON object built from `parts`; RawJSON values are embedded without re-encoding."""
+    return RawJSON('{' + ','.join(encode_basestring_ascii(key) + ':' + _encode_value(value) for key, value in parts.items()) + '}')
+
+
+def json_response(status=200, **parts):
+    """A JSON object response built from `parts` (see json_object)."""
+    return Response(json_object(**parts), status=status, mimetype='application/json')
+
+
+def stream_json_response(key, chunks, **parts):
+    """
+    Streams {"<key>": [...chunks...], **parts} without holding the whole list;
+    `chunks` is e.g. RowEncoder.iter_list() over a yield_per result. The request
+    context (and so the session) stays open until the last chunk is sent.
+    """
+    def generate():
+        yield '{' + encode_basestring_ascii(key) + ':'
+        yield from chunks
+        for name, value in parts.items():
+            yield ',' + encode_basestring_ascii(name) + ':' + _encode_value(value)
+        yield '}'
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+# --- Field plans, one per list shape (same keys and values as the models' to_dict) ---
+
+ASSET_FIELDS = RowEncoder([
+    ('id', Asset.id), ('symbol', Asset.symbol), ('name', Asset.name), ('asset_type', Asset.asset_type),
+])
+
+TRADE_FIELDS = RowEncoder([
+    ('id', Trade.id), ('user_id', Trade.user_id), ('asset_id', Trade.asset_id), ('asset_symbol', Asset.symbol),
+    ('order_type', Trade.order_type), ('quantity', Trade.quantity), ('price_at_execution', Trade.price_at_execution),
+    ('timestamp', Trade.timestamp),
+], joins=[(Asset, Asset.id == Trade.asset_id)])
+
+OPEN_ORDER_FIELDS = RowEncoder([
+    ('id', OpenOrder.id), ('user_id', OpenOrder.user_id), ('asset_id', OpenOrder.asset_id), ('asset_symbol', Asset.symbol),
+    ('order_type', OpenOrder.order_type), ('quantity', OpenOrder.quantity), ('trigger_price', OpenOrder.trigger_price),
+    ('status', OpenOrder.status), ('reason', OpenOrder.reason), ('trade_id', OpenOrder.trade_id),
+    ('created_at', OpenOrder.created_at), ('closed_at', OpenOrder.closed_at),
+], joins=[(Asset, Asset.id == OpenOrder.asset_id)])
+
+SNAPSHOT_FIELDS = RowEncoder([
+    ('date', PortfolioSnapshot.taken_at), ('cash', PortfolioSnapshot.cash),
+    ('holdings_value', PortfolioSnapshot.holdings_value), ('total_value', PortfolioSnapshot.total_value),
+])
+
+CONTENT_FIELDS = RowEncoder([
+    ('id', EducationalContent.id), ('title', EducationalContent.title), ('content_type', EducationalContent.content_type),
+    ('body', EducationalContent.body), ('video_url', EducationalContent.video_url), ('author_id', EducationalContent.author_id),
+    ('author_username', User.username), ('created_at', EducationalContent.created_at),
+    ('updated_at', EducationalContent.updated_at), ('module_id', EducationalContent.module_id),
+    ('order', EducationalContent.order),
+], joins=[(User, User.id == EducationalContent.author_id)])
+
+NEWS_FIELDS = RowEncoder([
+    ('id', News.id), ('title', News.title), ('preview', News.preview), ('content', News.content), ('created_at', News.created_at),
+])
+
+QUIZ_FIELDS = RowEncoder([
+    ('id', Quiz.id), ('title', Quiz.title), ('description', Quiz.description), ('lesson_id', Quiz.lesson_id),
+    ('created_at', Quiz.created_at), ('updated_at', Quiz.updated_at),
+])
+
+QUIZ_QUESTION_FIELDS = RowEncoder([
+    ('id', QuizQuestion.id), ('quiz_id', QuizQuestion.quiz_id), ('question_text', QuizQuestion.question_text),
+    ('choices', QuizQuestion.choices), ('correct_answer', QuizQuestion.correct_answer),
+    ('explanation', QuizQuestion.explanation), ('order', QuizQuestion.order),
+])
+
+MODULE_FIELDS = RowEncoder([
+    ('id', Module.id), ('title', Module.title), ('description', Module.description), ('order', Module.order),
+    ('created_at', Module.created_at), ('updated_at', Module.updated_at),
+])
+
+ADMIN_USER_FIELDS = RowEncoder([
+    ('id', User.id), ('username', User.username), ('email', User.email), ('is_admin', User.is_admin),
+    ('cash_balance', User.cash_balance), ('cohort', User.cohort),
+])
+
+
+def encode_with_children(parent_plan, parents, parent_key, name, child_plan, children, child_key):
+    """
+    Parents with a nested child list each (quizzes with their questions,
+    modules with their lessons) from two flat queries, instead of a lazy load
+    per parent. Children are matched on parent[parent_key] == child[child_key].
+    """
+    parent_index = parent_plan.keys.index(parent_key)
+    child_index = child_plan.keys.index(child_key)
+    grouped = {}
+    for child in children:
+        grouped.setdefault(child[child_index], []).append(child)
+    return RawJSON('[' + ','.join(
+        parent_plan.encode(parent, **{name: child_plan.encode_list(grouped.get(parent[parent_index], ()))}) for parent in parents
+    ) + ']')
@@ -1,8 +1,43 @@
+import os
+import tempfile
 import pytest
 import json
 import jwt # For jwt.exceptions
 from flask_jwt_extended import create_access_token, decode_token
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+from sqlalchemy import event
+
+# The app binds its database when imported, so point it at a throwaway SQLite file first
+_test_db_fd, _test_db_path = tempfile.mkstemp(suffix='.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{_test_db_path}'
+
+import app as app_module
 from app import app, db # Assuming app.py is in the same directory or accessible
+from datetime import datetime, timedelta, timezone
+from models import (Asset, AssetPrice, EducationalContent, Module, News, OpenOrder, PortfolioHolding, PortfolioSnapshot, PriceHistory,
+                    Quiz, QuizQuestion, RevokedToken, Trade, User)
+from price_history import HistoryStore
+from downsample import lttb_indices
+from market_data import AlphaVantageClient, Quote, TokenBucket
+from price_stream import PriceBroker, TooManyConnections
+from market_sim import MarketSimulator
+from indicators import parse_indicator_spec, compute_indicators
+import numpy as np
+from cache import TTLCache
+from price_refresh import PriceRefreshScheduler, as_utc, store_price_snapshot
+from order_book import OrderBook, OrderMatcher
+from leaderboard import Leaderboard, RankedList
+from portfolio_snapshots import take_portfolio_snapshots
+from performance import fifo_positions, risk_metrics
+from reconcile import reconcile
+from serialization import TRADE_FIELDS
+from passwords import PasswordHasher, HashingUnavailable
+from revocation import BloomFilter, RevocationStore
+from werkzeug.security import generate_password_hash
 
 @pytest.fixture(scope='module')
 def test_client():
@@ -11,17 +46,42 @@ def test_client():
         "TESTING": True,
         # Add other test-specific configurations if needed, e.g., a test database
         "JWT_SECRET_KEY": "test-secret-key", # Consistent key for testing
-        "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:", # Use in-memory for tests
     })
 
     with flask_app.test_client() as testing_client:
         with flask_app.app_context():
-            # db.create_all() # Create tables if your test interacts with db
-            pass
+            db.create_all()
         yield testing_client
-        # with flask_app.app_context():
-            # db.drop_all() # Clean up db after tests if created
-            # pass
+        with flask_app.app_context():
+            db.drop_all()
+            db.engine.dispose()
+    os.close(_test_db_fd)
+    os.remove(_test_db_path)
+
+@pytest.fixture
+def quiet_revocations(test_client, monkeypatch):
+    # For tests that count statements: load the revocation filter up front and skip its periodic sync
+    with test_client.application.app_context():
+        app_module.revocations.load()
+    monkeypatch.setattr(app_module.revocations, 'sync_interval', float('inf'))
+
+@pytest.fixture
+def seeded_assets(test_client):
+    symbols = [('AAPL', 'Apple Inc.', 'stock'), ('MSFT', 'Microsoft Corp.', 'stock'), ('BTCUSD', 'Bitcoin', 'crypto')]
+    with test_client.application.app_context():
+        for symbol, name, asset_type in symbols:
+            db.session.add(Asset(symbol=symbol, name=name, asset_type=asset_type))
+        db.session.commit()
+    app_module.price_cache.clear()
+    app_module.content_responses.clear()
+    yield symbols
+    with test_client.application.app_context():
+        for model in (RevokedToken, PortfolioSnapshot, OpenOrder, Trade, PortfolioHolding, AssetPrice, PriceHistory, QuizQuestion, Quiz,
+                      EducationalContent, Module, News, Asset, User):
+            db.session.query(model).delete()
+        db.session.commit()
+    app_module.price_cache.clear()
+    app_module.content_responses.clear()
 
 def test_get_assets_no_token(test_client):
     response = test_client.get('/assets')
@@ -62,4 +122,947 @@ def test_create_token_with_dict_identity_causes_decode_error(test_client):
             decode_token(access_token)
         assert "Subject must be a string" in str(excinfo.value)
 
+def test_ttl_cache_expiry_and_lru_eviction():
+    now = [0.0]
+    cache = TTLCache(max_entries=2, default_ttl=10, clock=lambda: now[0])
+    cache.set('AAPL', 1)
+    cache.set('MSFT', 2)
+    assert cache.get('AAPL') == 1 # AAPL is now most recently used
+    cache.set('TSLA', 3) # evicts MSFT
+    assert cache.get('MSFT') is None
+    now[0] = 11
+    assert cache.get('AAPL') is None
+    stats = cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['stale'] == 1
+    assert stats['hits'] == 1
+
+def test_ttl_cache_single_flight_deduplicates_concurrent_misses():
+    cache = TTLCache()
+    calls = []
+    release = threading.Event()
+
+    def loader():
+        calls.append(1)
+        release.wait(5)
+        return 'price'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load('BTCUSD', loader))) for _ in range(8)]
+    for t in threads: t.start()
+    time.sleep(0.05)
+    release.set()
+    for t in threads: t.join()
+    assert results == ['price'] * 8
+    assert len(calls) == 1
+    assert cache.stats()['coalesced'] == 7
+
+def test_refresh_scheduler_prioritizes_held_assets_within_budget(test_client, seeded_assets):
+    sleeps = []
+    now = [0.0]
+    def fake_sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    with test_client.application.app_context():
+        user = User(username='holder', email='holder@example.com', password_hash='x')
+        db.session.add(user)
+        db.session.flush()
+        btc = Asset.query.filter_by(symbol='BTCUSD').first()
+        db.session.add(PortfolioHolding(user_id=user.id, asset_id=btc.id, quantity=Decimal('1'), average_purchase_price=Decimal('100')))
+        db.session.commit()
+
+        fetched, ticks = [], []
+        fetched_at = datetime.now(timezone.utc)
+        scheduler = PriceRefreshScheduler(
+            fetch_quote=lambda asset: fetched.append(asset.symbol) or Quote(Decimal('42'), fetched_at, False),
+            calls_per_minute=30, on_price=lambda asset, price: ticks.append(price), sleep=fake_sleep, clock=lambda: now[0]
+        )
+        assert scheduler.run_cycle() == 3
+        assert fetched[0] == 'BTCUSD'
+        assert sleeps == [2.0, 2.0] # 30 calls/minute -> one call every 2s
+        assert db.session.get(AssetPrice, btc.id).price == Decimal('42') and len(ticks) == 3
+
+        # During an outage the last known quote is neither re-stamped as fresh nor used as a tick
+        scheduler.fetch_quote = lambda asset: Quote(Decimal('40'), fetched_at - timedelta(hours=1), True)
+        assert scheduler.run_cycle() == 0
+        snapshot = db.session.get(AssetPrice, btc.id)
+        assert snapshot.price == Decimal('42') and as_utc(snapshot.fetched_at) == fetched_at and len(ticks) == 3
+
+def test_price_endpoint_reads_fresh_snapshot_without_upstream_call(test_client, seeded_assets, monkeypatch):
+    def upstream_must_not_be_called(asset):
+        raise AssertionError("upstream called")
+    monkeypatch.setattr(app_module, 'fetch_price_from_alpha_vantage', upstream_must_not_be_called)
+    with test_client.application.app_context():
+        aapl = Asset.query.filter_by(symbol='AAPL').first()
+        store_price_snapshot(aapl.id, Decimal('187.5'))
+        token = create_access_token(identity=json.dumps({'id': 1, 'username': 'reader'}))
+    response = test_client.get('/assets/aapl/price', headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 200
+    assert Decimal(json.loads(response.data)['price']) == Decimal('187.5')
+    # No snapshot: unavailable rather than an inline upstream call (PRICE_FETCH_ON_SNAPSHOT_MISS is off by default)
+    response = test_client.get('/assets/prices?symbols=MSFT', headers={'Authorization': f'Bearer {token}'})
+    assert json.loads(response.data)['prices'] == [{'symbol': 'MSFT', 'asset_type': 'stock', 'error': "Price unavailable."}]
+
+def test_batch_prices_fetch_missing_symbols_concurrently(test_client, seeded_assets, monkeypatch):
+    in_flight = []
+    peak = [0]
+    lock = threading.Lock()
+    def slow_upstream(asset):
+        with lock:
+            in_flight.append(asset.symbol); peak[0] = max(peak[0], len(in_flight))
+        time.sleep(0.2)
+        with lock:
+            in_flight.remove(asset.symbol)
+        return Decimal('10.5')
+    monkeypatch.setattr(app_module, 'fetch_price_from_alpha_vantage', slow_upstream)
+    monkeypatch.setitem(app.config, 'PRICE_FETCH_ON_SNAPSHOT_MISS', True)
+    with test_client.application.app_context():
+        token = create_access_token(identity=json.dumps({'id': 1, 'username': 'reader'}))
+
+    started = time.monotonic()
+    response = test_client.get('/assets/prices?symbols=aapl,MSFT,BTCUSD,NOPE', headers={'Authorization': f'Bearer {token}'})
+    elapsed = time.monotonic() - started
+    assert response.status_code == 200
+    prices = json.loads(response.data)['prices']
+    assert [p['symbol'] for p in prices] == ['AAPL', 'MSFT', 'BTCUSD', 'NOPE']
+    assert all(p['price'] == '10.5' for p in prices[:3])
+    assert prices[3]['error'] == "Asset not found."
+    assert peak[0] == 3
+    assert elapsed < 0.5
+
+def test_history_store_appends_new_bars_and_replaces_the_trailing_one(test_client, seeded_assets):
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    def bars(*days_ago, close_offset=0):
+        return [(today - timedelta(days=d), Decimal(100 - d), Decimal(101 - d), Decimal(99 - d), Decimal(100 - d + close_offset), Decimal(1000))
+                for d in days_ago]
+
+    calls = []
+    upstream = [bars(5, 4) + bars(3, close_offset=-0.5)] # day -3 fetched mid-session
+    now = [0.0]
+    store = HistoryStore(fetch_bars=lambda asset, interval, outputsize: calls.append(outputsize) or upstream[0], clock=lambda: now[0])
+    with test_client.application.app_context():
+        aapl = Asset.query.filter_by(symbol='AAPL').first()
+        assert store.ensure_fresh(aapl, 'daily', 132) == 3
+        upstream[0] = bars(4, 3, 2, 1) # overlaps what we already have
+        assert store.ensure_fresh(aapl, 'daily', 132) == 0 # checked moments ago, no upstream call
+        now[0] += 1000
+        assert store.ensure_fresh(aapl, 'daily', 132) == 3 # day -3 replaced, -2 and -1 appended
+        assert calls == ['full', 'compact']
+        closes = [bar.close for bar in store.read_bars(aapl.id, 'daily', 4)]
+        assert closes == [Decimal(96), Decimal(97), Decimal(98), Decimal(99)] # day -3 now has its final close
+
+        # A partial week keyed by its Wednesday gives way to the finished week keyed by its Friday
+        week = lambda days_ago, close: (today - timedelta(days=days_ago), Decimal(close), Decimal(close), Decimal(close), Decimal(close), None)
+        upstream[0] = [week(16, 90), week(9, 91)]
+        assert store.ensure_fresh(aapl, 'weekly', 156) == 2
+        upstream[0] = [week(16, 90), week(7, 93)]
+        now[0] += 1000
+        assert store.ensure_fresh(aapl, 'weekly', 156) == 1
+        assert [(bar.close, as_utc(bar.timestamp)) for bar in store.read_bars(aapl.id, 'weekly', 10)] == [
+            (Decimal(90), today - timedelta(days=16)), (Decimal(93), today - timedelta(days=7))]
+
+def test_lttb_keeps_endpoints_and_extremes():
+    y = [float(i % 7) for i in range(500)]
+    y[137] = 100.0
+    y[402] = -100.0
+    keep = lttb_indices(range(500), y, 50)
+    assert len(keep) == 50
+    assert keep[0] == 0 and keep[-1] == 499
+    assert 137 in keep and 402 in keep
+    assert list(keep) == sorted(keep)
+
+def test_history_points_parameter_downsamples(test_client, seeded_assets, monkeypatch):
+    monkeypatch.setenv('MOCK_ASSET_PRICES', 'true')
+    with test_client.application.app_context():
+        token = create_access_token(identity=json.dumps({'id': 1, 'username': 'reader'}))
+    headers = {'Authorization': f'Bearer {token}'}
+    response = test_client.get('/assets/AAPL/history?range=1y&points=40', headers=headers)
+    assert response.status_code == 200
+    assert len(json.loads(response.data)['history']) == 40
+    assert test_client.get('/assets/AAPL/history?range=1y&points=2', headers=headers).status_code == 400
+
+class _FakeResponse:
+    def __init__(self, payload):
+        self.payload = payload
+    def raise_for_status(self):
+        pass
+    def json(self):
+        return self.payload
+
+class _FakeSession:
+    def __init__(self, payloads):
+        self.payloads = list(payloads)
+        self.calls = 0
+    def get(self, url, params=None, timeout=None):
+        self.calls += 1
+        return _FakeResponse(self.payloads.pop(0))
+
+def test_market_data_breaker_trips_on_rate_limit_and_serves_last_known():
+    session = _FakeSession([
+        {'Global Quote': {'05. price': '187.50'}},
+        {'Note': 'Thank you for using Alpha Vantage! Our standard API call frequency is 5 calls per minute.'},
+    ])
+    client = AlphaVantageClient(api_key='demo-key', calls_per_minute=600, burst=10, session=session, reset_timeout=60)
+    aapl = Asset(symbol='AAPL', name='Apple Inc.', asset_type='stock')
+    fresh = client.fetch_quote(aapl)
+    assert fresh.price == Decimal('187.50') and not fresh.stale
+    last_known = client.fetch_quote(aapl) # rate limited: last known value, flagged and with its original time
+    assert last_known == (fresh.price, fresh.as_of, True)
+    assert client.breaker.state == 'open'
+    assert client.get_quote(aapl) == Decimal('187.50') # fails fast without calling upstream
+    assert session.calls == 2
+    stats = client.stats()
+    assert stats['rate_limited'] == 1 and stats['rejected_open'] == 1 and stats['latency']['calls'] == 2
+
+def test_token_bucket_refuses_when_budget_cannot_be_met_in_time():
+    now = [0.0]
+    def fake_sleep(seconds):
+        now[0] += seconds
+    bucket = TokenBucket(rate=1.0, capacity=2, clock=lambda: now[0], sleep=fake_sleep)
+    assert bucket.acquire(timeout=0) and bucket.acquire(timeout=0)
+    assert not bucket.acquire(timeout=0.5)
+    assert bucket.acquire(timeout=1.0)
+    assert now[0] == pytest.approx(1.0)
+
+def test_price_broker_polls_each_symbol_once_and_fans_out():
+    polls = []
+    def get_price(asset):
+        polls.append(asset.symbol)
+        return Decimal('101.25')
+    broker = PriceBroker(get_price=get_price, poll_interval=0.05, max_connections_per_user=2)
+    btc = Asset(symbol='BTCUSD', name='Bitcoin', asset_type='crypto')
+    first = broker.subscribe(1, [btc])
+    second = broker.subscribe(2, [btc])
+    for subscription in (first, second):
+        ticks = subscription.next_ticks(timeout=2)
+        assert ticks and ticks[0]['symbol'] == 'BTCUSD' and ticks[0]['price'] == '101.25'
+    assert broker.stats()['symbols_polled'] == ['BTCUSD']
+
+    third = broker.subscribe(1, [btc])
+    with pytest.raises(TooManyConnections):
+        broker.subscribe(1, [btc])
+
+    for subscription in (first, second, third):
+        broker.unsubscribe(subscription)
+    broker.unsubscribe(first) # idempotent
+    assert broker.stats()['connections'] == 0
+
+def test_market_simulator_is_reproducible_and_consistent(tmp_path):
+    now = datetime(2025, 3, 3, 15, 10, tzinfo=timezone.utc)
+    aapl = Asset(symbol='AAPL', name='Apple Inc.', asset_type='stock')
+    sim = MarketSimulator(seed=7)
+    mapped = MarketSimulator(seed=7, cache_dir=str(tmp_path))
+
+    assert sim.quote(aapl, now) == mapped.quote(aapl, now) == MarketSimulator(seed=7, cache_dir=str(tmp_path)).quote(aapl, now)
+    assert sim.quote(aapl, now) != MarketSimulator(seed=8).quote(aapl, now)
+    for range_param, points in (('1d', 24), ('1y', 252), ('3y', 156)):
+        history = sim.history(aapl, range_param, points, now)
+        assert len(history) == points
+        assert Decimal(str(history[-1]['price'])) == sim.quote(aapl, now)
+
+    # Stocks share a common factor, so their daily returns are positively correlated
+    aapl_returns = np.diff(np.log(sim.daily_closes('AAPL', 'stock')))
+    msft_returns = np.diff(np.log(sim.daily_closes('MSFT', 'stock')))
+    assert np.corrcoef(aapl_returns, msft_returns)[0, 1] > 0.3
+
+    # A long-lived worker only keeps the latest two days of intraday paths per symbol
+    first = np.array(sim.intraday_path('AAPL', 'stock', 2000))
+    for day in range(2001, 2030):
+        sim.intraday_path('AAPL', 'stock', day)
+    assert sorted(sim._intraday['AAPL']) == [2028, 2029]
+    assert np.array_equal(sim.intraday_path('AAPL', 'stock', 2000), first) # evicted days regenerate identically
+
+def test_indicators_match_reference_definitions():
+    closes = np.linspace(100, 130, 60) + np.sin(np.arange(60))
+    specs = parse_indicator_spec('sma:5,ema:10,rsi:14,bb:20:2')
+    results = compute_indicators(closes, specs)
+
+    assert np.isnan(results['sma:5'][3])
+    assert results['sma:5'][10] == pytest.approx(closes[6:11].mean())
+    alpha = 2 / 11
+    weights = (1 - alpha) ** np.arange(60)[::-1]
+    assert results['ema:10'][-1] == pytest.approx((weights * closes).sum() / weights.sum())
+    assert 0 <= np.nanmin(results['rsi:14']) and np.nanmax(results['rsi:14']) <= 100
+    band = results['bb:20:2']
+    assert band['upper'][-1] - band['middle'][-1] == pytest.approx(2 * closes[-20:].std())
+    with pytest.raises(ValueError):
+        parse_indicator_spec('macd:12')
+
+def test_indicators_endpoint_aligns_with_history(test_client, seeded_assets, monkeypatch):
+    monkeypatch.setenv('MOCK_ASSET_PRICES', 'true')
+    with test_client.application.app_context():
+        token = create_access_token(identity=json.dumps({'id': 1, 'username': 'reader'}))
+    response = test_client.get('/assets/AAPL/indicators?range=6m&ind=sma:20,bb:20:2', headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 200
+    payload = json.loads(response.data)
+    assert len(payload['dates']) == len(payload['close']) == len(payload['indicators']['sma:20']) == 132
+    assert payload['indicators']['sma:20'][18] is None and payload['indicators']['sma:20'][19] is not None
+
+def _create_user(username, cash='10000.00'):
+    user = User(username=username, email=f'{username}@example.com', cash_balance=Decimal(cash))
+    user.set_password('password')
+    db.session.add(user)
+    db.session.commit()
+    token = create_access_token(identity=json.dumps({'id': user.id, 'username': username}))
+    return user.id, {'Authorization': f'Bearer {token}'}
+
+@contextmanager
+def statement_counter(engine):
+    """Collects the SQL statements run on `engine` inside the block (pair with quiet_revocations for authenticated calls)."""
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', listener)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', listener)
+
+def test_trade_order_buy_then_sell_updates_cash_and_holding(test_client, seeded_assets, monkeypatch):
+    monkeypatch.setattr(app_module, 'get_current_price_for_asset', lambda asset: Decimal('100'))
+    with test_client.application.app_context():
+        user_id, headers = _create_user('trader')
+    order = lambda order_type, qty: test_client.post('/trades/order', headers=headers, json={'asset_symbol': 'AAPL', 'order_type': order_type, 'quantity': qty})
+
+    response = order('market_buy', '3')
+    assert response.status_code == 201
+    body = json.loads(response.data)
+    assert Decimal(body['holding_updated']['quantity']) == 3
+    assert body['trade']['asset_symbol'] == 'AAPL'
+    assert order('market_sell', '5').status_code == 400
+    assert json.loads(order('market_sell', '3').data)['holding_updated'] is None
+    assert order('market_buy', '101').status_code == 400 # 10100 > 10000
+    with test_client.application.app_context():
+        assert db.session.get(User, user_id).cash_balance == Decimal('10000')
+        assert PortfolioHolding.query.filter_by(user_id=user_id).count() == 0
+
+def test_concurrent_trade_orders_never_lose_balance(test_client, seeded_assets, monkeypatch):
+    monkeypatch.setattr(app_module, 'get_current_price_for_asset', lambda asset: Decimal('100'))
+    with test_client.application.app_context():
+        user_id, headers = _create_user('stress', cash='5000.00')
+
+    # 60 concurrent buys of 100 each against 5000 of cash: exactly 50 may succeed
+    statuses = []
+    def worker():
+        client = app.test_client()
+        for _ in range(10):
+            response = client.post('/trades/order', headers=headers, json={'asset_symbol': 'BTCUSD', 'order_type': 'market_buy', 'quantity': '1'})
+            statuses.append(response.status_code)
+    threads = [threading.Thread(target=worker) for _ in range(6)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+    assert statuses.count(201) == 50 and statuses.count(400) == 10
+    with test_client.application.app_context():
+        assert db.session.get(User, user_id).cash_balance == Decimal('0')
+        holding = PortfolioHolding.query.filter_by(user_id=user_id).one()
+        assert holding.quantity == Decimal('50')
+        assert Trade.query.filter_by(user_id=user_id).count() == 50
+
+def test_batch_orders_all_or_nothing_and_best_effort(test_client, seeded_assets, monkeypatch):
+    monkeypatch.setattr(app_module, 'get_current_prices_for_assets', lambda assets: {a.symbol: Decimal('100') for a in assets})
+    with test_client.application.app_context():
+        user_id, headers = _create_user('batcher', cash='1000.00')
+    batch = lambda mode, orders: test_client.post('/trades/orders', headers=headers, json={'mode': mode, 'orders': orders})
+    buy = lambda symbol, qty: {'asset_symbol': symbol, 'order_type': 'market_buy', 'quantity': qty}
+
+    # The second buy overdraws, so nothing is executed
+    response = batch('all_or_nothing', [buy('AAPL', '5'), buy('MSFT', '6')])
+    assert response.status_code == 400
+    assert [r['status'] for r in json.loads(response.data)['results']] == ['not_executed', 'rejected']
+    with test_client.application.app_context():
+        assert db.session.get(User, user_id).cash_balance == Decimal('1000')
+        assert Trade.query.filter_by(user_id=user_id).count() == 0
+
+    # Identical legs keep their own positions in the results
+    response = batch('all_or_nothing', [buy('AAPL', '4')] * 3)
+    assert [(r['index'], r['status']) for r in json.loads(response.data)['results']] == [(0, 'not_executed'), (1, 'not_executed'), (2, 'rejected')]
+
+    response = batch('best_effort', [buy('AAPL', '5'), buy('MSFT', '6'), buy('NOPE', '1')])
+    assert response.status_code == 201
+    body = json.loads(response.data)
+    assert [r['status'] for r in body['results']] == ['filled', 'rejected', 'rejected']
+    assert Decimal(body['cash_balance']) == Decimal('500')
+
+    # Sells run first, so their proceeds fund the buy in the same batch
+    response = batch('all_or_nothing', [buy('MSFT', '10'), {'asset_symbol': 'AAPL', 'order_type': 'market_sell', 'quantity': '5'}])
+    assert response.status_code == 201
+    with test_client.application.app_context():
+        assert db.session.get(User, user_id).cash_balance == Decimal('0')
+        assert PortfolioHolding.query.filter_by(user_id=user_id).one().quantity == Decimal('10')
+        assert Trade.query.filter_by(user_id=user_id).count() == 3
+
+def test_order_book_pops_only_crossing_orders_and_skips_cancelled():
+    book = OrderBook()
+    book.add(1, 7, 'limit_buy', Decimal('95'))
+    book.add(2, 7, 'limit_buy', Decimal('99'))
+    book.add(3, 7, 'stop_sell', Decimal('90'))
+    book.add(4, 7, 'limit_sell', Decimal('110'))
+    book.add(5, 7, 'stop_buy', Decimal('105'))
+    book.add(6, 7, 'limit_buy', Decimal('98'))
+    book.discard(6)
+    assert book.crossing(7, Decimal('100')) == []
+    assert book.crossing(7, Decimal('97')) == [2]
+    assert book.crossing(7, Decimal('90')) == [1, 3] # cancelled 6 is skipped, oldest first
+    assert book.crossing(7, Decimal('106')) == [5]
+    assert book.crossing(8, Decimal('106')) == []
+    assert book.stats()['open_orders'] == 1
+
+    # Cancelled entries are compacted away once they outnumber the live ones
+    for order_id in range(10, 20):
+        book.add(order_id, 9, 'limit_sell', Decimal(order_id))
+    for order_id in range(10, 16):
+        book.discard(order_id)
+    assert book.stats()['heap_entries'] == 1 + 4
+    assert book.crossing(9, Decimal('100')) == [16, 17, 18, 19]
+
+def test_open_orders_fill_on_tick_and_cancel(test_client, seeded_assets):
+    with test_client.application.app_context():
+        user_id, headers = _create_user('limiter', cash='1000.00')
+    place = lambda order_type, qty, trigger: test_client.post('/trades/open-orders', headers=headers, json={
+        'asset_symbol': 'AAPL', 'order_type': order_type, 'quantity': qty, 'trigger_price': trigger})
+    limit_buy = json.loads(place('limit_buy', '2', '100').data)['order']
+    too_big = json.loads(place('limit_buy', '50', '100').data)['order']
+    to_cancel = json.loads(place('limit_buy', '1', '99').data)['order']
+    assert place('limit_buy', '1', '-5').status_code == 400
+    assert test_client.delete(f"/trades/open-orders/{to_cancel['id']}", headers=headers).status_code == 200
+    assert test_client.delete(f"/trades/open-orders/{to_cancel['id']}", headers=headers).status_code == 409
+
+    with test_client.application.app_context():
+        matcher = OrderMatcher()
+        aapl = Asset.query.filter_by(symbol='AAPL').one()
+        assert matcher.on_price(aapl, Decimal('101')) == 0
+        assert matcher.on_price(aapl, Decimal('98')) == 1
+        trade = Trade.query.filter_by(user_id=user_id).one()
+        assert trade.order_type == 'limit_buy' and trade.price_at_execution == Decimal('98')
+        trade_id = trade.id
+        assert db.session.get(User, user_id).cash_balance == Decimal('804')
+        assert matcher.stats()['open_orders'] == 0 and matcher.rejections == 1
+
+        # An order whose lower id commits after a higher one was synced is still picked up
+        late = OpenOrder(id=limit_buy['id'] + 100, user_id=user_id, asset_id=aapl.id, order_type='limit_sell',
+                         quantity=Decimal('1'), trigger_price=Decimal('200'))
+        db.session.add(late); db.session.commit()
+        matcher.sync()
+        db.session.add(OpenOrder(id=limit_buy['id'] + 50, user_id=user_id, asset_id=aapl.id, order_type='limit_sell',
+                                 quantity=Decimal('1'), trigger_price=Decimal('200')))
+        db.session.commit()
+        matcher.sync()
+        assert matcher.stats()['open_orders'] == 2
+
+        # A fill that fails for another reason than a rejection leaves the order resting for the next tick
+        fill = matcher.fill
+        matcher.fill = lambda order_id, asset, price: (_ for _ in ()).throw(RuntimeError('lock timeout'))
+        assert matcher.on_price(aapl, Decimal('201')) == 0 and matcher.stats()['open_orders'] == 2
+        matcher.fill = fill
+        assert matcher.on_price(aapl, Decimal('201')) == 2 and matcher.stats()['open_orders'] == 0
+
+    orders = {o['id']: o for o in json.loads(test_client.get('/trades/open-orders?status=all', headers=headers).data)['orders']}
+    assert orders[limit_buy['id']]['status'] == 'filled' and orders[limit_buy['id']]['trade_id'] == trade_id
+    assert orders[too_big['id']]['status'] == 'rejected'
+    assert orders[to_cancel['id']]['status'] == 'cancelled'
+    assert json.loads(test_client.get('/trades/open-orders', headers=headers).data) == {'orders': []}
+
+def test_portfolio_query_count_is_constant(test_client, seeded_assets, quiet_revocations):
+    with test_client.application.app_context():
+        for i in range(8):
+            db.session.add(Asset(symbol=f'STK{i}', name=f'Stock {i}', asset_type='stock'))
+        db.session.commit()
+        assets = Asset.query.order_by(Asset.id).all()
+        small_id, small_headers = _create_user('small')
+        large_id, large_headers = _create_user('large')
+        db.session.add(PortfolioHolding(user_id=small_id, asset_id=assets[0].id, quantity=Decimal('1'), average_purchase_price=Decimal('10')))
+        for asset in assets:
+            db.session.add(PortfolioHolding(user_id=large_id, asset_id=asset.id, quantity=Decimal('2'), average_purchase_price=Decimal('10')))
+        db.session.commit()
+        engine = db.engine
+
+    def count_statements(headers):
+        app_module.price_cache.clear()
+        with statement_counter(engine) as statements:
+            response = test_client.get('/portfolio', headers=headers)
+        assert response.status_code == 200
+        return len(statements), json.loads(response.data)
+
+    small_count, small = count_statements(small_headers)
+    large_count, large = count_statements(large_headers)
+    assert len(small['holdings']) == 1 and len(large['holdings']) == len(assets)
+    assert small_count == large_count <= 3
+    assert set(large['holdings'][0]) == {'asset_id', 'symbol', 'name', 'quantity', 'average_purchase_price', 'current_price',
+                                         'current_value', 'holding_cost', 'profit_loss', 'profit_loss_percent'}
+    assert Decimal(large['summary']['total_portfolio_cost']) == Decimal('20') * len(assets)
+
+def test_portfolio_snapshots_only_revalue_changed_users(test_client, seeded_assets, monkeypatch):
+    monkeypatch.setattr(app_module, 'get_current_price_for_asset', lambda asset: Decimal('100'))
+    with test_client.application.app_context():
+        trader_id, headers = _create_user('snap_trader', cash='1000.00')
+        idle_id, _ = _create_user('snap_idle', cash='500.00')
+    assert test_client.post('/trades/order', headers=headers, json={'asset_symbol': 'AAPL', 'order_type': 'market_buy', 'quantity': '2'}).status_code == 201
+
+    t0 = datetime.now(timezone.utc)
+    with test_client.application.app_context():
+        aapl = Asset.query.filter_by(symbol='AAPL').one()
+        assert take_portfolio_snapshots(now=t0) == 2
+        assert take_portfolio_snapshots(now=t0 + timedelta(minutes=5)) == 0 # nothing changed
+        store_price_snapshot(aapl.id, Decimal('150'), fetched_at=t0 + timedelta(minutes=6))
+        assert take_portfolio_snapshots(now=t0 + timedelta(minutes=10)) == 1 # only the holder is revalued
+        assert take_portfolio_snapshots(full=True, now=t0 + timedelta(minutes=15)) == 2
+
+    response = test_client.get('/portfolio/history?range=1w', headers=headers)
+    assert response.status_code == 200
+    history = json.loads(response.data)['history']
+    assert [h['total_value'] for h in history] == ['1000.00', '1100.00', '1100.00']
+    assert history[1]['cash'] == '800.00' and history[1]['holdings_value'] == '300.00'
+    assert len(json.loads(test_client.get('/portfolio/history?range=1w&points=3', headers=headers).data)['history']) == 3
+    assert test_client.get('/portfolio/history?range=5y', headers=headers).status_code == 400
+
+def test_leaderboard_ranks_incrementally_by_cohort(test_client, seeded_assets, monkeypatch):
+    monkeypatch.setattr(app_module, 'get_current_price_for_asset', lambda asset: Decimal('100'))
+    board = app_module.leaderboard
+    monkeypatch.setattr(board, 'sync_interval', 3600) # only explicit syncs below
+    with test_client.application.app_context():
+        alice_id, alice = _create_user('lb_alice', cash='1000.00')
+        bob_id, bob = _create_user('lb_bob', cash='900.00')
+        carol_id, _ = _create_user('lb_carol', cash='800.00')
+        for user_id in (alice_id, bob_id):
+            db.session.get(User, user_id).cohort = 'spring'
+        db.session.commit()
+        board.load()
+
+    def ranking(headers, query=''):
+        body = json.loads(test_client.get(f'/leaderboard{query}', headers=headers).data)
+        return [e['username'] for e in body['entries']], body['me'], body['total']
+
+    assert ranking(bob) == (['lb_alice', 'lb_bob', 'lb_carol'], {'rank': 2, 'total_value': '900.00'}, 3)
+    assert ranking(bob, '?cohort=spring&per_page=1&page=2') == (['lb_bob'], {'rank': 2, 'total_value': '900.00'}, 2)
+    assert ranking(alice, '?cohort=autumn')[1:] == (None, 0)
+
+    # Bob buys 5 AAPL at 100: value unchanged until the stored price moves
+    assert test_client.post('/trades/order', headers=bob, json={'asset_symbol': 'AAPL', 'order_type': 'market_buy', 'quantity': '5'}).status_code == 201
+    assert ranking(bob)[1] == {'rank': 2, 'total_value': '900.00'}
+    with test_client.application.app_context():
+        store_price_snapshot(Asset.query.filter_by(symbol='AAPL').one().id, Decimal('130'))
+        board.sync()
+    assert ranking(bob) == (['lb_bob', 'lb_alice', 'lb_carol'], {'rank': 1, 'total_value': '1050.00'}, 3)
+    assert board.stats()['assets_held'] == 1
+    assert test_client.get('/leaderboard?per_page=0', headers=bob).status_code == 400
+
+    # A worker's first request doesn't build the board inline: it is refused until the background refresh has run
+    cold = Leaderboard()
+    monkeypatch.setattr(app_module, 'leaderboard', cold)
+    monkeypatch.setattr(cold, 'start', lambda run_refresh: None)
+    response = test_client.get('/leaderboard', headers=bob)
+    assert response.status_code == 503 and response.headers['Retry-After']
+    with cold._refreshing:
+        assert cold.refresh() is False # single flight
+    with test_client.application.app_context():
+        assert cold.refresh() is True
+    assert ranking(bob)[1] == {'rank': 1, 'total_value': '1050.00'}
+
+def test_ranked_list_matches_a_sorted_list():
+    import random
+    rng = random.Random(7)
+    ranked, reference = RankedList(load=4), []
+    for step in range(3000):
+        if reference and rng.random() < 0.45:
+            key = reference.pop(rng.randrange(len(reference)))
+            ranked.remove(key)
+        else:
+            key = (rng.randint(-500, 500), step)
+            ranked.add(key)
+            reference.append(key)
+            reference.sort()
+        if step % 50 == 0:
+            assert len(ranked) == len(reference)
+            assert ranked.islice(0, len(reference)) == reference
+            start = rng.randrange(len(reference) + 1)
+            assert ranked.islice(start, start + 7) == reference[start:start + 7]
+            probe = (rng.randint(-520, 520), 0)
+            assert ranked.index(probe) == bisect.bisect_left(reference, probe)
+    with pytest.raises(ValueError):
+        ranked.remove((1000, 0))
+
+def test_fifo_positions_and_risk_metrics():
+    asset_ids = np.array([1, 2, 1, 1, 2, 1])
+    is_buy = np.array([True, True, True, False, False, False])
+    quantities = np.array([10, 4, 10, 15, 4, 2], dtype=np.float64)
+    prices = np.array([100, 50, 120, 130, 40, 110], dtype=np.float64)
+    timestamps = np.arange(6).astype('datetime64[s]')
+    positions = fifo_positions(asset_ids, is_buy, quantities, prices, timestamps)
+    # Asset 1: sell 15 consumes 10@100 + 5@120 (350 gain), sell 2 consumes 2@120 (20 loss); 3@120 left
+    assert positions[1]['realized_pnl'] == pytest.approx(330)
+    assert positions[1]['open_quantity'] == pytest.approx(3) and positions[1]['open_cost'] == pytest.approx(360)
+    assert [lot[:2] for lot in positions[1]['lots']] == [(3.0, 120.0)]
+    assert positions[2] == {'realized_pnl': pytest.approx(-40), 'open_quantity': 0.0, 'open_cost': 0.0, 'lots': []}
+
+    metrics = risk_metrics(np.array([100.0, 120.0, 90.0, 110.0]))
+    assert metrics['max_drawdown'] == pytest.approx(0.25)
+    assert metrics['total_return'] == pytest.approx(0.10)
+    returns = np.array([0.2, -0.25, 20 / 90])
+    assert metrics['sharpe_ratio'] == pytest.approx(returns.mean() / returns.std(ddof=1) * np.sqrt(252))
+
+def test_portfolio_performance_endpoint_is_memoized_until_next_trade(test_client, seeded_assets, monkeypatch):
+    price = {'value': Decimal('100')}
+    monkeypatch.setattr(app_module, 'get_current_price_for_asset', lambda asset: price['value'])
+    monkeypatch.setattr(app_module, 'get_current_prices_for_assets', lambda assets: {a.symbol: Decimal('150') for a in assets})
+    with test_client.application.app_context():
+        _, headers = _create_user('perf', cash='10000.00')
+    trade = lambda order_type, qty: test_client.post('/trades/order', headers=headers, json={'asset_symbol': 'AAPL', 'order_type': order_type, 'quantity': qty})
+    trade('market_buy', '10')
+    price['value'] = Decimal('120'); trade('market_buy', '10')
+    price['value'] = Decimal('130'); trade('market_sell', '15')
+
+    loads = []
+    compute = app_module.compute_performance
+    monkeypatch.setattr(app_module, 'compute_performance', lambda user_id: loads.append(user_id) or compute(user_id))
+    body = json.loads(test_client.get('/portfolio/performance?lots=true', headers=headers).data)
+    assert body['realized_pnl'] == '350.00' and body['unrealized_pnl'] == '150.00' and body['total_pnl'] == '500.00'
+    assert body['assets'][0]['lots'][0]['quantity'] == '5.00000000' and body['trade_count'] == 3
+    test_client.get('/portfolio/performance', headers=headers)
+    assert len(loads) == 1
+    trade('market_sell', '5')
+    body = json.loads(test_client.get('/portfolio/performance', headers=headers).data)
+    assert len(loads) == 2 and body['realized_pnl'] == '400.00' and body['unrealized_pnl'] == '0.00'
+
+def test_reconcile_reports_and_repairs_holding_drift(test_client, seeded_assets, monkeypatch):
+    price = {'value': Decimal('100')}
+    monkeypatch.setattr(app_module, 'get_current_price_for_asset', lambda asset: price['value'])
+    with test_client.application.app_context():
+        users = [_create_user(f'recon{i}') for i in range(3)]
+    for i, (_, headers) in enumerate(users):
+        for symbol, qty, new_price in (('AAPL', '4', '100'), ('AAPL', '2', '130'), ('MSFT', '3', '50')):
+            price['value'] = Decimal(new_price) + i
+            test_client.post('/trades/order', headers=headers, json={'asset_symbol': symbol, 'order_type': 'market_buy', 'quantity': qty})
+        test_client.post('/trades/order', headers=headers, json={'asset_symbol': 'MSFT', 'order_type': 'market_sell', 'quantity': '3'})
+
+    def summary(**kwargs):
+        totals = {}
+        for report in reconcile(partitions=2, **kwargs):
+            for key, value in report.items():
+                if isinstance(value, int):
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+
+    with test_client.application.app_context():
+        assets = {a.symbol: a.id for a in Asset.query.all()}
+        (u0, _), (u1, _), (u2, _) = users
+        assert summary()['trades'] == 12
+        assert all(summary()[kind] == 0 for kind in ('missing', 'unexpected', 'quantity', 'average_cost'))
+
+        db.session.get(PortfolioHolding, (u0, assets['AAPL'])).quantity = Decimal('5')
+        db.session.get(PortfolioHolding, (u1, assets['AAPL'])).average_purchase_price = Decimal('1')
+        db.session.delete(db.session.get(PortfolioHolding, (u2, assets['AAPL'])))
+        db.session.add(PortfolioHolding(user_id=u2, asset_id=assets['BTCUSD'], quantity=Decimal('1'), average_purchase_price=Decimal('1')))
+        db.session.get(User, u0).cash_balance += Decimal('500')
+        db.session.commit()
+
+        found = summary()
+        assert (found['quantity'], found['average_cost'], found['missing'], found['unexpected'], found['cash_adjusted']) == (1, 1, 1, 1, 1)
+        assert summary(repair=True)['repaired'] == 4
+        fixed = summary()
+        assert all(fixed[kind] == 0 for kind in ('missing', 'unexpected', 'quantity', 'average_cost'))
+        holding = db.session.get(PortfolioHolding, (u1, assets['AAPL']))
+        assert holding.quantity == Decimal('6') and holding.average_purchase_price == Decimal('111')
+
+def test_trades_keyset_pagination_and_streaming_export(test_client, seeded_assets, monkeypatch):
+    monkeypatch.setattr(app_module, 'get_current_price_for_asset', lambda asset: Decimal('10'))
+    with test_client.application.app_context():
+        _, headers = _create_user('pager')
+    for i in range(7): # several share a timestamp, so ties are broken by id
+        test_client.post('/trades/order', headers=headers, json={'asset_symbol': 'AAPL' if i % 2 else 'MSFT', 'order_type': 'market_buy', 'quantity': '1'})
+
+    all_trades = json.loads(test_client.get('/trades', headers=headers).data)['trades']
+    assert len(all_trades) == 7 and all_trades[0]['asset_symbol'] == 'MSFT'
+
+    def walk(order):
+        ids, cursor = [], None
+        while True:
+            query = f'/trades?limit=3&order={order}' + (f'&cursor={cursor}' if cursor else '')
+            body = json.loads(test_client.get(query, headers=headers).data)
+            ids += [t['id'] for t in body['trades']]
+            cursor = body['next_cursor']
+            if not cursor:
+                return ids
+    assert walk('asc') == [t['id'] for t in all_trades]
+    assert walk('desc') == [t['id'] for t in reversed(all_trades)]
+    assert len(json.loads(test_client.get('/trades?limit=5&asset=AAPL', headers=headers).data)['trades']) == 3
+    assert test_client.get('/trades?limit=3&cursor=bogus', headers=headers).status_code == 400
+
+    ndjson = test_client.get('/trades/export?format=ndjson', headers=headers)
+    lines = ndjson.get_data(as_text=True).splitlines()
+    assert ndjson.mimetype == 'application/x-ndjson' and [json.loads(line) for line in lines] == all_trades
+    csv_rows = test_client.get('/trades/export?format=csv', headers=headers).get_data(as_text=True).splitlines()
+    assert csv_rows[0].startswith('id,user_id,asset_id,asset_symbol') and len(csv_rows) == 8
+
+def test_explain_hot_queries_flags_missing_index_and_rolls_back(test_client):
+    runner = app.test_cli_runner()
+    with app.app_context():
+        users_before = db.session.execute(db.select(db.func.count(User.id))).scalar()
+
+    result = runner.invoke(args=['explain-hot-queries', '--seed-rows', '2000'])
+    assert result.exit_code == 0, result.output
+    assert 'GET /trades: ok' in result.output and 'FULL SCAN' not in result.output
+    with app.app_context():
+        assert db.session.execute(db.select(db.func.count(User.id))).scalar() == users_before # seeded rows rolled back
+
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql('DROP INDEX ix_trades_user_timestamp')
+            connection.exec_driver_sql('DROP INDEX ix_trades_user_asset_timestamp') # also leads with user_id
+    result = runner.invoke(args=['explain-hot-queries', '--seed-rows', '2000'])
+    assert result.exit_code != 0 and 'GET /trades: FULL SCAN of trades' in result.output
+
+    result = runner.invoke(args=['create-indexes'])
+    assert 'Created ix_trades_user_timestamp on trades.' in result.output and 'Created 2 indexes.' in result.output
+    assert runner.invoke(args=['explain-hot-queries', '--seed-rows', '2000']).exit_code == 0
+
+def test_list_endpoints_encode_the_same_values_as_to_dict(test_client, seeded_assets, monkeypatch):
+    monkeypatch.setattr(app_module, 'get_current_price_for_asset', lambda asset: Decimal('12.5'))
+    with test_client.application.app_context():
+        user_id, headers = _create_user('lister')
+        db.session.get(User, user_id).is_admin = True
+        module = Module(title='Basics', order=1)
+        db.session.add(module); db.session.flush()
+        lesson = EducationalContent(title='Quotes "and" escapes \u00e9', content_type='article', body='b', author_id=user_id, module_id=module.id)
+        db.session.add(lesson); db.session.flush()
+        quiz = Quiz(title='Q1', lesson_id=lesson.id)
+        db.session.add(quiz); db.session.flush()
+        db.session.add(QuizQuestion(quiz_id=quiz.id, question_text='?', choices=['a', 'b'], correct_answer='a'))
+        db.session.add(News(title='n', preview='p', content='c'))
+        db.session.commit()
+        expected_lesson = lesson.to_dict()
+        expected_quiz = quiz.to_dict(include_questions=True)
+        expected_module = module.to_dict(include_lessons=True)
+    test_client.post('/trades/order', headers=headers, json={'asset_symbol': 'BTCUSD', 'order_type': 'market_buy', 'quantity': '0.12345678'})
+
+    assert json.loads(test_client.get('/content').data)['contents'] == [expected_lesson]
+    assert json.loads(test_client.get('/admin/lessons', headers=headers).data)['lessons'] == [expected_lesson]
+    assert json.loads(test_client.get('/admin/quizzes', headers=headers).data)['quizzes'] == [expected_quiz]
+    assert json.loads(test_client.get('/admin/modules', headers=headers).data)['modules'] == [expected_module]
+    trades = json.loads(test_client.get('/trades', headers=headers).data)['trades']
+    with test_client.application.app_context():
+        assert trades == [trade.to_dict() for trade in Trade.query.filter_by(user_id=user_id)]
+        assert trades[0]['quantity'] == '0.12345678'
+        # Streamed in chunks, the array is still well formed
+        rows = db.session.execute(TRADE_FIELDS.select()).all()
+        assert json.loads(''.join(TRADE_FIELDS.iter_list(rows * 5, chunk_rows=2))) == trades * 5
+        assert json.loads(''.join(TRADE_FIELDS.iter_list([]))) == []
+
+def test_admin_role_claim_skips_user_lookup_until_demoted(test_client, seeded_assets, quiet_revocations):
+    app_module.role_cache.clear()
+    with test_client.application.app_context():
+        admin_id, _ = _create_user('boss')
+        db.session.get(User, admin_id).is_admin = True
+        _create_user('staff')
+        db.session.commit()
+        engine = db.engine
+    login = lambda name: {'Authorization': 'Bearer ' + json.loads(test_client.post(
+        '/auth/login', json={'username_or_email': name, 'password': 'password'}).data)['access_token']}
+    admin_headers, staff_headers = login('boss'), login('staff')
+    with test_client.application.app_context():
+        assert decode_token(admin_headers['Authorization'][7:])['is_admin'] is True
+
+    def call(path, headers):
+        with statement_counter(engine) as statements:
+            status = test_client.get(path, headers=headers).status_code
+        return status, len(statements)
+
+    assert call('/admin/price-cache', staff_headers) == (403, 0) # refused on the claim alone
+    assert call('/admin/price-cache', admin_headers) == (200, 1) # role confirmed once...
+    assert call('/admin/price-cache', admin_headers) == (200, 0) # ...then served from the role cache
+    assert call('/protected', admin_headers) == (200, 0)
+
+    # Demoted elsewhere: the claim stays valid until the cached role expires
+    with test_client.application.app_context():
+        db.session.get(User, admin_id).is_admin = False
+        db.session.commit()
+    assert call('/admin/price-cache', admin_headers)[0] == 200
+    app_module.role_cache.invalidate(admin_id) # TTL elapsed
+    assert call('/admin/price-cache', admin_headers)[0] == 403
+
+    # Demoted through the API: immediate in this process
+    with test_client.application.app_context():
+        db.session.get(User, admin_id).is_admin = True
+        db.session.commit()
+    app_module.role_cache.invalidate(admin_id)
+    assert test_client.post(f'/admin/users/{admin_id}/set-admin', headers=admin_headers, json={'is_admin': False}).status_code == 200
+    assert call('/admin/price-cache', admin_headers)[0] == 403
+    app_module.role_cache.clear()
+
+def test_login_hashes_in_pool_upgrades_old_hashes_and_sheds_load(test_client, seeded_assets, monkeypatch):
+    with test_client.application.app_context():
+        user = User(username='legacy', email='legacy@example.com', password_hash=generate_password_hash('secret', method='pbkdf2:sha256:1000'))
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+    login = lambda password: test_client.post('/auth/login', json={'username_or_email': 'legacy', 'password': password})
+
+    assert login('wrong').status_code == 401
+    assert login('secret').status_code == 200
+    with test_client.application.app_context():
+        upgraded = db.session.get(User, user_id).password_hash
+    assert upgraded.startswith('scrypt:') and not app_module.password_hasher.needs_rehash(upgraded)
+    assert login('secret').status_code == 200
+
+    # Every slot taken: sign-ins fail fast instead of queueing
+    busy = PasswordHasher(workers=1, max_pending=0)
+    monkeypatch.setattr(app_module, 'password_hasher', busy)
+    busy._slots.acquire()
+    response = login('secret')
+    assert response.status_code == 503 and busy.stats()['rejected_busy'] == 1
+    assert test_client.post('/auth/register', json={'username': 'x', 'email': 'x@example.com', 'password': 'p'}).status_code == 503
+    busy._slots.release()
+
+    slow = PasswordHasher(method='scrypt', workers=1, timeout=0.001)
+    with pytest.raises(HashingUnavailable):
+        slow.hash('secret')
+    slow.shutdown()
+    assert PasswordHasher(workers=0).verify(upgraded, 'secret')
+
+    # A hash abandoned after its timeout keeps its slot until it really finishes
+    import passwords
+    from concurrent.futures import ThreadPoolExecutor
+    release = threading.Event()
+    monkeypatch.setattr(passwords, '_hash', lambda password, method: release.wait() and 'hashed')
+    stuck = PasswordHasher(workers=1, max_pending=0, timeout=0.01)
+    stuck._executor = ThreadPoolExecutor(max_workers=1)
+    with pytest.raises(HashingUnavailable):
+        stuck.hash('first') # times out, still running
+    with pytest.raises(HashingUnavailable):
+        stuck.hash('second') # refused: the abandoned hash still holds the only slot
+    assert stuck.stats()['timed_out'] == 1 and stuck.stats()['rejected_busy'] == 1
+    release.set()
+    stuck.shutdown()
+    assert stuck._slots.acquire(blocking=False)
+
+def test_refresh_token_flow_and_logout_revocation(test_client, seeded_assets, monkeypatch):
+    with test_client.application.app_context():
+        _create_user('student')
+    tokens = json.loads(test_client.post('/auth/login', json={'username_or_email': 'student', 'password': 'password'}).data)
+    bearer = lambda token: {'Authorization': f'Bearer {token}'}
+
+    def no_hashing(*args):
+        raise AssertionError("refresh must not check a password")
+    monkeypatch.setattr(app_module.password_hasher, 'verify', no_hashing)
+    refreshed = test_client.post('/auth/refresh', headers=bearer(tokens['refresh_token']))
+    assert refreshed.status_code == 200
+    access_token = json.loads(refreshed.data)['access_token']
+    assert test_client.get('/protected', headers=bearer(access_token)).status_code == 200
+    assert test_client.post('/auth/refresh', headers=bearer(access_token)).status_code == 422 # access tokens can't refresh
+
+    response = test_client.post('/auth/logout', headers=bearer(access_token), json={'refresh_token': tokens['refresh_token']})
+    assert response.status_code == 200
+    assert test_client.get('/protected', headers=bearer(access_token)).status_code == 401
+    assert test_client.post('/auth/refresh', headers=bearer(tokens['refresh_token'])).status_code == 401
+    assert test_client.get('/protected', headers=bearer(tokens['access_token'])).status_code == 200 # not presented, not revoked
+
+    # Another worker learns about the revocation from the table; unknown ids are answered by the filter alone
+    with test_client.application.app_context():
+        other = RevocationStore(capacity=1000)
+        assert other.is_revoked(decode_token(tokens['refresh_token'])['jti'])
+        assert not other.is_revoked('not-a-revoked-jti')
+        assert other.stats()['lookups'] <= 2
+
+    bloom = BloomFilter(1000, error_rate=0.01)
+    for i in range(1000):
+        bloom.add(f'jti-{i}')
+    assert all(f'jti-{i}' in bloom for i in range(1000))
+    assert sum(f'other-{i}' in bloom for i in range(10000)) < 300
+
+def test_import_users_bulk_creates_and_reports_rejected_rows(test_client, seeded_assets, tmp_path):
+    with test_client.application.app_context():
+        _create_user('taken')
+    rows = ['username,email,password,cohort']
+    rows += [f'pupil{i},pupil{i}@school.example,pw{i},class-a' for i in range(25)]
+    rows += ['taken,new@school.example,pw,', # existing username
+             'pupil3,other@school.example,pw,', # repeated in the file
+             'nopass,nopass@school.example,,',
+             'bademail,not-an-email,pw,']
+    csv_path = tmp_path / 'users.csv'
+    csv_path.write_text('\n'.join(rows) + '\n')
+    report_path = tmp_path / 'errors.csv'
+
+    result = app.test_cli_runner().invoke(args=['import-users', str(csv_path), '--workers', '2', '--batch-size', '10',
+                                               '--method', 'pbkdf2:sha256:1000', '--report', str(report_path)])
+    assert result.exit_code == 0, result.output
+    assert 'Created 25 of 29 users' in result.output
+    errors = report_path.read_text().splitlines()
+    assert errors[0] == 'line,username,email,error' and len(errors) == 5
+    assert errors[1].startswith('27,taken,') and 'username already exists' in errors[1]
+    with test_client.application.app_context():
+        pupil = User.query.filter_by(username='pupil7').one()
+        assert pupil.cohort == 'class-a' and pupil.cash_balance == Decimal('10000.00') and pupil.check_password('pw7')
+
+    # Running it again creates nothing: every row is now a duplicate
+    result = app.test_cli_runner().invoke(args=['import-users', str(csv_path), '--workers', '0', '--method', 'pbkdf2:sha256:1000'])
+    assert 'Created 0 of 29 users' in result.output and '... 9 more' in result.output
+
+def test_import_users_falls_back_per_row_when_copy_hits_a_late_duplicate(test_client, seeded_assets, monkeypatch):
+    import psycopg2.errors
+    import user_import
+
+    class ConflictingCopyCursor:
+        def copy_expert(self, statement, buffer):
+            raise psycopg2.errors.UniqueViolation('duplicate key value violates unique constraint "users_username_key"')
+
+        def close(self):
+            pass
+
+    # 'late' is created after the prefetch of taken names, so only the batch insert can catch it
+    monkeypatch.setattr(user_import, 'existing_identities', lambda: (set(), set()))
+    monkeypatch.setattr(user_import, '_uses_copy', lambda: True)
+    monkeypatch.setattr(user_import, '_driver_cursor', ConflictingCopyCursor)
+    lines = ['username,email,password', 'first,first@school.example,pw', 'late,late@school.example,pw', 'last,last@school.example,pw']
+    with test_client.application.app_context():
+        _create_user('late')
+        report = user_import.import_users(lines, method='pbkdf2:sha256:1000', workers=0, batch_size=10)
+        assert report.created == 2 and [error[:2] for error in report.errors] == [(3, 'late')]
+        assert sorted(username for (username,) in db.session.execute(db.select(User.username))) == ['first', 'last', 'late']
+
+def test_content_responses_are_cached_revalidated_and_invalidated_by_writes(test_client, seeded_assets):
+    app_module.role_cache.clear()
+    with test_client.application.app_context():
+        admin_id, admin_headers = _create_user('editor')
+        db.session.get(User, admin_id).is_admin = True
+        module = Module(title='Basics', order=1)
+        db.session.add(module)
+        db.session.commit()
+        module_id = module.id
+        engine = db.engine
+    created = test_client.post('/content', headers=admin_headers, json={'title': 'One', 'content_type': 'article', 'body': 'b'})
+    content_id = json.loads(created.data)['content']['id']
+
+    def get(path, **headers):
+        with statement_counter(engine) as statements:
+            response = test_client.get(path, headers=headers)
+        return response, len(statements)
+
+    page, queries = get('/content')
+    assert page.status_code == 200 and queries == 2 and page.headers['ETag']
+    assert 'must-revalidate' in page.headers['Cache-Control']
+    again, queries = get('/content')
+    assert again.data == page.data and queries == 0
+    not_modified, queries = get('/content', **{'If-None-Match': page.headers['ETag']})
+    assert not_modified.status_code == 304 and not_modified.data == b'' and queries == 0
+
+    item, queries = get(f'/content/{content_id}')
+    assert item.status_code == 200 and queries == 1 and json.loads(item.data)['author_username'] == 'editor'
+    assert get(f'/content/{content_id}', **{'If-Modified-Since': item.headers['Last-Modified']})[0].status_code == 304
+    assert get(f'/content/{content_id}', **{'If-None-Match': item.headers['ETag']})[0].status_code == 304
+
+    # Each write endpoint invalidates the item and the list pages in this process
+    test_client.put(f'/content/{content_id}', headers=admin_headers, json={'title': 'Two'})
+    updated, _ = get(f'/content/{content_id}', **{'If-None-Match': item.headers['ETag']})
+    assert updated.status_code == 200 and json.loads(updated.data)['title'] == 'Two'
+    assert get('/content', **{'If-None-Match': page.headers['ETag']})[0].status_code == 200
+    test_client.post(f'/admin/lessons/{content_id}/set-module', headers=admin_headers, json={'module_id': module_id, 'order': 1})
+    assert json.loads(get(f'/content/{content_id}')[0].data)['module_id'] == module_id
+    test_client.delete(f'/admin/modules/{module_id}', headers=admin_headers)
+    assert json.loads(get(f'/content/{content_id}')[0].data)['module_id'] is None
+    test_client.post('/admin/lessons', headers=admin_headers, json={'title': 'Three', 'content_type': 'video', 'author_id': admin_id})
+    assert json.loads(get('/content')[0].data)['total'] == 2
+    test_client.delete(f'/admin/lessons/{content_id}', headers=admin_headers)
+    assert get(f'/content/{content_id}')[0].status_code == 404
+    assert [content['title'] for content in json.loads(get('/content')[0].data)['contents']] == ['Three']
+
 # Add more tests here if needed
@@ -0,0 +1,180 @@
+import csv
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal, InvalidOperation
+from functools import partial
+
+import psycopg2
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash
+
+from models import db, User
+
+REQUIRED_COLUMNS = ('username', 'email', 'password')
+# Rows validated, hashed and inserted per round
+IMPORT_BATCH = 1000
+# Passwords sent to a hashing process per task
+HASH_CHUNK = 32
+USERNAME_MAX = User.__table__.c.username.type.length
+EMAIL_MAX = User.__table__.c.email.type.length
+COHORT_MAX = User.__table__.c.cohort.type.length
+DEFAULT_CASH = Decimal('10000.00')
+INSERT_COLUMNS = ('username', 'email', 'password_hash', 'cash_balance', 'is_admin', 'cohort')
+
+
+class ImportReport:
+    """Counts plus one (line, username, email, error) entry per rejected row."""
+
+    def __init__(self):
+        self.read = 0
+        self.created = 0
+        self.errors = []
+
+    def reject(self, line, row, error):
+        self.errors.append((line, row.get('username'), row.get('email'), error))
+
+    def write_errors(self, out):
+        writer = csv.writer(out)
+        writer.writerow(['line', 'username', 'email', 'error'])
+        writer.writerows(self.errors)
+
+
+def existing_identities():
+    """Every username and email already taken, in one query."""
+    usernames, emails = set(), set()
+    for username, email in db.session.execute(db.select(User.username, User.email)):
+        usernames.add(username)
+        emails.add(email)
+    return usernames, emails
+
+
+def validate_row(row, usernames, emails):
+    """The user to insert (without its hash), or an error message. Claims the username/email in the sets when valid."""
+    username = (row.get('username') or '').strip()
+    email = (row.get('email') or '').strip()
+    password = row.get('password') or ''
+    cohort = (row.get('cohort') or '').strip() or None
+    if not username or not email or not password:
+        return "username, email and password are required"
+    if len(username) > USERNAME_MAX or len(email) > EMAIL_MAX:
+        return f"username is limited to {USERNAME_MAX} characters and email to {EMAIL_MAX}"
+    if '@' not in email:
+        return "invalid email"
+    if cohort is not None and len(cohort) > COHORT_MAX:
+        return f"cohort is limited to {COHORT_MAX} characters"
+    try:
+        cash = Decimal(row['cash_balance']).quantize(Decimal('0.01')) if row.get('cash_balance') else DEFAULT_CASH
+    except InvalidOperation:
+        return "invalid cash_balance"
+    if username in usernames:
+        return "username already exists"
+    if email in emails:
+        return "email already exists"
+    usernames.add(username)
+    emails.add(email)
+    return {'username': username, 'email': email, 'password': password, 'cash_balance': cash, 'is_admin': False, 'cohort': cohort}
+
+
+def _uses_copy():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def _driver_cursor():
+    # The psycopg2 cursor of the current transaction's connection
+    return db.session.connection().connection.driver_connection.cursor()
+
+
+def _copy_users(rows):
+    # Postgres: one COPY per batch
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['' if row[column] is None else row[column] for column in INSERT_COLUMNS])
+    buffer.seek(0)
+    statement = f"COPY users ({', '.join(INSERT_COLUMNS)}) FROM STDIN WITH (FORMAT csv)"
+    cursor = _driver_cursor()
+    try:
+        cursor.copy_expert(statement, buffer)
+    except psycopg2.IntegrityError as e:
+        # The raw cursor bypasses SQLAlchemy's exception translation; re-raise as the error insert_batch handles
+        raise IntegrityError(statement, None, e) from e
+    finally:
+        cursor.close()
+
+
+def insert_batch(rows, report):
+    """
+    Inserts a batch in one statement (COPY on Postgres, executemany elsewhere).
+    If it hits a unique violation (an account created since the prefetch), the
+    batch is retried row by row in savepoints so only the conflicting rows are rejected.
+    """
+    values = [{column: row[column] for column in INSERT_COLUMNS} for row in rows]
+    savepoint = db.session.begin_nested()
+    try:
+        if _uses_copy():
+            _copy_users(values)
+        else:
+            db.session.execute(db.insert(User.__table__), values)
+        savepoint.commit()
+        report.created += len(rows)
+    except IntegrityError:
+        # Back to the state before the batch (on Postgres the failed COPY has aborted the transaction until then)
+        savepoint.rollback()
+        for row, value in zip(rows, values):
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(db.insert(User.__table__), value)
+                report.created += 1
+            except IntegrityError:
+                report.reject(row['line'], row, "username or email already exists")
+    db.session.commit()
+
+
+def import_users(lines, method='scrypt', workers=4, batch_size=IMPORT_BATCH, dry_run=False):
+    """
+    Creates users from CSV text (a header with username, email, password and
+    optional cohort, cash_balance), streamed `batch_size` rows at a time:
+    validate against the prefetched taken usernames/emails, hash the batch's
+    passwords across a process pool, insert the batch. Returns an ImportReport.
+    """
+    reader = csv.DictReader(lines)
+    missing = [column for column in REQUIRED_COLUMNS if column not in (reader.fieldnames or [])]
+    if missing:
+        raise ValueError(f"CSV header lacks {', '.join(missing)}")
+    usernames, emails = existing_identities()
+    report = ImportReport()
+    hash_one = partial(generate_password_hash, method=method)
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) if workers > 0 else None
+
+    def flush(batch):
+        if not batch:
+            return
+        passwords = [row.pop('password') for row in batch]
+        hashes = pool.map(hash_one, passwords, chunksize=HASH_CHUNK) if pool else map(hash_one, passwords)
+        for row, password_hash in zip(batch, hashes):
+            row['password_hash'] = password_hash
+        if dry_run:
+            report.created += len(batch)
+        else:
+            insert_batch(batch, report)
+
+    try:
+        batch = []
+        for row in reader:
+            report.read += 1
+            line = reader.line_num
+            result = validate_row(row, usernames, emails)
+            if isinstance(result, str):
+                report.reject(line, row, result)
+                continue
+            result['line'] = line
+            batch.append(result)
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        flush(batch)
+    finally:
+        if pool:
+            pool.shutdown()
+    return report
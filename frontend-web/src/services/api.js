@@ -26,6 +26,9 @@ apiClient.interceptors.request.use(
   }
 );
 
+// One refresh at a time: concurrent 401s wait for the same new access token
+let refreshInFlight = null;
+
 // Response Interceptor for 401 errors
 apiClient.interceptors.response.use(
   (response) => response,
@@ -37,6 +40,22 @@ apiClient.interceptors.response.use(
         originalRequest.url && // Ensure URL exists
         !originalRequest.url.endsWith('/auth/login') && 
         !originalRequest.url.endsWith('/auth/register')) {
+
+      // Expired access token: get a new one with the refresh token and retry once
+      if (!originalRequest._retried) {
+        originalRequest._retried = true;
+        refreshInFlight = refreshInFlight || authService.refresh().finally(() => { refreshInFlight = null; });
+        return refreshInFlight.then((token) => {
+          originalRequest.headers['Authorization'] = `Bearer ${token}`;
+          return apiClient(originalRequest);
+        }).catch(() => {
+          authService.logout();
+          if (window.location.pathname !== '/login' && window.location.pathname !== '/register') {
+            window.location.href = '/login';
+          }
+          return Promise.reject(error);
+        });
+      }
       
       console.warn('Axios interceptor: Detected 401 error. Logging out.');
       authService.logout(); // Clear token and user state
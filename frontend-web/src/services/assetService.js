@@ -11,6 +11,12 @@ const getAssetPrice = (symbol) => {
   return apiClient.get(`/assets/${symbol.toUpperCase()}/price`);
 };
 
+// Fetch current prices for several symbols in one request
+const getAssetPrices = (symbols) => {
+  const list = symbols.map((symbol) => symbol.toUpperCase()).join(',');
+  return apiClient.get(`/assets/prices?symbols=${encodeURIComponent(list)}`);
+};
+
 // Place a trade order
 const placeOrder = (assetSymbol, orderType, quantity) => {
   const payload = {
@@ -22,14 +28,17 @@ const placeOrder = (assetSymbol, orderType, quantity) => {
 };
 
 // Fetch historical price data for a specific asset symbol and range
-const getAssetHistory = (symbol, range) => {
+const getAssetHistory = (symbol, range, points) => {
   // range: '1d', '1m', '6m', 'ytd', '1y', '3y'
-  return apiClient.get(`/assets/${symbol.toUpperCase()}/history?range=${range}`);
+  // points (optional): max points to return, e.g. the chart width in pixels
+  const pointsParam = points ? `&points=${points}` : '';
+  return apiClient.get(`/assets/${symbol.toUpperCase()}/history?range=${range}${pointsParam}`);
 };
 
 const assetService = {
   getAllAssets,
   getAssetPrice,
+  getAssetPrices,
   placeOrder,
   getAssetHistory,
 };
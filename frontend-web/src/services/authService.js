@@ -25,8 +25,29 @@ const login = (usernameOrEmail, password) => {
 };
 
 const logout = () => {
+  const user = getCurrentUser();
   localStorage.removeItem('user');
-  // Potentially call a backend /auth/logout endpoint if it exists and needs to invalidate server-side session/token
+  // Revoke the session server-side so a leaked refresh token can't mint new access tokens
+  if (user && user.access_token) {
+    axios.post(`${API_URL}/auth/logout`, { refresh_token: user.refresh_token }, {
+      headers: { Authorization: `Bearer ${user.access_token}` },
+    }).catch(() => {}); // Best effort: the local session is gone either way
+  }
+};
+
+// Exchanges the stored refresh token for a new access token (no password needed)
+const refresh = () => {
+  const user = getCurrentUser();
+  if (!user || !user.refresh_token) {
+    return Promise.reject(new Error('No refresh token'));
+  }
+  return axios.post(`${API_URL}/auth/refresh`, null, {
+    headers: { Authorization: `Bearer ${user.refresh_token}` },
+  }).then((response) => {
+    const updated = { ...user, access_token: response.data.access_token };
+    localStorage.setItem('user', JSON.stringify(updated));
+    return updated.access_token;
+  });
 };
 
 const getCurrentUser = () => {
@@ -47,6 +68,7 @@ const authService = {
   register,
   login,
   logout,
+  refresh,
   getCurrentUser,
   getAuthToken,
 };
@@ -18,8 +18,24 @@ const getPortfolio = () => {
   return apiClient.get(`/portfolio`, { headers: getAuthHeaders() });
 };
 
+// range: '1w', '1m', '3m', '6m', '1y', 'all'; points optionally caps the number of points returned
+const getPortfolioHistory = (range = '1m', points) => {
+  const params = { range };
+  if (points) params.points = points;
+  return apiClient.get(`/portfolio/history`, { headers: getAuthHeaders(), params });
+};
+
+// Ranking by account value; cohort optionally restricts it to one competition group
+const getLeaderboard = (page = 1, perPage = 20, cohort) => {
+  const params = { page, per_page: perPage };
+  if (cohort) params.cohort = cohort;
+  return apiClient.get(`/leaderboard`, { headers: getAuthHeaders(), params });
+};
+
 const portfolioService = {
   getPortfolio,
+  getPortfolioHistory,
+  getLeaderboard,
 };
 
 export default portfolioService;
@@ -7,8 +7,23 @@ const getTrades = (assetSymbol) => {
   return apiClient.get(url);
 };
 
+// One page of trades; pass the previous response's next_cursor to continue
+const getTradesPage = ({ assetSymbol, limit = 50, cursor, order = 'desc' } = {}) => {
+  const params = { limit, order };
+  if (assetSymbol) params.asset = assetSymbol;
+  if (cursor) params.cursor = cursor;
+  return apiClient.get('/trades', { params });
+};
+
+// Full history as a file download: format is 'csv' or 'ndjson'
+const exportTrades = (format = 'csv') => {
+  return apiClient.get('/trades/export', { params: { format }, responseType: 'blob' });
+};
+
 const tradeService = {
   getTrades,
+  getTradesPage,
+  exportTrades,
 };
 
 export default tradeService;